@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""benchmark
+
+Benchmark of the preprocess, train and predict functions of molecular.py and molecular_eda.py
+on synthetic QM9-like data. The functions are loaded from the notebook scripts
+without running their cells.
+
+    python benchmark.py --n-molecules 2000 --out bench.json
+    python benchmark.py --n-molecules 2000 --out bench.json --baseline bench_old.json
+"""
+
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import logging
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    import lightgbm as lgb
+except ImportError:
+    lgb = None
+
+"""## config"""
+
+NOTEBOOK_DIR = os.path.dirname(os.path.abspath(__file__))
+MOLECULAR_PATH = os.path.join(NOTEBOOK_DIR, 'molecular.py')
+MOLECULAR_EDA_PATH = os.path.join(NOTEBOOK_DIR, 'molecular_eda.py')
+
+# QM9: up to 9 heavy atoms (C, N, O, F) and 29 atoms with H
+MAX_HEAVY_ATOMS = 9
+HEAVY_ATOMS = ['C', 'N', 'O', 'F']
+HEAVY_ATOM_PROB = [0.7, 0.12, 0.15, 0.03]
+VALENCE = {'C': 4, 'N': 3, 'O': 2, 'F': 1}
+BOND_LENGTH = {'H': 1.09, 'C': 1.50, 'N': 1.45, 'O': 1.43, 'F': 1.35}
+# 8 coupling types of train.csv
+COUPLING_TYPES = ['1JHC', '1JHN', '2JHC', '2JHH', '2JHN', '3JHC', '3JHH', '3JHN']
+
+# functions (and constants) used by the benchmarks
+MOLECULAR_NAMES = [
+    'INT_MOLECULE_ID', 'MOLECULE_PREFIX', 'TARGET', 'N_FOLDS', 'N_JOBS', 'USE_GROUP_MAE_FEVAL',
+    'REDUCE_MEM_RTOL', 'SAVE_LGB_DATASET', 'atom_weight', 'UNSEEN_CODE', 'FE_AGGS', 'Encoder',
+    'GEO_KNN', 'GEO_RADII', 'GEO_ELEMENTS', 'GEO_BATCH_SIZE',
+    'encode_molecule_name', 'StructureIndex', 'map_atom_info', 'calc_dist',
+    'molecule_atoms', 'atom_geometry', 'add_geometry_features', 'relabel', 'divide_type',
+    'group_transform', 'feature_engineering', 'str_sort',
+    'fillna_label', 'load_2j_table', 'add_2j_center_atom', 'load_3j_table', 'add_3j_center_atom',
+    '_round_trip_ok', 'reduce_mem_usage',
+    'update_code_hash', 'fingerprint', 'group_codes', 'GroupMAE', 'group_mean_log_mae', 'group_mae_feval',
+    'FOLD_PATH', 'make_group_folds', 'fold_key', 'get_folds', 'oof_split', 'build_dataset', 'fit_fold', 'collect_folds', 'oof_train',
+    'to_float32', 'scale_tree', 'merge_boosters', 'oof_predict', 'gen_params',
+]
+MOLECULAR_EDA_NAMES = [
+    'topological_distance', 'BondGraph', 'path_bonds', 'unique_candidate',
+    'get_intercept_atom_2j', 'get_intercept_atom_3j',
+    'ATOM_W', 'ELEMENTS', 'neighbor_composition', 'get_1j_features',
+    'get_xyz', 'normalize', 'get_cos_2j', 'get_cos_3j',
+]
+
+"""## logging"""
+
+def get_logger():
+    return logging.getLogger('benchmark')
+
+"""## load functions"""
+
+def iter_definitions(path):
+    """
+    (defined names, source) of the top-level definitions (functions, classes and assignments)
+    in a notebook script, in the order of the script.
+    """
+    src = open(path).read()
+    for node in ast.parse(src).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            defined = [node.name]
+        elif isinstance(node, ast.Assign):
+            defined = [t.id for t in node.targets if isinstance(t, ast.Name)]
+        else:
+            continue
+        yield defined, ast.get_source_segment(src, node)
+
+def load_definitions(path, names, ns):
+    """
+    Execute only the definitions of `names` (functions, classes and assignments)
+    in a notebook script, in the order of the script.
+    """
+    for defined, source in iter_definitions(path):
+        if any(name in names for name in defined):
+            exec(source, ns)
+    return ns
+
+def load_functions(preprocess_dir):
+    """
+    Returns
+    -------
+    mol: dict
+        namespace of molecular.py
+    eda: dict
+        namespace of molecular_eda.py
+    """
+    base = {'np': np, 'pd': pd, 'lgb': lgb, 'joblib': joblib, 'os': os, 're': re, 'math': math,
+            'json': json, 'hashlib': hashlib, 'inspect': inspect, 'sp': sp,
+            'get_logger': get_logger, 'display': lambda *args, **kwargs: None,
+            # the benchmark measures the functions without the stage records of molecular.py
+            'instrument': lambda *args, **kwargs: (lambda func: func)}
+    # the tables, binned datasets and folds of the benchmark are in preprocess_dir
+    mol = load_definitions(MOLECULAR_PATH, MOLECULAR_NAMES, dict(base, PREPROCESS=preprocess_dir))
+    mol['LGB_DATASET_DIR'] = os.path.join(preprocess_dir, 'lgb_dataset/')
+    eda = load_definitions(MOLECULAR_EDA_PATH, MOLECULAR_EDA_NAMES, dict(base))
+    return mol, eda
+
+"""## synthetic data"""
+
+def make_molecule(rng, max_heavy=MAX_HEAVY_ATOMS):
+    """
+    Returns
+    -------
+    atoms: list of str
+    xyz: np.ndarray, shape [n_atoms, 3]
+    bonds: list of (atom_index_0, atom_index_1, nbond)
+    """
+    n_heavy = rng.randint(1, max_heavy + 1)
+    atoms = []
+    free = []
+    bonds = []
+    parent = []
+    for i in range(n_heavy):
+        cand = [j for j in range(i) if free[j] > 0]
+        if i > 0 and len(cand) == 0:
+            break
+        atom = rng.choice(HEAVY_ATOMS, p=HEAVY_ATOM_PROB) if i > 0 else 'C'
+        atoms.append(atom)
+        free.append(VALENCE[atom])
+        if i > 0:
+            j = cand[rng.randint(len(cand))]
+            bonds.append((j, i, 1.0))
+            free[i] -= 1
+            free[j] -= 1
+        parent.append(bonds[-1][0] if i > 0 else -1)
+    # ring closure
+    n_heavy = len(atoms)
+    if n_heavy >= 5 and rng.rand() < 0.3:
+        cand = [i for i in range(n_heavy) if free[i] > 0]
+        if len(cand) >= 2:
+            i, j = rng.choice(cand, 2, replace=False)
+            if (i, j) not in [(a, b) for a, b, _ in bonds] and (j, i) not in [(a, b) for a, b, _ in bonds]:
+                bonds.append((min(i, j), max(i, j), 1.0))
+                free[i] -= 1
+                free[j] -= 1
+    for i in range(n_heavy):
+        for _ in range(free[i]):
+            atoms.append('H')
+            parent.append(i)
+            bonds.append((i, len(atoms) - 1, 1.0))
+
+    # place each atom at a bond length from its parent
+    xyz = np.zeros((len(atoms), 3))
+    direction = rng.normal(size=(len(atoms), 3))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    for i in range(1, len(atoms)):
+        xyz[i] = xyz[parent[i]] + BOND_LENGTH[atoms[i]] * direction[i]
+    return atoms, xyz, bonds
+
+def bond_distance(n_atoms, bonds, max_dist=3):
+    """the number of bonds between atoms (max_dist + 1 if farther)"""
+    adj = np.zeros((n_atoms, n_atoms), dtype=np.int32)
+    for a, b, _ in bonds:
+        adj[a, b] = adj[b, a] = 1
+    dist = np.full((n_atoms, n_atoms), max_dist + 1)
+    np.fill_diagonal(dist, 0)
+    reach = np.eye(n_atoms, dtype=np.int32)
+    for d in range(1, max_dist + 1):
+        reach = ((reach @ adj) > 0).astype(np.int32)
+        dist[(reach > 0) & (dist > d)] = d
+    return dist
+
+def make_dataset(n_molecules, seed=0):
+    """
+    Synthetic train.csv, structures.csv and bonds (train_bonds.csv) like QM9.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        'id', 'molecule_name', 'atom_index_0', 'atom_index_1', 'type', 'scalar_coupling_constant'
+    df_strct: pd.DataFrame
+        'molecule_name', 'atom_index', 'atom', 'x', 'y', 'z'
+    df_bonds: pd.DataFrame
+        'molecule_name', 'atom_index_0', 'atom_index_1', 'nbond'
+    """
+    rng = np.random.RandomState(seed)
+    strct, bonds_rows, pairs = [], [], []
+    for m in range(n_molecules):
+        name = 'dsgdb9nsd_%06d' % (m + 1)
+        atoms, xyz, bonds = make_molecule(rng)
+        atoms = np.array(atoms)
+        strct.append(pd.DataFrame({'molecule_name': name, 'atom_index': np.arange(len(atoms)), 'atom': atoms,
+                                   'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2]}))
+        bonds_rows += [(name, a, b, o) for a, b, o in bonds]
+
+        # couplings of H and (C, N, H) within 3 bonds. H-H pairs are listed once.
+        dist = bond_distance(len(atoms), bonds)
+        idx0, idx1 = np.nonzero((dist >= 1) & (dist <= 3))
+        is_pair = (atoms[idx0] == 'H') & np.isin(atoms[idx1], ['C', 'N', 'H'])
+        is_pair &= (atoms[idx1] != 'H') | (idx0 < idx1)
+        idx0, idx1 = idx0[is_pair], idx1[is_pair]
+        types = np.char.add(np.char.add(dist[idx0, idx1].astype(str), 'JH'), atoms[idx1])
+        pairs.append(pd.DataFrame({'molecule_name': name, 'atom_index_0': idx0, 'atom_index_1': idx1,
+                                   'type': types, 'dist': np.linalg.norm(xyz[idx0] - xyz[idx1], axis=1)}))
+
+    df_strct = pd.concat(strct, ignore_index=True)
+    df_bonds = pd.DataFrame(bonds_rows, columns=['molecule_name', 'atom_index_0', 'atom_index_1', 'nbond'])
+    df = pd.concat(pairs, ignore_index=True)
+    df.insert(0, 'id', np.arange(len(df)))
+    # a target depending on the type and the distance
+    type_mean = pd.Series(np.linspace(-10, 90, len(COUPLING_TYPES)), index=COUPLING_TYPES)
+    df['scalar_coupling_constant'] = (df['type'].map(type_mean).values - 5 * df['dist'].values
+                                      + rng.normal(scale=1.0, size=len(df)))
+    df.drop('dist', axis=1, inplace=True)
+    return df, df_strct, df_bonds
+
+"""## measure"""
+
+def read_status_kb(key):
+    """value of `key` (e.g. VmRSS, VmHWM) in /proc/self/status in KB. None if unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """reset VmHWM (peak RSS) of this process. False if the OS does not support it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    hwm = read_status_kb('VmHWM')
+    if hwm is not None:
+        return hwm / 1024
+    import resource
+    # ru_maxrss is KB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+def measure(func, n_rows, repeat=1):
+    """
+    Run func() `repeat` times and take the fastest run.
+
+    Parameters
+    ----------
+    func: callable
+        func() runs the benchmark target on fresh inputs.
+    n_rows: int
+        the number of rows processed by func()
+
+    Returns
+    -------
+    ret: dict
+    """
+    best = None
+    is_reset = reset_peak_rss()
+    rss_start = read_status_kb('VmRSS')
+    for _ in range(repeat):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        func()
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+    wall, cpu = best
+    return {'seconds': wall,
+            'cpu_seconds': cpu,
+            'rows': int(n_rows),
+            'rows_per_sec': n_rows / wall if wall > 0 else float('inf'),
+            'peak_rss_mb': peak_rss_mb(),
+            # peak RSS is of the process when VmHWM can not be reset
+            'peak_rss_is_stage': is_reset,
+            'rss_start_mb': None if rss_start is None else rss_start / 1024}
+
+"""## benchmarks"""
+
+def run_benchmarks(n_molecules, repeat=1, seed=0, train=True):
+    """
+    Returns
+    -------
+    ret: dict
+        {'meta': ..., 'results': {benchmark name: output of measure()}}
+    """
+    preprocess_dir = tempfile.mkdtemp(prefix='mole_bench_') + '/'
+    mol, eda = load_functions(preprocess_dir)
+
+    get_logger().info('generate %d molecules' % n_molecules)
+    df, df_strct, df_bonds = make_dataset(n_molecules, seed)
+    if mol['INT_MOLECULE_ID']:
+        for d in [df, df_strct, df_bonds]:
+            mol['encode_molecule_name'](d)
+    get_logger().info('%d couplings, %d atoms, %d bonds' % (len(df), len(df_strct), len(df_bonds)))
+
+    results = {}
+    def bench(name, func, n_rows):
+        get_logger().info('benchmark %s' % name)
+        results[name] = measure(func, n_rows, repeat)
+        get_logger().info('%s: %.3f sec, %.0f rows/sec' % (name, results[name]['seconds'], results[name]['rows_per_sec']))
+
+    strct = mol['StructureIndex'](df_strct)
+    bench('StructureIndex', lambda: mol['StructureIndex'](df_strct), len(df_strct))
+
+    # bond graph and intercept atoms (molecular_eda.py)
+    n_atoms = pd.Series(strct.n_atoms, index=strct.mol_names)
+    graph = eda['BondGraph'].from_bonds(df_bonds, n_atoms)
+    bench('BondGraph.from_bonds', lambda: eda['BondGraph'].from_bonds(df_bonds, n_atoms), len(df_bonds))
+    bench('BondGraph.topological_distance',
+          lambda: eda['BondGraph'].from_bonds(df_bonds, n_atoms).topological_distance(), len(df_strct))
+    graph.topological_distance()
+
+    n_bond = df['type'].str[0]
+    df_1j = df[n_bond == '1'].reset_index(drop=True)
+    bench('neighbor_composition', lambda: eda['neighbor_composition'](graph, strct), len(df_strct))
+    comp = eda['neighbor_composition'](graph, strct)
+    bench('get_1j_features', lambda: eda['get_1j_features'](df_1j, graph, strct, comp), len(df_1j))
+    df_2j = df[n_bond == '2'].reset_index(drop=True)
+    df_3j = df[n_bond == '3'].reset_index(drop=True)
+    bench('get_intercept_atom_2j', lambda: eda['get_intercept_atom_2j'](df_2j, graph), len(df_2j))
+    bench('get_intercept_atom_3j', lambda: eda['get_intercept_atom_3j'](df_3j, graph), len(df_3j))
+    df_2j['center_index'] = eda['get_intercept_atom_2j'](df_2j, graph)
+    df_3j['center_index_0'], df_3j['center_index_1'] = eda['get_intercept_atom_3j'](df_3j, graph)
+    bench('get_cos_2j', lambda: eda['get_cos_2j'](df_2j, strct), len(df_2j))
+    bench('get_cos_3j', lambda: eda['get_cos_3j'](df_3j, strct), len(df_3j))
+    joblib.dump(eda['get_cos_2j'](df_2j, strct), preprocess_dir + 'df_2jsim.pkl')
+    joblib.dump(eda['get_cos_3j'](df_3j, strct), preprocess_dir + 'df_3jsim.pkl')
+
+    # preprocess (molecular.py)
+    table_2j = mol['load_2j_table']()
+    table_3j = mol['load_3j_table']()
+    bench('add_2j_center_atom', lambda: mol['add_2j_center_atom'](df.copy(), table_2j), len(df))
+    bench('add_3j_center_atom', lambda: mol['add_3j_center_atom'](df.copy(), table_3j), len(df))
+
+    bench('map_atom_info', lambda: mol['map_atom_info'](mol['map_atom_info'](df.copy(), strct, 0), strct, 1), len(df))
+    df_fe = mol['map_atom_info'](mol['map_atom_info'](df.copy(), strct, 0), strct, 1)
+    bench('calc_dist', lambda: mol['calc_dist'](df_fe.copy()), len(df))
+    df_fe = mol['calc_dist'](df_fe)
+    bench('add_geometry_features', lambda: mol['add_geometry_features'](df_fe.copy(), strct), len(df))
+    df_fe = mol['divide_type'](mol['add_geometry_features'](df_fe, strct))
+    bench('feature_engineering', lambda: mol['feature_engineering'](df_fe.copy()), len(df))
+    df_fe = mol['feature_engineering'](df_fe)
+
+    cat_names = ['type', 'type_0', 'type_1', '2j_atom_center', '3j_atom_center']
+    df_cat = mol['add_3j_center_atom'](mol['add_2j_center_atom'](df.copy(), table_2j), table_3j)
+    df_cat = mol['divide_type'](df_cat)[cat_names]
+    enc = mol['Encoder']()
+    enc.fit(df_cat, cat_names)
+    bench('Encoder.transform', lambda: enc.transform(df_cat.copy()), len(df_cat))
+
+    df_num = df_fe.select_dtypes(include='number').drop(['id', mol['TARGET']], axis=1)
+    bench('reduce_mem_usage', lambda: mol['reduce_mem_usage'](df_num.copy(), verbose=False), len(df_num))
+
+    # train and predict a type
+    if train and lgb is None:
+        get_logger().warning('lightgbm is not installed. skip oof_train and oof_predict')
+    elif train:
+        is_the_type = (df_fe['type'] == '3JHC').values
+        X = df_num[is_the_type].reset_index(drop=True)
+        y = df_fe.loc[is_the_type, mol['TARGET']].reset_index(drop=True)
+        types = df_fe.loc[is_the_type, 'type'].reset_index(drop=True)
+        folds = mol['make_group_folds'](df_fe.loc[is_the_type, 'molecule_name'].values, types)
+        bench('oof_train', lambda: mol['oof_train'](X, y, types, folds), len(X))
+        models, _, _ = mol['oof_train'](X, y, types, folds)
+        bench('oof_predict', lambda: mol['oof_predict'](models, X), len(X))
+
+    meta = {'n_molecules': n_molecules,
+            'n_couplings': int(len(df)),
+            'n_atoms': int(len(df_strct)),
+            'repeat': repeat,
+            'seed': seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'lightgbm': None if lgb is None else lgb.__version__,
+            'cpu_count': joblib.cpu_count()}
+    return {'meta': meta, 'results': results}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=NOTEBOOK_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(result, baseline, tolerance=0.8):
+    """
+    Compare rows/sec with a baseline.
+
+    Parameters
+    ----------
+    tolerance: float
+        a benchmark is a regression if rows/sec is less than tolerance * baseline.
+
+    Returns
+    -------
+    df_cmp: pd.DataFrame
+    """
+    rows = []
+    for name, res in result['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        speedup = res['rows_per_sec'] / base['rows_per_sec']
+        rows.append((name, base['rows_per_sec'], res['rows_per_sec'], speedup,
+                     base['peak_rss_mb'], res['peak_rss_mb'], speedup < tolerance))
+    return pd.DataFrame(rows, columns=['benchmark', 'base_rows_per_sec', 'rows_per_sec', 'speedup',
+                                       'base_peak_rss_mb', 'peak_rss_mb', 'regression'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-molecules', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-train', action='store_true', help='skip oof_train and oof_predict')
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--baseline', default=None, help='json of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.8)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    result = run_benchmarks(args.n_molecules, args.repeat, args.seed, train=not args.no_train)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+    get_logger().info('saved %s' % args.out)
+
+    df_res = pd.DataFrame(result['results']).T[['seconds', 'rows', 'rows_per_sec', 'peak_rss_mb']]
+    print(df_res.to_string())
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        df_cmp = compare(result, baseline, args.tolerance)
+        print(df_cmp.to_string(index=False))
+        if df_cmp['regression'].any():
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,17 @@ import math
 from tqdm import tqdm
 import joblib
 import gc
+import os
+import json
+import hashlib
+import inspect
+import shutil
+import time
+import itertools
+import re
+import functools
+import contextlib
+import threading
 
 """## config"""
 
@@ -38,14 +49,64 @@ PREPROCESS = './analysis/mole/data/preprocess/'
 MID_MODEL_PATH = PREPROCESS + 'middle_model.pkl'
 MODEL_PATH = PREPROCESS + 'model.pkl'
 ENCODER_PATH = PREPROCESS + 'le.pkl'
+FEATURE_STORE_DIR = PREPROCESS + 'feature_store/'
+STAGE_CACHE_DIR = PREPROCESS + 'stage_cache/'
+# boosters, feature columns and encoder for prediction (see ModelArtifact)
+ARTIFACT_DIR = PREPROCESS + 'artifact/'
+# fold of each row of train.csv (int8)
+FOLD_PATH = PREPROCESS + 'folds.npz'
+# binned lgb.Dataset of each coupling type (used if SAVE_LGB_DATASET)
+LGB_DATASET_DIR = PREPROCESS + 'lgb_dataset/'
+SAVE_LGB_DATASET = False
 
 USE_PREPROCESS_DATA = False
+# cache each stage of preprocess() by hash of its input and code
+USE_STAGE_CACHE = True
+# use int32 id (e.g. 1) instead of molecule_name (e.g. 'dsgdb9nsd_000001')
+INT_MOLECULE_ID = True
+MOLECULE_PREFIX = 'dsgdb9nsd_'
+# raw csv files are converted to .npy columns on the first read and memory-mapped afterwards
+USE_CSV_CACHE = True
+CSV_CACHE_DIR = PREPROCESS + 'csv_cache/'
+# dtypes of the columns of the raw csv files (the targets keep float64)
+CSV_DTYPES = {
+    'id': np.int32, 'molecule_name': 'category', 'type': 'category', 'atom': 'category',
+    'atom_index': np.int8, 'atom_index_0': np.int8, 'atom_index_1': np.int8,
+    'x': np.float32, 'y': np.float32, 'z': np.float32,
+    'scalar_coupling_constant': np.float64,
+    'fc': np.float64, 'sd': np.float64, 'pso': np.float64, 'dso': np.float64,
+}
 TARGET = 'scalar_coupling_constant'
 MERGE_KEY = ['molecule_name', 'atom_index_0', 'atom_index_1']
 CONTR_COLS = ['fc', 'sd', 'pso', 'dso']
 N_FOLDS = 3
+# the number of processes for per-molecule preprocessing (-1: all cores)
+N_JOBS = -1
+# the number of (type, fold) trainings running at once (1: one by one)
+TRAIN_N_WORKERS = 4
+# early stopping by group_mean_log_mae instead of mae
+USE_GROUP_MAE_FEVAL = False
+# the max relative error allowed when reduce_mem_usage() casts floats
+REDUCE_MEM_RTOL = 1e-6
+# predict test.csv by chunks of about this number of rows (molecule-aligned)
+STREAM_PREDICT = True
+STREAM_CHUNK_SIZE = 200000
+# train fc/sd/pso/dso and TARGET on shared features (CNTR)
+# and use their out-of-fold predictions as features of the models of TARGET
+TRAIN_CONTRIBUTIONS = False
+# measure latency of score_molecule() on test molecules
+RUN_SCORE_BENCHMARK = False
+
+# per-atom geometry features of atom_index_0 and atom_index_1 (see atom_geometry())
+GEO_KNN = 4
+GEO_RADII = [1.2, 1.6, 2.5]
+GEO_ELEMENTS = ['H', 'C', 'N', 'O', 'F']
+# the number of molecules of a padded distance tensor
+GEO_BATCH_SIZE = 10000
 
 atom_weight = {'H': 1.008, 'C': 12.01, 'N': 14.01, 'O':16.00}
+# code of the categories not seen when Encoder is fitted
+UNSEEN_CODE = -1
 
 """## logging"""
 
@@ -75,8 +136,259 @@ def get_logger():
 
 create_logger('mole.log')
 
+"""### stage instrumentation
+Wall/CPU time, shapes and memory of each stage are written as JSON lines next to mole.log.
+"""
+
+def rss_mb():
+    """current RSS of this process in MB. None if /proc is not available."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def data_shape(obj):
+    if isinstance(obj, tuple):
+        obj = next((o for o in obj if hasattr(o, 'shape')), None)
+    return list(obj.shape) if hasattr(obj, 'shape') else None
+
+def data_mb(obj):
+    """memory of a dataframe or array in MB (object columns are counted by their pointers)"""
+    if isinstance(obj, tuple):
+        obj = next((o for o in obj if hasattr(o, 'shape')), None)
+    if isinstance(obj, pd.DataFrame):
+        return obj.memory_usage(index=True).sum() / 1024**2
+    elif isinstance(obj, (pd.Series, np.ndarray)):
+        return obj.nbytes / 1024**2
+    return None
+
+class StageRecorder:
+    """
+    Records of stages appended to a JSON lines file.
+    Worker processes (e.g. of run_sharded) append to the same file with the same run_id.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.run_id = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    
+    def write(self, record):
+        record['run_id'] = self.run_id
+        record['pid'] = os.getpid()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    
+    def load(self):
+        """records of this run"""
+        if not os.path.exists(self.path):
+            return pd.DataFrame()
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        return pd.DataFrame([r for r in records if r.get('run_id') == self.run_id])
+
+stage_recorder = StageRecorder('mole_stages.jsonl')
+
+@contextlib.contextmanager
+def stage(name, data=None, **info):
+    """
+    Record a stage.
+    
+        with stage('name', df) as rec:
+            df = ...
+            rec['out'] = df
+    
+    Parameters
+    ----------
+    data: pd.DataFrame, np.ndarray or None
+        input of the stage
+    info: 
+        other values written to the record (e.g. n_fold)
+    
+    A stage on a worker thread (e.g. a fold of run_fold_tasks) runs concurrently with
+    the other stages of the process, so its CPU time is of the thread (time.thread_time(),
+    without the native threads of LightGBM) and the process-wide RSS is not recorded.
+    """
+    rec = {'out': None}
+    in_shape, in_mb = data_shape(data), data_mb(data)
+    on_main = (threading.current_thread() is threading.main_thread())
+    cpu_time = time.process_time if on_main else time.thread_time
+    rss_start = rss_mb() if on_main else None
+    wall_start, cpu_start = time.perf_counter(), cpu_time()
+    try:
+        yield rec
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, cpu_time() - cpu_start
+        out = rec.pop('out')
+        rss_end, out_mb = (rss_mb() if on_main else None), data_mb(out)
+        record = {'stage': name, 
+                  'wall_sec': wall, 
+                  'cpu_sec': cpu,
+                  'cpu_scope': 'process' if on_main else 'thread',
+                  'in_shape': in_shape, 
+                  'out_shape': data_shape(out),
+                  # RSS of the whole process
+                  'rss_mb': rss_end,
+                  'rss_delta_mb': None if rss_start is None or rss_end is None else rss_end - rss_start,
+                  'pandas_delta_mb': None if in_mb is None or out_mb is None else out_mb - in_mb}
+        record.update(info)
+        stage_recorder.write(record)
+
+def instrument(name=None, keys=()):
+    """
+    Decorator recording each call as a stage.
+    The first dataframe or array in the arguments is the input, and the return value is the output.
+    
+    Parameters
+    ----------
+    name: None or str
+        name of the stage. If None, the qualified name of the function.
+    keys: list of str
+        arguments written to the record (e.g. ['n_fold'])
+    """
+    def decorator(func):
+        stage_name = func.__qualname__ if name is None else name
+        sig = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            info = {}
+            if keys:
+                arguments = sig.bind(*args, **kwargs).arguments
+                info = {key: arguments[key] for key in keys if key in arguments}
+            data = next((a for a in args if isinstance(a, (pd.DataFrame, pd.Series, np.ndarray))), None)
+            with stage(stage_name, data, **info) as rec:
+                ret = func(*args, **kwargs)
+                rec['out'] = ret
+            return ret
+        return wrapper
+    return decorator
+
+def stage_summary(recorder=None):
+    """
+    Total of the stages of this run, the slowest first.
+    """
+    recorder = stage_recorder if recorder is None else recorder
+    df = recorder.load()
+    if len(df) == 0:
+        return df
+    df_sum = df.groupby('stage').agg(calls=('wall_sec', 'size'),
+                                     wall_sec=('wall_sec', 'sum'),
+                                     cpu_sec=('cpu_sec', 'sum'),
+                                     cpu_scope=('cpu_scope', 'first'),
+                                     max_rss_mb=('rss_mb', 'max'),
+                                     max_rss_delta_mb=('rss_delta_mb', 'max'),
+                                     pandas_delta_mb=('pandas_delta_mb', 'sum'))
+    df_sum['wall_ratio'] = df_sum['wall_sec'] / df_sum['wall_sec'].sum()
+    return df_sum.sort_values('wall_sec', ascending=False)
+
 """## util"""
 
+def encode_molecule_name(df):
+    """
+    Convert 'molecule_name' (e.g. 'dsgdb9nsd_000001') to int32 id (e.g. 1) in place.
+    It does nothing if 'molecule_name' is already converted.
+    """
+    if not pd.api.types.is_integer_dtype(df['molecule_name']):
+        df['molecule_name'] = df['molecule_name'].str[len(MOLECULE_PREFIX):].astype(np.int32)
+    return df
+
+def decode_molecule_name(mole_id):
+    """
+    Inverse of encode_molecule_name.
+    
+    Parameters
+    ----------
+    mole_id: array-like object, shape [n_samples]
+    
+    Returns
+    -------
+    mole_name: pd.Series, shape [n_samples]
+    """
+    return MOLECULE_PREFIX + pd.Series(mole_id).astype(str).str.zfill(6)
+
+def csv_dtypes(path, usecols=None):
+    """CSV_DTYPES of the columns of a csv file"""
+    columns = pd.read_csv(path, nrows=0).columns
+    return {col: CSV_DTYPES[col] for col in columns
+            if col in CSV_DTYPES and (usecols is None or col in usecols)}
+
+def read_csv(path, usecols=None, **kwargs):
+    """
+    pd.read_csv with CSV_DTYPES converting 'molecule_name' to int id if INT_MOLECULE_ID is True.
+    String columns not in CSV_DTYPES are read as category.
+    """
+    df = pd.read_csv(path, usecols=usecols, dtype=csv_dtypes(path, usecols), **kwargs)
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col].dtype):
+            df[col] = df[col].astype('category')
+    if INT_MOLECULE_ID and 'molecule_name' in df.columns:
+        df = encode_molecule_name(df)
+    return df
+
+def csv_cache_dir(path):
+    """directory of the binary cache of a csv file. It changes when the file or the dtypes change."""
+    st = os.stat(path)
+    key = hashlib.sha1(repr((os.path.abspath(path), st.st_mtime_ns, st.st_size,
+                             sorted(CSV_DTYPES.items()), INT_MOLECULE_ID)).encode()).hexdigest()
+    return os.path.join(CSV_CACHE_DIR, '%s_%s' % (os.path.basename(path), key[:16]))
+
+def load_csv(path, usecols=None, cache=USE_CSV_CACHE, **kwargs):
+    """
+    read_csv() with a binary cache.
+    
+    On the first read, each column is saved as <CSV_CACHE_DIR>/<file>_<key>/<column>.npy
+    (category as int codes and the categories in meta.json).
+    Later loads memory-map the files (copy-on-write), so they are fast and
+    the pages are shared between processes.
+    
+    Parameters
+    ----------
+    path: str
+    usecols: None or list of str
+        columns to load. Columns not in the cache yet are read from the csv and added.
+    cache: bool
+        If False or kwargs are given, the csv is read without the cache.
+    kwargs:
+        other arguments of pd.read_csv
+    """
+    if not cache or kwargs:
+        return read_csv(path, usecols=usecols, **kwargs)
+    
+    cache_dir = csv_cache_dir(path)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    else:
+        meta = {'columns': pd.read_csv(path, nrows=0).columns.tolist(), 'categories': {}}
+    # in the order of the csv
+    columns = [col for col in meta['columns'] if usecols is None or col in usecols]
+    
+    missing = [col for col in columns if not os.path.exists(os.path.join(cache_dir, col + '.npy'))]
+    if missing:
+        get_logger().info('convert %s to %s' % (path, cache_dir))
+        df = read_csv(path, usecols=missing)
+        os.makedirs(cache_dir, exist_ok=True)
+        for col in missing:
+            values = df[col].values
+            if isinstance(values, pd.Categorical):
+                meta['categories'][col] = values.categories.tolist()
+                values = values.codes
+            np.save(os.path.join(cache_dir, col + '.npy'), np.asarray(values))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    
+    data = {}
+    for col in columns:
+        values = np.load(os.path.join(cache_dir, col + '.npy'), mmap_mode='c')
+        if col in meta['categories']:
+            values = pd.Categorical.from_codes(values, meta['categories'][col])
+        data[col] = values
+    return pd.DataFrame(data, copy=False)
+
 def onehot(_df):
     cat_names = [name for name, col in _df.iteritems() if col.dtype == 'O']
     df_cat = pd.get_dummies(_df[cat_names])
@@ -93,95 +405,274 @@ def label_encode(df):
     return df
 
 class Encoder:
-    def __init__(self):        
-        self.encoders = {}
+    """
+    Label encoding of categorical columns by fixed vocabularies.
+    
+    The code of a category is its position in the sorted vocabulary of fit() (same as LabelEncoder)
+    and the categories not in the vocabulary (e.g. a new center atom at prediction) are UNSEEN_CODE.
+    """
+    def __init__(self):
+        self.vocabs = {}
+    
+    def __setstate__(self, state):
+        # Encoder pickled with a LabelEncoder for each column
+        if 'encoders' in state:
+            state = {'vocabs': {cat_name: pd.Index(le.classes_) for cat_name, le in state['encoders'].items()}}
+        self.__dict__.update(state)
     
     def fit(self, df, cat_names):
         for cat_name in cat_names:
-            le = LabelEncoder()
-            le.fit(df[cat_name].values)
-            self.encoders[cat_name] = le        
+            self.vocabs[cat_name] = pd.Index(sorted(df[cat_name].dropna().unique()))
+    
+    def encode(self, cat_name, values):
+        """
+        Parameters
+        ----------
+        cat_name: str
+        values: array-like object or pd.Categorical, shape [n_samples]
+        
+        Returns
+        -------
+        codes: np.ndarray of int32, shape [n_samples]
+        """
+        vocab = self.vocabs[cat_name]
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            # look up only the categories
+            values = pd.Categorical(values)
+            table = np.append(vocab.get_indexer(values.categories), UNSEEN_CODE).astype(np.int32)
+            return table[values.codes]
+        codes = vocab.get_indexer(np.asarray(values, dtype=object)).astype(np.int32)
+        codes[codes < 0] = UNSEEN_CODE
+        return codes
     
+    @instrument()
     def transform(self, df):
-        for cat_name in self.encoders.keys():            
-            df[cat_name] = self.encoders[cat_name].transform(df[cat_name].values)
+        for cat_name in self.vocabs.keys():
+            df[cat_name] = self.encode(cat_name, df[cat_name].values)
             
         return df
 
 
-def reduce_mem_usage(df, verbose=True):
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    start_mem = df.memory_usage().sum() / 1024**2    
-    for col in df.columns:
-        col_type = df[col].dtypes
-        if col_type in numerics:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if str(col_type)[:3] == 'int':
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)  
-            else:
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)    
-    end_mem = df.memory_usage().sum() / 1024**2
+def _round_trip_ok(values, dtype, rtol, atol):
+    """
+    Whether all values survive the cast to dtype within |x - cast(x)| <= atol + rtol * |x|.
+    NaN must stay NaN and inf must stay the same inf.
+    """
+    with np.errstate(over='ignore', invalid='ignore'):
+        cast = values.astype(dtype).astype(values.dtype)
+        err = np.abs(cast - values)
+        ok = (err <= atol + rtol * np.abs(values)) | (cast == values) | (np.isnan(values) & np.isnan(cast))
+    return bool(ok.all())
+
+def reduce_mem_usage(df, rtol=REDUCE_MEM_RTOL, atol=0., category_ratio=0.5, columns=None, verbose=True):
+    """
+    Downcast the columns of df in place.
+    
+    Integers are cast to the smallest integer type holding [min, max].
+    Floats are cast to float16 or float32 only if every value round-trips
+    within the tolerance, so coordinates and distances keep their precision.
+    Object (and string) columns with few unique values are cast to category.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+    rtol, atol: float
+        tolerance of the round-trip error of floats.
+        rtol=1e-6 accepts float32 but not float16 for general values.
+    category_ratio: float or None
+        object columns whose (the number of unique values) / (the number of rows)
+        is at most category_ratio are cast to category. None for no conversion.
+    columns: None or list of str
+        columns to reduce. None for all columns.
+    verbose: bool
+        print the total and per-column savings
+    
+    Returns
+    -------
+    df: pd.DataFrame
+        the same object as the input df
+    """
+    columns = df.columns if columns is None else columns
+    start_mem = df.memory_usage(deep=True).sum() / 1024**2
+    # [min, max] of all the integer columns in one pass
+    int_cols = [col for col in columns 
+                if isinstance(df[col].dtype, np.dtype) and pd.api.types.is_integer_dtype(df[col].dtype)]
+    ranges = df[int_cols].agg(['min', 'max']) if len(int_cols) > 0 and len(df) > 0 else None
+    report = []
+    for col in columns:
+        series = df[col]
+        col_type = series.dtype
+        new_type = None
+        if pd.api.types.is_bool_dtype(col_type) or isinstance(col_type, pd.CategoricalDtype):
+            continue
+        elif pd.api.types.is_integer_dtype(col_type) and isinstance(col_type, np.dtype):
+            if ranges is None:
+                continue
+            c_min, c_max = ranges.at['min', col], ranges.at['max', col]
+            for dtype in [np.int8, np.int16, np.int32, np.int64]:
+                if np.iinfo(dtype).min <= c_min and c_max <= np.iinfo(dtype).max:
+                    new_type = np.dtype(dtype)
+                    break
+        elif pd.api.types.is_float_dtype(col_type) and isinstance(col_type, np.dtype):
+            values = series.values
+            for dtype in [np.float16, np.float32]:
+                if np.dtype(dtype).itemsize >= col_type.itemsize:
+                    break
+                if _round_trip_ok(values, dtype, rtol, atol):
+                    new_type = np.dtype(dtype)
+                    break
+        elif category_ratio is not None and not pd.api.types.is_numeric_dtype(col_type):
+            if series.nunique(dropna=False) <= category_ratio * len(series):
+                new_type = 'category'
+        
+        if new_type is None or new_type == col_type:
+            continue
+        before = series.memory_usage(index=False, deep=True)
+        df[col] = series.astype(new_type)
+        after = df[col].memory_usage(index=False, deep=True)
+        report.append((col, str(col_type), str(new_type), before / 1024**2, after / 1024**2))
+    end_mem = df.memory_usage(deep=True).sum() / 1024**2
     if verbose: 
-        print('Mem. usage decreased to {:5.2f} Mb ({:.1f}% reduction)'.format(end_mem, 100 * (start_mem - end_mem) / start_mem))
+        df_report = pd.DataFrame(report, columns=['column', 'from', 'to', 'before_mb', 'after_mb'])
+        df_report['saved_mb'] = df_report['before_mb'] - df_report['after_mb']
+        print(df_report.sort_values('saved_mb', ascending=False).to_string(index=False))
+        print('Mem. usage decreased to {:5.2f} Mb ({:.1f}% reduction)'.format(end_mem, 100 * (start_mem - end_mem) / max(start_mem, 1e-12)))
     
     return df
 
-def reduce_mem_usage_v2(df, verbose=True):
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    start_mem = df.memory_usage().sum() / 1024**2
-    for col in df.columns:
-        col_type = df[col].dtypes
-        if col_type in numerics:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if str(col_type)[:3] == 'int':
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)
-            else:
-                c_prec = df[col].apply(lambda x: np.finfo(x).precision).max()
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max and c_prec == np.finfo(np.float16).precision:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max and c_prec == np.finfo(np.float32).precision:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)
-    end_mem = df.memory_usage().sum() / 1024**2
-    if verbose: print('Mem. usage decreased to {:5.2f} Mb ({:.1f}% reduction)'.format(end_mem, 100 * (start_mem - end_mem) / start_mem))
-    return df
+"""## parallel
+All features are computed per molecule, so the rows are split into molecule-aligned shards.
+"""
+
+def split_molecules(df, n_shards):
+    """
+    Split df into contiguous shards without dividing a molecule.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name'
+    n_shards: int
+    
+    Returns
+    -------
+    shards: list of pd.DataFrame
+    order: None or np.ndarray
+        If rows of a molecule are not contiguous in df, df is sorted by molecule
+        before splitting and `order` is the permutation used.
+    """
+    codes, _ = pd.factorize(df['molecule_name'])
+    order = None
+    if (codes[1:] < codes[:-1]).any():
+        order = np.argsort(codes, kind='stable')
+        df = df.iloc[order]
+        codes = codes[order]
+    
+    mol_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    targets = np.arange(1, n_shards) * len(df) // n_shards
+    bounds = mol_starts[np.minimum(np.searchsorted(mol_starts, targets), len(mol_starts) - 1)]
+    bounds = np.unique(np.r_[0, bounds, len(df)])
+    shards = [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    return shards, order
+
+def run_sharded(func, df, n_jobs=N_JOBS, **kwargs):
+    """
+    Run `func(shard, **kwargs)` on molecule-aligned shards of df in a process pool
+    and concatenate the results in the original row order.
+    
+    numpy arrays in kwargs (e.g. coordinates of StructureIndex) are memory-mapped
+    by joblib and shared between the processes instead of being copied.
+    
+    Parameters
+    ----------
+    func: callable
+        func must return a dataframe with the same rows as its input shard.
+    df: pd.DataFrame
+        df must have 'molecule_name'
+    n_jobs: int
+        the number of processes. If 1, func is applied to whole df without a pool.
+    """
+    if n_jobs == 1:
+        return func(df, **kwargs)
+    
+    n_shards = joblib.cpu_count() if n_jobs < 0 else n_jobs
+    shards, order = split_molecules(df, n_shards)
+    get_logger().info('run %s on %d shards' % (func.__name__, len(shards)))
+    
+    results = joblib.Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        joblib.delayed(func)(shard, **kwargs) for shard in shards)
+    ret = pd.concat(results, axis=0)
+    if order is not None:
+        ret = ret.iloc[np.argsort(order)]
+    return ret
 
 """## Preprocess"""
 
+class StructureIndex:
+    """
+    structures.csv as flat arrays for gathering atoms by integer indexing.
+    
+    The atom `i` of the molecule `m` is at `atom_offset[m] + i` of `xyz` and `atom`.
+    The last row of `xyz` and `atom` is NaN for missing atoms (e.g. index -1).
+    """
+    def __init__(self, strct):
+        """
+        Parameters
+        ----------
+        strct: pd.DataFrame
+            dataframe of structures.csv
+        """
+        strct = strct.sort_values(['molecule_name', 'atom_index'])
+        mol_codes, mol_names = pd.factorize(strct['molecule_name'], sort=True)
+        self.mol_names = pd.Index(mol_names)
+        self.n_atoms = np.bincount(mol_codes)
+        self.atom_offset = np.zeros(len(mol_names) + 1, dtype=np.int64)
+        self.atom_offset[1:] = np.cumsum(self.n_atoms)
+        assert (strct['atom_index'].values == np.arange(len(strct)) - self.atom_offset[mol_codes]).all(), \
+            'atom_index must be 0, 1, 2, ... in each molecule.'
+        
+        self.xyz = np.empty((len(strct) + 1, 3), dtype=np.float64)
+        self.xyz[:-1] = strct[['x', 'y', 'z']].values
+        self.xyz[-1] = np.nan
+        self.atom = np.append(strct['atom'].values.astype(object), np.nan)
+    
+    def pos(self, mole_name, atom_idx):
+        """
+        Parameters
+        ----------
+        mole_name: array-like object, shape [n_samples]
+        atom_idx: array-like object, shape [n_samples]
+        
+        Returns
+        -------
+        pos: np.ndarray, shape [n_samples]
+            row of `xyz` and `atom`. -1 (NaN row) if the atom does not exist.
+        """
+        mol_codes = self.mol_names.get_indexer(np.asarray(mole_name))
+        atom_idx = np.asarray(atom_idx)
+        is_valid = (mol_codes >= 0) & (atom_idx >= 0) & (atom_idx < self.n_atoms[mol_codes])
+        return np.where(is_valid, self.atom_offset[mol_codes] + atom_idx, -1)
+
+@instrument(keys=['atom_idx'])
 def map_atom_info(df, strct, atom_idx):
-    df = pd.merge(df, strct, how = 'left',
-                  left_on  = ['molecule_name', f'atom_index_{atom_idx}'],
-                  right_on = ['molecule_name',  'atom_index'])
-    
-    df = df.drop('atom_index', axis=1)
-    df = df.rename(columns={'atom': f'atom_{atom_idx}',
-                            'x': f'x_{atom_idx}',
-                            'y': f'y_{atom_idx}',
-                            'z': f'z_{atom_idx}'})
+    """
+    Add `atom_{atom_idx}`, `x_{atom_idx}`, `y_{atom_idx}`, `z_{atom_idx}` to df in place.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_{atom_idx}'
+    strct: StructureIndex
+    atom_idx: int
+    """
+    pos = strct.pos(df['molecule_name'].values, df[f'atom_index_{atom_idx}'].values)
+    df[f'atom_{atom_idx}'] = strct.atom[pos]
+    df[f'x_{atom_idx}'] = strct.xyz[pos, 0]
+    df[f'y_{atom_idx}'] = strct.xyz[pos, 1]
+    df[f'z_{atom_idx}'] = strct.xyz[pos, 2]
     return df
 
+@instrument()
 def calc_dist(df):
     p_0 = df[['x_0', 'y_0', 'z_0']].values
     p_1 = df[['x_1', 'y_1', 'z_1']].values
@@ -193,94 +684,315 @@ def calc_dist(df):
 
     return df
 
-def divide_type(df):    
-    df['type_0'] = df['type'].apply(lambda x: x[0])
-    df['type_1'] = df['type'].apply(lambda x: x[1:])
+def molecule_atoms(strct, mol_codes):
+    """
+    Atoms of molecules padded to the same number of atoms.
+    
+    Parameters
+    ----------
+    strct: StructureIndex
+    mol_codes: np.ndarray, shape [n_molecules]
+        position of the molecules in `strct.mol_names`
+    
+    Returns
+    -------
+    pos: np.ndarray, shape [n_molecules, max_atoms]
+        row of `strct.xyz` and `strct.atom`. -1 (NaN row) for padding.
+    xyz: np.ndarray, shape [n_molecules, max_atoms, 3]
+    atom: np.ndarray, shape [n_molecules, max_atoms]
+    """
+    n_atoms = strct.n_atoms[mol_codes]
+    slot = np.arange(n_atoms.max() if len(n_atoms) else 0)
+    pos = np.where(slot < n_atoms[:, None], strct.atom_offset[mol_codes][:, None] + slot, -1)
+    return pos, strct.xyz[pos], strct.atom[pos]
+
+def atom_geometry(xyz, atom, k=GEO_KNN, radii=GEO_RADII, elements=GEO_ELEMENTS):
+    """
+    Per-atom features from the distance matrices of molecules.
+    
+    Parameters
+    ----------
+    xyz: np.ndarray, shape [n_molecules, max_atoms, 3]
+        NaN for padding (see molecule_atoms())
+    atom: np.ndarray, shape [n_molecules, max_atoms]
+    k: int
+        the number of the nearest atoms
+    radii: list of float
+        count the atoms within each radius
+    elements: list of str
+        distance to the nearest atom of each element
+    
+    Returns
+    -------
+    feats: dict
+        {name: np.ndarray of shape [n_molecules, max_atoms]} (float32)
+    """
+    n_mol, n_slot = atom.shape
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b without the [n_molecules, max_atoms, max_atoms, 3] difference
+    sq = (xyz ** 2).sum(axis=2)
+    dist = sq[:, :, None] + sq[:, None, :] - 2 * np.einsum('mid,mjd->mij', xyz, xyz)
+    dist = np.sqrt(np.maximum(dist, 0)).astype(np.float32)
+    # padding and the atom itself are not neighbors
+    dist[np.isnan(dist)] = np.inf
+    dist[:, np.arange(n_slot), np.arange(n_slot)] = np.inf
+    
+    feats = {}
+    knn = np.full((n_mol, n_slot, k), np.inf, dtype=np.float32)
+    knn[:, :, :min(k, n_slot)] = np.sort(dist, axis=2)[:, :, :k]
+    for j in range(k):
+        feats[f'knn_dist_{j + 1}'] = knn[:, :, j]
+    for r in radii:
+        feats['coord_r' + f'{r:g}'.replace('.', 'p')] = (dist < r).sum(axis=2).astype(np.float32)
+    for e in elements:
+        feats[f'nearest_{e}_dist'] = np.where((atom == e)[:, None, :], dist, np.inf).min(axis=2, initial=np.inf)
+    
+    is_pad = np.isnan(xyz[:, :, 0])
+    for val in feats.values():
+        val[np.isinf(val) | is_pad] = np.nan
+    return feats
+
+@instrument()
+def add_geometry_features(df, strct, batch_size=GEO_BATCH_SIZE):
+    """
+    Add atom_geometry() of atom_index_0 and atom_index_1 (e.g. `knn_dist_1_0`) to df in place.
+    
+    Distance matrices are built for batches of `batch_size` molecules of df
+    and the features are gathered by (molecule, atom index).
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_0', 'atom_index_1'
+    strct: StructureIndex
+    batch_size: int
+    """
+    mol_codes = strct.mol_names.get_indexer(df['molecule_name'].values)
+    atom_idx = [df['atom_index_0'].values, df['atom_index_1'].values]
+    mols, row_mol = np.unique(mol_codes, return_inverse=True)
+    row_mol = row_mol.ravel()
+    # rows of missing molecules (-1) are left NaN
+    n_missing = int((mols < 0).sum())
+    
+    out = {}
+    for start in range(n_missing, len(mols), batch_size):
+        stop = min(start + batch_size, len(mols))
+        pos, xyz, atom = molecule_atoms(strct, mols[start:stop])
+        feats = atom_geometry(xyz, atom)
+        rows = np.where((row_mol >= start) & (row_mol < stop))[0]
+        local = row_mol[rows] - start
+        for i, idx in enumerate(atom_idx):
+            idx = idx[rows]
+            is_valid = (idx >= 0) & (idx < pos.shape[1])
+            idx = np.where(is_valid, idx, 0)
+            for name, val in feats.items():
+                col = out.setdefault(f'{name}_{i}', np.full(len(df), np.nan, dtype=np.float32))
+                col[rows] = np.where(is_valid, val[local, idx], np.nan)
+    for col, val in out.items():
+        df[col] = val
     return df
 
+def relabel(codes, labels):
+    """
+    pd.Categorical of `labels[codes]` built from the few labels instead of every row.
+    
+    Parameters
+    ----------
+    codes: np.ndarray, shape [n_samples]
+        -1 for NaN
+    labels: array-like object, shape [n_labels]
+        label of each code. labels can be duplicated.
+    """
+    categories, label_codes = np.unique(np.asarray(labels, dtype=object), return_inverse=True)
+    return pd.Categorical.from_codes(np.append(label_codes.ravel(), -1)[codes], categories)
+
+def divide_type(df):
+    # split the few distinct types instead of every row
+    codes, uniques = pd.factorize(df['type'])
+    df['type_0'] = relabel(codes, [t[0] for t in uniques])
+    df['type_1'] = relabel(codes, [t[1:] for t in uniques])
+    return df
+
+# (output column, group keys, column, stat, derived ops)
+# derived op 'diff' is `stat - column` and 'div' is `stat / column`.
+FE_AGGS = [
+    ('molecule_couples', ['molecule_name'], 'id', 'count', []),
+    ('molecule_dist_mean', ['molecule_name'], 'dist', 'mean', []),
+    ('molecule_dist_min', ['molecule_name'], 'dist', 'min', []),
+    ('molecule_dist_max', ['molecule_name'], 'dist', 'max', []),
+    ('atom_0_couples_count', ['molecule_name', 'atom_index_0'], 'id', 'count', []),
+    ('atom_1_couples_count', ['molecule_name', 'atom_index_1'], 'id', 'count', []),
+    ('molecule_atom_index_0_x_1_std', ['molecule_name', 'atom_index_0'], 'x_1', 'std', []),
+    ('molecule_atom_index_0_y_1_mean', ['molecule_name', 'atom_index_0'], 'y_1', 'mean', ['diff', 'div']),
+    ('molecule_atom_index_0_y_1_max', ['molecule_name', 'atom_index_0'], 'y_1', 'max', ['diff']),
+    ('molecule_atom_index_0_y_1_std', ['molecule_name', 'atom_index_0'], 'y_1', 'std', []),
+    ('molecule_atom_index_0_z_1_std', ['molecule_name', 'atom_index_0'], 'z_1', 'std', []),
+    ('molecule_atom_index_0_dist_mean', ['molecule_name', 'atom_index_0'], 'dist', 'mean', ['diff', 'div']),
+    ('molecule_atom_index_0_dist_max', ['molecule_name', 'atom_index_0'], 'dist', 'max', ['diff', 'div']),
+    ('molecule_atom_index_0_dist_min', ['molecule_name', 'atom_index_0'], 'dist', 'min', ['diff', 'div']),
+    ('molecule_atom_index_0_dist_std', ['molecule_name', 'atom_index_0'], 'dist', 'std', ['diff', 'div']),
+    ('molecule_atom_index_1_dist_mean', ['molecule_name', 'atom_index_1'], 'dist', 'mean', ['diff', 'div']),
+    ('molecule_atom_index_1_dist_max', ['molecule_name', 'atom_index_1'], 'dist', 'max', ['diff', 'div']),
+    ('molecule_atom_index_1_dist_min', ['molecule_name', 'atom_index_1'], 'dist', 'min', ['diff', 'div']),
+    ('molecule_atom_index_1_dist_std', ['molecule_name', 'atom_index_1'], 'dist', 'std', ['diff', 'div']),
+    ('molecule_atom_1_dist_mean', ['molecule_name', 'atom_1'], 'dist', 'mean', []),
+    ('molecule_atom_1_dist_min', ['molecule_name', 'atom_1'], 'dist', 'min', ['diff', 'div']),
+    ('molecule_atom_1_dist_std', ['molecule_name', 'atom_1'], 'dist', 'std', ['diff']),
+    ('molecule_type_0_dist_std', ['molecule_name', 'type_0'], 'dist', 'std', ['diff']),
+    ('molecule_type_dist_mean', ['molecule_name', 'type'], 'dist', 'mean', ['diff', 'div']),
+    ('molecule_type_dist_max', ['molecule_name', 'type'], 'dist', 'max', []),
+    ('molecule_type_dist_min', ['molecule_name', 'type'], 'dist', 'min', []),
+    ('molecule_type_dist_std', ['molecule_name', 'type'], 'dist', 'std', ['diff']),
+]
+
+def group_transform(df, keys, aggs, key_codes=None):
+    """
+    Same as df.groupby(keys)[column].transform(stat) for all `aggs`,
+    but the rows are grouped and sorted only once.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+    keys: list of str
+    aggs: list of tuple
+        (column, stat). stat is 'count', 'mean', 'min', 'max' or 'std'
+    key_codes: None or dict
+        cache of pd.factorize() of each key column shared between calls
+    
+    Returns
+    -------
+    ret: dict
+        {(column, stat): np.ndarray of shape [n_samples]}
+    """
+    if key_codes is None:
+        key_codes = {}
+    codes = np.zeros(len(df), dtype=np.int64)
+    is_null_key = np.zeros(len(df), dtype=bool)
+    for key in keys:
+        if key not in key_codes:
+            key_codes[key] = pd.factorize(df[key], sort=True)
+        k_codes, uniques = key_codes[key]
+        codes = codes * len(uniques) + k_codes
+        is_null_key |= (k_codes < 0)
+    # rows with NaN key are a group whose stats are NaN like pandas
+    codes[is_null_key] = -1
+    
+    # train.csv and test.csv are already sorted by molecule_name, atom_index_0
+    if (codes[1:] >= codes[:-1]).all():
+        order = None
+        sorted_codes = codes
+    else:
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+    is_start = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+    starts = np.flatnonzero(is_start)
+    seg_sorted = np.cumsum(is_start) - 1
+    if order is None:
+        seg = seg_sorted
+    else:
+        seg = np.empty_like(seg_sorted)
+        seg[order] = seg_sorted
+    is_null_seg = (sorted_codes[starts] < 0)
+    
+    ret = {}
+    for col in dict.fromkeys(col for col, _ in aggs):
+        stats = [stat for c, stat in aggs if c == col]
+        x = df[col].values.astype(np.float64, copy=False)
+        if order is not None:
+            x = x[order]
+        is_valid = ~np.isnan(x)
+        has_null = not is_valid.all()
+        if has_null:
+            count = np.add.reduceat(is_valid, starts, dtype=np.int64)
+            x0 = np.where(is_valid, x, 0)
+        else:
+            count = np.diff(np.r_[starts, len(x)])
+            x0 = x
+        
+        res = {'count': count}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if 'mean' in stats or 'std' in stats:
+                res['mean'] = np.add.reduceat(x0, starts) / count
+            if 'std' in stats:
+                dev = x0 - res['mean'][seg_sorted]
+                if has_null:
+                    dev[~is_valid] = 0
+                res['std'] = np.sqrt(np.add.reduceat(dev * dev, starts) / (count - 1))
+        if 'min' in stats:
+            res['min'] = np.fmin.reduceat(x, starts)
+        if 'max' in stats:
+            res['max'] = np.fmax.reduceat(x, starts)
+        
+        # broadcast back to rows
+        for stat in stats:
+            if stat == 'count':
+                val = np.where(is_null_seg, np.nan, res[stat]) if is_null_seg.any() else res[stat]
+            else:
+                val = np.where(is_null_seg | (count == 0), np.nan, res[stat])
+            ret[(col, stat)] = val[seg]
+    return ret
+
+@instrument()
 def feature_engineering(df):
     print("Starting Feature Engineering...")
-    g = df.groupby('molecule_name')
-    g1 = df.groupby(['molecule_name', 'atom_index_0'])
-    g2 = df.groupby(['molecule_name', 'atom_index_1'])
-    g3 = df.groupby(['molecule_name', 'atom_1'])
-    g4 = df.groupby(['molecule_name', 'type_0'])
-    g5 = df.groupby(['molecule_name', 'type'])
-    
-    df['type_0'] = df['type'].apply(lambda x: x[0])
-    df['molecule_couples'] = g['id'].transform('count')
-    df['molecule_dist_mean'] = g['dist'].transform('mean')
-    df['molecule_dist_min'] = g['dist'].transform('min')
-    df['molecule_dist_max'] = g['dist'].transform('max')
-    df['atom_0_couples_count'] = g1['id'].transform('count')
-    df['atom_1_couples_count'] = g2['id'].transform('count')
-    df[f'molecule_atom_index_0_x_1_std'] = g1['x_1'].transform('std')
-    df[f'molecule_atom_index_0_y_1_mean'] = g1['y_1'].transform('mean')
-    df[f'molecule_atom_index_0_y_1_mean_diff'] = df[f'molecule_atom_index_0_y_1_mean'] - df['y_1']
-    df[f'molecule_atom_index_0_y_1_mean_div'] = df[f'molecule_atom_index_0_y_1_mean'] / df['y_1']
-    df[f'molecule_atom_index_0_y_1_max'] = g1['y_1'].transform('max')
-    df[f'molecule_atom_index_0_y_1_max_diff'] = df[f'molecule_atom_index_0_y_1_max'] - df['y_1']
-    df[f'molecule_atom_index_0_y_1_std'] = g1['y_1'].transform('std')
-    df[f'molecule_atom_index_0_z_1_std'] = g1['z_1'].transform('std')
-    df[f'molecule_atom_index_0_dist_mean'] = g1['dist'].transform('mean')
-    df[f'molecule_atom_index_0_dist_mean_diff'] = df[f'molecule_atom_index_0_dist_mean'] - df['dist']
-    df[f'molecule_atom_index_0_dist_mean_div'] = df[f'molecule_atom_index_0_dist_mean'] / df['dist']
-    df[f'molecule_atom_index_0_dist_max'] = g1['dist'].transform('max')
-    df[f'molecule_atom_index_0_dist_max_diff'] = df[f'molecule_atom_index_0_dist_max'] - df['dist']
-    df[f'molecule_atom_index_0_dist_max_div'] = df[f'molecule_atom_index_0_dist_max'] / df['dist']
-    df[f'molecule_atom_index_0_dist_min'] = g1['dist'].transform('min')
-    df[f'molecule_atom_index_0_dist_min_diff'] = df[f'molecule_atom_index_0_dist_min'] - df['dist']
-    df[f'molecule_atom_index_0_dist_min_div'] = df[f'molecule_atom_index_0_dist_min'] / df['dist']
-    df[f'molecule_atom_index_0_dist_std'] = g1['dist'].transform('std')
-    df[f'molecule_atom_index_0_dist_std_diff'] = df[f'molecule_atom_index_0_dist_std'] - df['dist']
-    df[f'molecule_atom_index_0_dist_std_div'] = df[f'molecule_atom_index_0_dist_std'] / df['dist']
-    df[f'molecule_atom_index_1_dist_mean'] = g2['dist'].transform('mean')
-    df[f'molecule_atom_index_1_dist_mean_diff'] = df[f'molecule_atom_index_1_dist_mean'] - df['dist']
-    df[f'molecule_atom_index_1_dist_mean_div'] = df[f'molecule_atom_index_1_dist_mean'] / df['dist']
-    df[f'molecule_atom_index_1_dist_max'] = g2['dist'].transform('max')
-    df[f'molecule_atom_index_1_dist_max_diff'] = df[f'molecule_atom_index_1_dist_max'] - df['dist']
-    df[f'molecule_atom_index_1_dist_max_div'] = df[f'molecule_atom_index_1_dist_max'] / df['dist']
-    df[f'molecule_atom_index_1_dist_min'] = g2['dist'].transform('min')
-    df[f'molecule_atom_index_1_dist_min_diff'] = df[f'molecule_atom_index_1_dist_min'] - df['dist']
-    df[f'molecule_atom_index_1_dist_min_div'] = df[f'molecule_atom_index_1_dist_min'] / df['dist']
-    df[f'molecule_atom_index_1_dist_std'] = g2['dist'].transform('std')
-    df[f'molecule_atom_index_1_dist_std_diff'] = df[f'molecule_atom_index_1_dist_std'] - df['dist']
-    df[f'molecule_atom_index_1_dist_std_div'] = df[f'molecule_atom_index_1_dist_std'] / df['dist']
-    df[f'molecule_atom_1_dist_mean'] = g3['dist'].transform('mean')
-    df[f'molecule_atom_1_dist_min'] = g3['dist'].transform('min')
-    df[f'molecule_atom_1_dist_min_diff'] = df[f'molecule_atom_1_dist_min'] - df['dist']
-    df[f'molecule_atom_1_dist_min_div'] = df[f'molecule_atom_1_dist_min'] / df['dist']
-    df[f'molecule_atom_1_dist_std'] = g3['dist'].transform('std')
-    df[f'molecule_atom_1_dist_std_diff'] = df[f'molecule_atom_1_dist_std'] - df['dist']
-    df[f'molecule_type_0_dist_std'] = g4['dist'].transform('std')
-    df[f'molecule_type_0_dist_std_diff'] = df[f'molecule_type_0_dist_std'] - df['dist']
-    df[f'molecule_type_dist_mean'] = g5['dist'].transform('mean')
-    df[f'molecule_type_dist_mean_diff'] = df[f'molecule_type_dist_mean'] - df['dist']
-    df[f'molecule_type_dist_mean_div'] = df[f'molecule_type_dist_mean'] / df['dist']
-    df[f'molecule_type_dist_max'] = g5['dist'].transform('max')
-    df[f'molecule_type_dist_min'] = g5['dist'].transform('min')
-    df[f'molecule_type_dist_std'] = g5['dist'].transform('std')
-    df[f'molecule_type_dist_std_diff'] = df[f'molecule_type_dist_std'] - df['dist']
+    # compute all stats of the same group keys together
+    aggs_by_keys = {}
+    for _, keys, col, stat, _ in FE_AGGS:
+        aggs_by_keys.setdefault(tuple(keys), []).append((col, stat))
+    key_codes = {}
+    stats = {keys: group_transform(df, list(keys), aggs, key_codes) for keys, aggs in aggs_by_keys.items()}
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, keys, col, stat, ops in FE_AGGS:
+            df[name] = stats[tuple(keys)][(col, stat)]
+            for op in ops:
+                if op == 'diff':
+                    df[f'{name}_diff'] = df[name].values - df[col].values
+                elif op == 'div':
+                    df[f'{name}_div'] = df[name].values / df[col].values
 
     # TODO: back
     # df = reduce_mem_usage(df)
     
     return df
 
-def add_1j(df):
+def load_1j_table():
     get_logger().info('load df_1j')
     
     df_1j = joblib.load(PREPROCESS + 'df_1j.pkl')
+    if INT_MOLECULE_ID:
+        df_1j = encode_molecule_name(df_1j)
+    
+    return df_1j
+
+@instrument()
+def add_1j(df, df_1j=None):
+    """
+    df_1j: None or pd.DataFrame
+        output of load_1j_table(). If None, it is loaded.
+    """
+    if df_1j is None:
+        df_1j = load_1j_table()
     
     df = df.merge(df_1j, on=['molecule_name', 'atom_index_0', 'atom_index_1'], how='left') 
     
+    # replace missing vlaue to 'nan' for Encoder
+    df['neighbor_atoms'] = fillna_label(df['neighbor_atoms'], 'nan')
+    
     return df
 
 
-def add_2j_center_atom(df):    
+def fillna_label(s, label):
+    """fillna() of an object or categorical column with a label"""
+    if isinstance(s.dtype, pd.CategoricalDtype) and label not in s.cat.categories:
+        s = s.cat.add_categories(label)
+    return s.fillna(label)
+
+def load_2j_table():
     get_logger().info('load df_2jsim')
     
     df_2j = joblib.load(PREPROCESS + 'df_2jsim.pkl')  
+    if INT_MOLECULE_ID:
+        df_2j = encode_molecule_name(df_2j)
     
     # atom weight
     df_2j['2j_atom_center_weight'] = df_2j['2j_atom_center'].replace(atom_weight)
@@ -288,10 +1000,21 @@ def add_2j_center_atom(df):
     # sum of norm
     df_2j['2j_sum_norm_vec'] = df_2j['2j_norm_vec_02'] + df_2j['2j_norm_vec_12']
     
+    return df_2j
+
+@instrument()
+def add_2j_center_atom(df, df_2j=None):
+    """
+    df_2j: None or pd.DataFrame
+        output of load_2j_table(). If None, it is loaded.
+    """
+    if df_2j is None:
+        df_2j = load_2j_table()
+    
     df = df.merge(df_2j, on=['molecule_name', 'atom_index_0', 'atom_index_1'], how='left')    
     
-    # replace missing vlaue to 'nan' for LabelEncoder
-    df.loc[df['2j_atom_center'].isnull(), '2j_atom_center'] = 'nan'
+    # replace missing vlaue to 'nan' for Encoder
+    df['2j_atom_center'] = fillna_label(df['2j_atom_center'], 'nan')
     
     return df
 
@@ -309,10 +1032,12 @@ def str_sort(s):
     else:
         return s
 
-def add_3j_center_atom(df):    
+def load_3j_table():
     get_logger().info('load df_3jsim')
     
     df_3j = joblib.load(PREPROCESS + 'df_3jsim.pkl')
+    if INT_MOLECULE_ID:
+        df_3j = encode_molecule_name(df_3j)
     
     # atom weight
     s_atom_w0 = df_3j['3j_atom_center_0'].replace(atom_weight)
@@ -321,38 +1046,296 @@ def add_3j_center_atom(df):
 
     # concatenate atom string 'C' + 'C' - > 'CC'
     tmp = df_3j['3j_atom_center_0'] + df_3j['3j_atom_center_1']
-    df_3j['3j_atom_center'] = tmp.transform(str_sort)    
+    # str_sort of the few distinct pairs instead of every row
+    codes, uniques = pd.factorize(tmp)
+    df_3j['3j_atom_center'] = relabel(codes, [str_sort(u) for u in uniques])
     df_3j.drop(['3j_atom_center_0', '3j_atom_center_1'], axis=1, inplace=True)
     
     # sum norm_vec
     df_3j['3j_sum_norm_vec'] = df_3j['3j_norm_vec_02'] + df_3j['3j_norm_vec_13'] + df_3j['3j_norm_vec_23']
     
+    return df_3j
+
+@instrument()
+def add_3j_center_atom(df, df_3j=None):
+    """
+    df_3j: None or pd.DataFrame
+        output of load_3j_table(). If None, it is loaded.
+    """
+    if df_3j is None:
+        df_3j = load_3j_table()
+    
     df = df.merge(df_3j, on=['molecule_name', 'atom_index_0', 'atom_index_1'], how='left')    
     
-    # replace missing vlaue to 'nan' for LabelEncoder
-    df.loc[df['3j_atom_center'].isnull(), '3j_atom_center'] = 'nan'    
+    # replace missing vlaue to 'nan' for Encoder
+    df['3j_atom_center'] = fillna_label(df['3j_atom_center'], 'nan')
     
     return df
 
+# columns that are not features
+DROP_COLS = ['id', 'molecule_name', 'atom_index_0', 'atom_index_1',
+             'x_0', 'y_0', 'z_0', 'x_1', 'y_1', 'z_1', # 'dist_x', 'dist_y', 'dist_z',
+             'atom_0', 'atom_1'
+            ]
+
 def drop_col(df_org):
     df = df_org.copy()
-    to_drop = ['id', 'molecule_name', 'atom_index_0', 'atom_index_1',
-               'x_0', 'y_0', 'z_0', 'x_1', 'y_1', 'z_1', # 'dist_x', 'dist_y', 'dist_z',
-               'atom_0', 'atom_1'
-              ]
-    df = df.drop(to_drop, axis=1)
+    df = df.drop(DROP_COLS, axis=1)
     
     return df
 
+def group_codes(types):
+    """
+    Integer codes of groups for GroupMAE.
+    Non-negative integers are used as they are and others are factorized.
+    """
+    types = np.asarray(types)
+    if types.dtype.kind in 'iu' and (len(types) == 0 or types.min() >= 0):
+        return types
+    codes, _ = pd.factorize(types)
+    return codes
+
+class GroupMAE:
+    """
+    Accumulator of sum of absolute errors and counts of each group.
+    It can be updated batch by batch and gives group_mean_log_mae() of all the batches.
+    
+    The group codes must be the same across batches (e.g. codes of Encoder).
+    """
+    def __init__(self, n_groups=0):
+        self.abs_sum = np.zeros(n_groups)
+        self.count = np.zeros(n_groups, dtype=np.int64)
+    
+    def update(self, y_true, y_pred, groups):
+        """
+        Parameters
+        ----------
+        y_true, y_pred: array-like object, shape [n_samples]
+        groups: np.ndarray of non-negative int, shape [n_samples]
+        """
+        groups = np.asarray(groups)
+        if len(groups) == 0:
+            return self
+        n_groups = max(groups.max() + 1, len(self.count))
+        abs_err = np.abs(np.asarray(y_true, dtype=np.float64) - np.asarray(y_pred, dtype=np.float64))
+        abs_sum = np.bincount(groups, weights=abs_err, minlength=n_groups)
+        count = np.bincount(groups, minlength=n_groups)
+        abs_sum[:len(self.abs_sum)] += self.abs_sum
+        count[:len(self.count)] += self.count
+        self.abs_sum, self.count = abs_sum, count
+        return self
+    
+    def maes(self):
+        """MAE of the groups which have samples"""
+        has = self.count > 0
+        return self.abs_sum[has] / self.count[has]
+    
+    def score(self, floor=1e-9):
+        return np.log(np.maximum(self.maes(), floor)).mean()
+
 def group_mean_log_mae(y_true, y_pred, types, floor=1e-9):
     """
     Fast metric computation for this competition: https://www.kaggle.com/c/champs-scalar-coupling
     Code is from this kernel: https://www.kaggle.com/uberkinder/efficient-metric
     """
-    maes = (y_true-y_pred).abs().groupby(types).mean()    
-    return np.log(maes.map(lambda x: max(x, floor))).mean()
+    return GroupMAE().update(y_true, y_pred, group_codes(types)).score(floor)
+
+def group_mae_feval(groups_of):
+    """
+    feval of lgb.train() to use group_mean_log_mae as the metric.
+    
+    Parameters
+    ----------
+    groups_of: dict
+        {id(lgb.Dataset): group codes of its rows} for the train and valid sets
+    """
+    def feval(preds, data):
+        score = GroupMAE().update(data.get_label(), preds, groups_of[id(data)]).score()
+        return 'group_log_mae', score, False
+    return feval
+
+def make_group_folds(mol_names, types, n_folds=N_FOLDS, seed=1):
+    """
+    Split rows into folds by molecule, balanced about `type`.
+    
+    Each molecule holds a share of the rows of each type. The molecules are
+    assigned greedily, the largest share first (ties in random order), to the fold
+    whose shares of all types stay the most even, so that every type
+    (also the rare ones, e.g. 1JHN) is spread evenly over the folds.
+    
+    Parameters
+    ----------
+    mol_names: array-like object, shape [n_samples]
+    types: array-like object, shape [n_samples]
+    
+    Returns
+    -------
+    folds: np.ndarray of int8, shape [n_samples]
+        the fold of each row
+    """
+    mol_codes, _ = pd.factorize(np.asarray(mol_names))
+    type_codes, type_names = pd.factorize(np.asarray(types))
+    n_mol = mol_codes.max() + 1
+    n_type = len(type_names)
+    
+    counts = np.bincount(mol_codes * n_type + type_codes, 
+                         minlength=n_mol * n_type).reshape(n_mol, n_type)
+    share = counts / counts.sum(axis=0)
+    rand = np.random.RandomState(seed).permutation(n_mol)
+    # np.lexsort sorts by the last key first
+    order = np.lexsort([rand, -share.max(axis=1)])
+    load = np.zeros((n_folds, n_type))
+    mol_fold = np.empty(n_mol, dtype=np.int8)
+    for m in order:
+        # the fold with the least increase of the sum of squared shares
+        k = np.argmin((share[m] * (2 * load + share[m])).sum(axis=1))
+        mol_fold[m] = k
+        load[k] += share[m]
+    return mol_fold[mol_codes]
+
+def fold_key(mol_names, types):
+    """key of the folds of the rows. It is the same in any process for the same rows, N_FOLDS and make_group_folds."""
+    return (fingerprint(np.asarray(mol_names)) + fingerprint(np.asarray(types)) 
+            + fingerprint(N_FOLDS) + fingerprint(make_group_folds))
+
+def get_folds(mol_names, types, path=FOLD_PATH):
+    """
+    make_group_folds() persisted to `path`.
+    The saved folds are reused while the rows (molecule_name and type) are the same.
+    """
+    key = fold_key(mol_names, types)
+    if os.path.exists(path):
+        saved = np.load(path)
+        if str(saved['key']) == key:
+            get_logger().info('load folds from %s' % path)
+            return saved['folds']
+    
+    folds = make_group_folds(mol_names, types)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, folds=folds, key=key)
+    get_logger().info('saved folds to %s' % path)
+    return folds
+
+def oof_split(_folds):
+    """
+    Parameters
+    ----------
+    _folds: np.ndarray, shape [n_samples]
+        output of get_folds()
+    
+    Returns
+    -------
+    folds: list of (train_idx, valid_idx)
+    """
+    _folds = np.asarray(_folds)
+    return [(np.flatnonzero(_folds != k), np.flatnonzero(_folds == k)) 
+            for k in range(_folds.max() + 1)]
+
+def build_dataset(_X, _y, save=SAVE_LGB_DATASET, reference=None):
+    """
+    Bin _X once into a lgb.Dataset, which folds are taken from by Dataset.subset().
+    
+    Parameters
+    ----------
+    _X: pd.DataFrame, shape [n_samples, n_features]
+    _y: pd.Series, shape [n_samples]
+    save: bool
+        If True, the binned dataset is saved to LGB_DATASET_DIR and loaded
+        instead of binning again when _X, _y and the parameters are the same.
+    reference: None or lgb.Dataset
+        dataset of the same _X (e.g. with another target) whose bins are reused
+    """
+    params, _ = gen_params(_X)
+    if reference is not None:
+        return lgb.Dataset(_X, label=_y, reference=reference, params=params).construct()
+    if save:
+        key = hashlib.sha1(''.join([fingerprint(_X), fingerprint(np.asarray(_y)), 
+                                    fingerprint(params)]).encode()).hexdigest()
+        path = LGB_DATASET_DIR + key + '.bin'
+        if os.path.exists(path):
+            get_logger().info('load binned dataset %s' % path)
+            return lgb.Dataset(path, params=params).construct()
+    
+    dataset = lgb.Dataset(_X, label=_y, params=params).construct()
+    if save:
+        os.makedirs(LGB_DATASET_DIR, exist_ok=True)
+        get_logger().info('save binned dataset %s' % path)
+        dataset.save_binary(path)
+    return dataset
+
+@instrument(keys=['n_fold'])
+def fit_fold(_X, _y, _types, train_idx, valid_idx, n_fold, n_jobs=-1, dataset=None):
+    """
+    Train a model on a fold.
+    _X, _y and _types must have RangeIndex, and train_idx and valid_idx must be sorted.
+    
+    Parameters
+    ----------
+    dataset: None or lgb.Dataset
+        output of build_dataset(_X, _y). If None, it is built.
+    
+    Returns
+    -------
+    model: lgb.Booster
+    valid_score: float
+    y_pred: np.ndarray, shape [len(valid_idx)]
+    """
+    if dataset is None:
+        dataset = build_dataset(_X, _y)
+    
+    # prepare data
+    # subsets share the bins of dataset
+    train_set = dataset.subset(train_idx)
+    valid_set = dataset.subset(valid_idx)
+    y_valid = _y.iloc[valid_idx]
+    print('mean of target. train:{}, valid:{}'.format(_y.iloc[train_idx].mean(), y_valid.mean()))
+
+    # generate model
+    params, num_boost_round = gen_params(_X)
+    params['num_threads'] = n_jobs
+    feval = None
+    if USE_GROUP_MAE_FEVAL:
+        codes = group_codes(_types)
+        feval = group_mae_feval({id(train_set): codes[train_idx], id(valid_set): codes[valid_idx]})
+        params['metric'] = 'None'
+    
+    # train
+    model = lgb.train(params, train_set, num_boost_round=num_boost_round,
+                      valid_sets=[train_set, valid_set],
+                      valid_names=['training', 'valid_1'],
+                      feval=feval,
+                      verbose_eval=100,
+                      early_stopping_rounds=100
+                      )
+    
+    # validate
+    y_pred = model.predict(_X.iloc[valid_idx], num_iteration=model.best_iteration)
+    
+    types_valid = _types.iloc[valid_idx]
+    valid_score = group_mean_log_mae(y_valid, y_pred, types_valid)
+    get_logger().info('fold %d valid %f' % (n_fold+1, valid_score))
+    return model, valid_score, y_pred
+
+def collect_folds(_y, folds, results):
+    """
+    Put results of fit_fold() together in the same way as oof_train().
+    
+    Parameters
+    ----------
+    _y: pd.Series with RangeIndex
+    folds: list of (train_idx, valid_idx)
+    results: list of return values of fit_fold(), in the order of folds
+    """
+    models = [model for model, _, _ in results]
+    df_scores = pd.DataFrame({'valid_score': [score for _, score, _ in results]})
+    df_pred = pd.DataFrame(index=_y.index)
+    for (train_idx, valid_idx), (_, _, y_pred) in zip(folds, results):
+        df_pred.loc[valid_idx, 'proba'] = y_pred
+        df_pred.loc[valid_idx, 'y_true'] = _y.iloc[valid_idx].values
+    get_logger().info('CV score: %f' % df_scores['valid_score'].mean())
+    return models, df_scores, df_pred
 
-def oof_train(X_org, y_org, _types):
+def oof_train(X_org, y_org, _types, _folds):
 # def oof_train(_X, _y, _types):
     """
     Parameters
@@ -361,125 +1344,388 @@ def oof_train(X_org, y_org, _types):
     _y: array-like object, shape [n_samples]
     _types: array-like object, shsape [n_samples]
         array of `type` (e.g. 2JHC, 1JHC, 3JHH, etc.)
+    _folds: np.ndarray, shape [n_samples]
+        fold of each row (output of get_folds())
     """
-    # TODO: divide data to training and validation about molecular
-    
-    models = []
     # TODO: back
     _X = X_org.copy().reset_index(drop=True)
     _y = y_org.copy().reset_index(drop=True)
-    df_scores = pd.DataFrame(columns=['valid_score'])
-    df_pred = pd.DataFrame(index=_X.index).reset_index(drop=True)
-
-    fold = StratifiedKFold(n_splits=N_FOLDS, shuffle=True, random_state=1)
-    for n_fold, (train_idx, valid_idx) in enumerate(fold.split(_X, _types)):
-        # prepare data
-        X_train, y_train = _X.iloc[train_idx], _y.iloc[train_idx]
-        X_valid, y_valid = _X.iloc[valid_idx], _y.iloc[valid_idx]
-        print('mean of target. train:{}, valid:{}'.format(y_train.mean(), y_valid.mean()))
-
-        # generate model
-        model = gen_model(_X)
-        
-        # train
-        model.fit(X_train, y_train, eval_metric='mae',
-                  eval_set=[(X_train, y_train), (X_valid, y_valid)],
-                  verbose=100,
-                  early_stopping_rounds=100
-                  )
-        
-        # validate
-        y_pred = model.predict(X_valid, num_iteration=model.best_iteration_)
-        
-        types_valid = _types.iloc[valid_idx]
-        valid_score = group_mean_log_mae(y_valid, y_pred, types_valid)
-        get_logger().info('fold %d valid %f' % (n_fold+1, valid_score))
-        
-        df_scores = df_scores.append(pd.Series([valid_score], index=['valid_score']), ignore_index=True)
-        df_pred.loc[valid_idx, 'proba'] = y_pred
-        df_pred.loc[valid_idx, 'y_true'] = y_valid
-        models.append(model)
-        
+    _types = _types.reset_index(drop=True)
+
+    folds = oof_split(_folds)
+    dataset = build_dataset(_X, _y)
+    results = []
+    for n_fold, (train_idx, valid_idx) in enumerate(folds):
+        results.append(fit_fold(_X, _y, _types, train_idx, valid_idx, n_fold, dataset=dataset))
         # TODO: back
         # break
-    get_logger().info('CV score: %f' % df_scores.mean()[0])
     
-    return models, df_scores, df_pred
-
-def oof_predict(_models, _X):
-    get_logger().info('Start oof_predict')
-    y_pred = np.zeros(_X.shape[0])
+    return collect_folds(_y, folds, results)
+
+def fold_task_jobs(n_rows, total_rows, n_workers, n_cores=None):
+    """
+    The number of threads of LightGBM for a task of n_rows.
+    A task gets the cores in proportion to its rows, assuming n_workers tasks run at once.
+    """
+    n_cores = joblib.cpu_count() if n_cores is None else n_cores
+    n_jobs = int(np.ceil(n_cores * n_workers * n_rows / max(total_rows, 1)))
+    return int(np.clip(n_jobs, 1, n_cores))
+
+def run_fold_tasks(tasks, n_workers=TRAIN_N_WORKERS):
+    """
+    Run (type, fold) trainings concurrently, the largest first.
+    LightGBM releases the GIL, so the tasks run on threads and share the data.
+    
+    Parameters
+    ----------
+    tasks: list of dict
+        kwargs of fit_fold() without n_jobs
+    n_workers: int
+        the number of tasks running at once
+    
+    Returns
+    -------
+    results: list of return values of fit_fold(), in the order of tasks
+    """
+    n_rows = [len(task['train_idx']) for task in tasks]
+    total_rows = sum(n_rows)
+    order = np.argsort(n_rows, kind='stable')[::-1]
+    get_logger().info('run %d fold tasks on %d workers' % (len(tasks), n_workers))
+    
+    results = joblib.Parallel(n_jobs=n_workers, prefer='threads')(
+        joblib.delayed(fit_fold)(**tasks[i], n_jobs=fold_task_jobs(n_rows[i], total_rows, n_workers))
+        for i in order)
+    ret = [None] * len(tasks)
+    for i, result in zip(order, results):
+        ret[i] = result
+    return ret
+
+def to_float32(_X):
+    """Features as a C-contiguous float32 matrix, which LightGBM reads without copying"""
+    if isinstance(_X, pd.DataFrame):
+        _X = _X.to_numpy(dtype=np.float32)
+    return np.ascontiguousarray(_X, dtype=np.float32)
+
+def scale_tree(tree_str, weight):
+    """Multiply output values of a tree in LightGBM model text by weight"""
+    lines = tree_str.split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith('leaf_value=') or line.startswith('internal_value='):
+            key, values = line.split('=', 1)
+            lines[i] = key + '=' + ' '.join(repr(float(v) * weight) for v in values.split(' '))
+    return '\n'.join(lines)
+
+def merge_boosters(boosters):
+    """
+    Merge the fold boosters into one lgb.Booster, whose prediction is the mean of them,
+    so that the rows are scored by all the trees in one pass.
+    
+    The trees are concatenated in LightGBM model text with leaf values divided by
+    the number of boosters. The boosters must have the same features.
+    """
+    head = None
+    trees = []
+    for booster in boosters:
+        model_str = booster.model_to_string()
+        end = model_str.index('end of trees')
+        parts = re.split(r'^Tree=\d+\n', model_str[:end], flags=re.M)
+        if head is None:
+            head, tail = parts[0], model_str[end:]
+        trees += [scale_tree(tree, 1 / len(boosters)) for tree in parts[1:]]
+    
+    trees = ['Tree=%d\n%s' % (i, tree) for i, tree in enumerate(trees)]
+    tree_sizes = 'tree_sizes=' + ' '.join(str(len(tree.encode())) for tree in trees)
+    head = re.sub(r'^tree_sizes=.*$', tree_sizes, head, flags=re.M)
+    return lgb.Booster(model_str=head + ''.join(trees) + tail)
+
+def compile_ensemble(model_path, lib_path, n_jobs=N_JOBS):
+    """
+    Compile a LightGBM model text (e.g. ensemble of ModelArtifact) to a shared library
+    by treelite for large batch runs. It needs treelite and a C compiler.
+    
+    Returns
+    -------
+    predictor: treelite_runtime.Predictor
+    """
+    import treelite
+    import treelite_runtime
+    model = treelite.Model.load(model_path, model_format='lightgbm')
+    model.export_lib(toolchain='gcc', libpath=lib_path, params={'parallel_comp': joblib.cpu_count()})
+    return treelite_runtime.Predictor(lib_path, nthread=joblib.cpu_count() if n_jobs < 0 else n_jobs)
+
+@instrument()
+def oof_predict(_models, _X, n_jobs=N_JOBS):
+    """
+    Mean of the predictions of fold models.
+    
+    Parameters
+    ----------
+    _models: list of lgb.Booster or lgb.Booster
+        If a booster is given, it is an output of merge_boosters().
+    """
+    get_logger().info('Start oof_predict')
+    booster = _models if isinstance(_models, lgb.Booster) else merge_boosters(_models)
+    y_pred = booster.predict(to_float32(_X), num_threads=n_jobs)
+    
+    get_logger().info('Finish oof_predict')
+    return y_pred
+
+
+def gen_params(_X):
+    """
+    Returns
+    -------
+    params: dict
+        parameters of lgb.train()
+    num_boost_round: int
+    """
+    n_features = _X.shape[1]
+    colsample_rate = max(0.1, math.sqrt(n_features)/n_features)
+    
+    params = dict(
+        learning_rate=0.2,
+        num_leaves=128,
+        # min_child_weight=15, # good value: 0, 5, 15, 300
+        min_child_samples=80,
+        subsample=0.7,
+        colsample_bytree=1, # colsample_rate,
+        objective='regression',
+        metric='mae',
+        reg_lambda=0.1,
+        reg_alpha=0.1,
+        seed=2019,
+        verbose=-1
+        )
+    num_boost_round = 2000
+    return params, num_boost_round
+
+def preprocess_molecules(df, strct):
+    """
+    Per-molecule part of preprocess().
+    It gives the same result on any molecule-aligned part of df.
+    """
+    df = map_atom_info(df, strct, 0)
+    df = map_atom_info(df, strct, 1)
+    df = calc_dist(df)
+    df = add_geometry_features(df, strct)
+    df = divide_type(df)
+    df = feature_engineering(df)
+    return df
+
+def update_code_hash(h, code):
+    """Update hash h with the bytecode, constants and global names of a code object and its nested ones"""
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            update_code_hash(h, const)
+        elif isinstance(const, frozenset):
+            # the order of a set depends on the hash seed of the process
+            h.update(repr(sorted(repr(c) for c in const)).encode())
+        else:
+            h.update(repr(const).encode())
+
+def fingerprint(obj):
+    """
+    Hash string of an input of a preprocess stage.
+    
+    Parameters
+    ----------
+    obj: object
+        dataframe, series, index, categorical and array: hash of the content.
+        list, tuple, dict and set: hash of the hashes of the items.
+        function: hash of the source code (of the bytecode, constants and names if it is not available).
+        path of an existing file: hash of the path, mtime and size.
+        other (scalar): hash of repr()
+    """
+    h = hashlib.sha1()
+    if isinstance(obj, pd.DataFrame):
+        h.update(str(obj.columns.tolist()).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        h.update(('%s:%s:%r' % (type(obj).__name__, obj.dtype, obj.name)).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=isinstance(obj, pd.Series)).values.tobytes())
+    elif isinstance(obj, pd.Categorical):
+        h.update(('Categorical:%s' % obj.dtype).encode())
+        h.update(pd.util.hash_array(obj).tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(('%s:%s' % (obj.dtype, obj.shape)).encode())
+        h.update(pd.util.hash_array(obj.ravel()).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode())
+        for value in obj:
+            h.update(fingerprint(value).encode())
+    elif isinstance(obj, dict):
+        # the order of the items does not matter
+        for key_hash, value_hash in sorted((fingerprint(k), fingerprint(v)) for k, v in obj.items()):
+            h.update((key_hash + value_hash).encode())
+    elif isinstance(obj, (set, frozenset)):
+        for value_hash in sorted(fingerprint(value) for value in obj):
+            h.update(value_hash.encode())
+    elif isinstance(obj, StructureIndex):
+        for name, value in sorted(vars(obj).items()):
+            h.update(name.encode())
+            h.update(fingerprint(value).encode())
+    elif isinstance(obj, type):
+        # the methods, because inspect.getsource() of a class defined in a notebook fails
+        for name, value in sorted(vars(obj).items()):
+            value = getattr(value, 'fget', getattr(value, '__func__', value))
+            if inspect.isfunction(value):
+                h.update(name.encode())
+                h.update(fingerprint(value).encode())
+    elif callable(obj):
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            func = inspect.unwrap(obj)
+            if hasattr(func, '__code__'):
+                update_code_hash(h, func.__code__)
+                h.update(fingerprint(func.__defaults__).encode())
+            else:
+                h.update(repr(func).encode())
+    elif isinstance(obj, str) and os.path.isfile(obj):
+        st = os.stat(obj)
+        h.update(('%s:%d:%d' % (obj, st.st_mtime_ns, st.st_size)).encode())
+    else:
+        h.update(repr(obj).encode())
+    return h.hexdigest()
+
+class StageCache:
+    """
+    Content-addressed cache of preprocess stages.
+    
+    The key of a stage is the hash of the key of the previous stage
+    (the first key is the hash of the inputs), the stage name and its dependencies,
+    so that changing a stage recomputes only the stage and the stages after it.
+    """
+    def __init__(self, inputs, root=STAGE_CACHE_DIR, enabled=USE_STAGE_CACHE):
+        """
+        Parameters
+        ----------
+        inputs: list
+            inputs of the first stage (e.g. dataframe of train.csv)
+        root: str
+        enabled: bool
+            If False, stages are always computed and not saved.
+        """
+        self.root = root
+        self.enabled = enabled
+        self.key = ''
+        if enabled:
+            os.makedirs(root, exist_ok=True)
+            self.key = hashlib.sha1(''.join(fingerprint(x) for x in inputs).encode()).hexdigest()
+    
+    def run(self, name, func, *args, deps=(), **kwargs):
+        """
+        Return func(*args, **kwargs) loading it from the cache if possible.
         
-    for i, model in enumerate(_models):
-        get_logger().info('prediction: %d' % i)
-        y_pred += model.predict(_X) / len(_models)
-    
-    get_logger().info('Finish oof_predict')
-    return y_pred
-
+        Parameters
+        ----------
+        name: str
+            stage name
+        func: callable
+            args and kwargs are NOT hashed. They must be outputs of the previous stage
+            or be listed in inputs of StageCache or deps.
+        deps: list
+            other things the stage depends on:
+            functions it calls, config values and files it reads.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        
+        self.key = hashlib.sha1(
+            ''.join([self.key, name, fingerprint(func)] + [fingerprint(x) for x in deps]).encode()
+        ).hexdigest()
+        path = os.path.join(self.root, '%s_%s.pkl' % (name, self.key[:16]))
+        if os.path.exists(path):
+            get_logger().info('load cached stage %s from %s' % (name, path))
+            return joblib.load(path)
+        
+        ret = func(*args, **kwargs)
+        joblib.dump(ret, path)
+        return ret
 
-def gen_model(_X):
-    n_features = _X.shape[1]
-    colsample_rate = max(0.1, math.sqrt(n_features)/n_features)
+def encode(df, mode, encoder_path=ENCODER_PATH):
+    """
+    Parameters
+    ----------
+    encoder_path: str
+        path of Encoder to load when mode is 'predict'
     
-    _model = lgb.LGBMRegressor(
-        learning_rate=0.2,
-        n_estimators=2000,
-        num_leaves=128,
-        # min_child_weight=15, # good value: 0, 5, 15, 300
-        min_child_samples=80,
-        subsample=0.7,
-        colsample_bytree=1, # colsample_rate,
-        objective='regression',
-        reg_lambda=0.1,
-        reg_alpha=0.1,
-        seed=2019
-        )
-    return _model
+    Returns
+    -------
+    df: pd.DataFrame
+    enc: Encoder
+    """
+    if mode == 'train':
+        enc = Encoder()
+        enc.fit(df, ['type', 'type_0', 'type_1', 'neighbor_atoms',
+                     '2j_atom_center', '3j_atom_center'])
+    elif mode == 'predict':
+        get_logger().info('loading encoder from %s' % encoder_path)
+        enc = joblib.load(encoder_path)
+    df = enc.transform(df)
+    return df, enc
 
-def preprocess(df, strct, mode, s_type=None):
+def reduce_features(df):
+    use_features = [col for col in df.columns if col not in [TARGET, *CONTR_COLS]] #'fc', 'sd', 'dso', 'pso']]
+    get_logger().info(use_features)
+    # the object columns are already encoded by encode()
+    df = reduce_mem_usage(df, columns=use_features, category_ratio=None)
+    return df
+
+@instrument(keys=['mode'])
+def preprocess(df, strct, mode, s_type=None, use_cache=USE_STAGE_CACHE, tables=None, 
+               encoder_path=ENCODER_PATH):
     """
     Parameters
     ----------
     df: pd.DataFrame
         dataframe of train.csv or test.csv
-    strct: pd.DataFrame
-        dataframe of structures.csv
+    strct: StructureIndex
+        index of structures.csv
     mode: str
         'train' or 'predict'
     s_type: None or pd.Series
         'type' column (e.g. 1JHC, 2JHH).
         If mode is 'train', the s_type must be specified.
+    use_cache: bool
+        whether cache the stages by StageCache
+    tables: None or dict
+        {'1j': load_1j_table(), '2j': load_2j_table(), '3j': load_3j_table()}
+        to reuse them between calls. If None, they are loaded.
+    encoder_path: str
+        path of Encoder used when mode is 'predict'
     """
     get_logger().info('Start preprocess()')
-    df = add_1j(df)
-    df = add_2j_center_atom(df)
-    df = add_3j_center_atom(df)
-    df = map_atom_info(df, strct, 0)
-    df = map_atom_info(df, strct, 1)
-    df = calc_dist(df)
-    df = divide_type(df)
-    df = feature_engineering(df)
+    tables = {} if tables is None else tables
+    cache = StageCache([df, strct, INT_MOLECULE_ID], enabled=use_cache)
+    df = cache.run('add_1j', add_1j, df, tables.get('1j'),
+                   deps=[PREPROCESS + 'df_1j.pkl', load_1j_table, encode_molecule_name])
+    df = cache.run('add_2j', add_2j_center_atom, df, tables.get('2j'),
+                   deps=[PREPROCESS + 'df_2jsim.pkl', load_2j_table, encode_molecule_name, atom_weight,
+                         fillna_label])
+    df = cache.run('add_3j', add_3j_center_atom, df, tables.get('3j'),
+                   deps=[PREPROCESS + 'df_3jsim.pkl', load_3j_table, encode_molecule_name, atom_weight, str_sort,
+                         relabel, fillna_label])
+    df = cache.run('molecules', run_sharded, preprocess_molecules, df, strct=strct,
+                   deps=[preprocess_molecules, map_atom_info, calc_dist, divide_type, relabel,
+                         feature_engineering, group_transform, FE_AGGS,
+                         add_geometry_features, molecule_atoms, atom_geometry,
+                         GEO_KNN, GEO_RADII, GEO_ELEMENTS])
     
     display(df.head(10))
     display(df.tail(10))
     
     # encode
+    encode_deps = [mode, Encoder, UNSEEN_CODE] + ([encoder_path] if mode == 'predict' else [])
+    df, enc = cache.run('encode', encode, df, mode, encoder_path, deps=encode_deps)
     if mode == 'train':
-        enc = Encoder()
-        enc.fit(df, ['type', 'type_0', 'type_1', 
-                     '2j_atom_center', '3j_atom_center'])
         joblib.dump(enc, ENCODER_PATH)
-    elif mode == 'predict':
-        get_logger().info('loading encoder from %s' % ENCODER_PATH)
-        enc = joblib.load(ENCODER_PATH)
-    df = enc.transform(df)
-        
-    use_features = [col for col in df.columns if col not in [TARGET, *CONTR_COLS]] #'fc', 'sd', 'dso', 'pso']]
-    get_logger().info(use_features)
-    df[use_features] = reduce_mem_usage(df[use_features])
+    
+    df = cache.run('reduce_mem', reduce_features, df, deps=[reduce_mem_usage, _round_trip_ok, REDUCE_MEM_RTOL, TARGET, CONTR_COLS])
     # TODO: back
-    # df = add_scc_feature(df, 'fc', mode=mode, s_type=s_type)
+    # df = add_scc_feature(df, mode=mode, s_type=s_type)
     
     get_logger().info('Finish preprocess()')
     return df
@@ -495,96 +1741,302 @@ def drop_uneffect_feature(df):
 
 """### fermi constant"""
 
+@functools.lru_cache(maxsize=1)
+def load_scc(path=INPUT + 'scalar_coupling_contributions.csv'):
+    """
+    MERGE_KEY and CONTR_COLS of scalar_coupling_contributions.csv loaded once and shared between calls.
+    Do not modify the returned dataframe in place.
+    """
+    get_logger().info('start loading %s' % path)
+    scc = load_csv(path, usecols=MERGE_KEY + CONTR_COLS)
+    get_logger().info('finished loading %s' % path)
+    return scc
+
 class CNTR:
-    """Model to predict fc/sd/pso/dso columns"""
+    """
+    Models to predict fc/sd/pso/dso columns (and their sum) of each coupling type.
     
-    def __init__(self, y_col):
-        self.y_col = y_col
-        
-    def train(self, df_org, scc, s_type):
+    The targets of a type share one feature matrix and the bins of one lgb.Dataset,
+    and all (target, type, fold) trainings are scheduled together by run_fold_tasks().
+    """
+    def __init__(self, y_cols=CONTR_COLS + [TARGET]):
+        self.y_cols = list(y_cols)
+        # {y_col: {coupling type: models}}
+        self.model_dict = {y_col: {} for y_col in self.y_cols}
+        self.score_dict = {y_col: {} for y_col in self.y_cols}
+        self.feature_dict = {}
+    
+    @property
+    def pred_cols(self):
+        return ['%s_pred' % y_col for y_col in self.y_cols]
+    
+    def features(self, columns):
+        """feature columns in `columns` (the targets, stacking features and DROP_COLS are not)"""
+        drop = set(DROP_COLS + CONTR_COLS + [TARGET] + self.pred_cols)
+        return [col for col in columns if col not in drop]
+    
+    def train(self, df, s_type, folds, n_workers=TRAIN_N_WORKERS):
         """
         Parameters
         ----------
+        df: pd.DataFrame or FeatureStore
+            features and `y_cols` columns. If df is FeatureStore, rows of each type are loaded lazily.
         s_type: pd.Series
             'type' column (e.g. 1JHC, 2JHH)
-        """
-        df = df_org.copy()
-        # Merge
-        key_cols = ['molecule_name', 'atom_index_0', 'atom_index_1']
-        df = df.merge(scc[key_cols + [self.y_col]], how='left', on=key_cols)
-        
-        # drop unnecessary cols        
-        df = drop_col(df)        
-        
-        y = df[self.y_col].copy()        
-        df.drop([TARGET, self.y_col], axis=1, inplace=True)
-        X = df
-        
-        display(X.head())
-        display(y.head())
-        models, scores, y_pred = oof_train(X, y, s_type)
+        folds: np.ndarray
+            fold of each row (output of get_folds())
+        n_workers: int
+            the number of trainings running at once
         
-        # save model
-        joblib.dump(models, MID_MODEL_PATH, compress=3)
-        
-        self.models_ = models
-        self.scores_ = scores
-        self.y_pred_ = y_pred
-        
-    def predict(self, df_org):    
-        y_pred = np.zeros(df_org.shape[0])
-        
-        X = df_org.copy()
-        X = drop_col(X)
+        Sets `oof_`, out-of-fold predictions ('<y_col>_pred') in the order of the rows of df.
+        """
+        columns = list(df.columns)
+        feature_cols = self.features(columns)
+        # only the features and the targets are loaded from FeatureStore
+        load_cols = feature_cols + [col for col in dict.fromkeys(self.y_cols + [TARGET]) if col in columns]
+        tasks = []
+        task_keys = []
+        data = {}
+        y_target = np.full(len(s_type), np.nan)
+        for coup_type in s_type.unique():
+            get_logger().info('Starting train contributions(%s)' % coup_type)
+            is_the_type = (s_type == coup_type).values
+            if isinstance(df, FeatureStore):
+                df_type = df.load(columns=load_cols, types=[coup_type])
+            else:
+                df_type = df[is_the_type]
+            
+            # one feature matrix of the type for all targets
+            X = drop_uneffect_feature(df_type[feature_cols].reset_index(drop=True))
+            self.feature_dict[coup_type] = X.columns.tolist()
+            get_logger().info('features(%s): %s' % (coup_type, str(self.feature_dict[coup_type])))
+            types = s_type[is_the_type].reset_index(drop=True)
+            type_folds = oof_split(folds[is_the_type])
+            if TARGET in df_type.columns:
+                y_target[is_the_type] = df_type[TARGET].values
+            
+            reference = None
+            for y_col in self.y_cols:
+                y = df_type[y_col].reset_index(drop=True).astype(np.float64)
+                # the other targets reuse the bins of the first one
+                dataset = build_dataset(X, y, reference=reference)
+                reference = dataset if reference is None else reference
+                data[y_col, coup_type] = (y, type_folds, np.flatnonzero(is_the_type))
+                for n_fold, (train_idx, valid_idx) in enumerate(type_folds):
+                    tasks.append(dict(_X=X, _y=y, _types=types, dataset=dataset,
+                                      train_idx=train_idx, valid_idx=valid_idx, n_fold=n_fold))
+                    task_keys.append((y_col, coup_type))
         
-        display(X.head())
-        # X = self.preprocess(df_org)
-        for model in self.models_:            
-            y_pred += model.predict(X) / len(models)
+        results = run_fold_tasks(tasks, n_workers)
+        oof = np.full((len(s_type), len(self.y_cols)), np.nan)
+        for (y_col, coup_type), (y, type_folds, rows) in data.items():
+            get_logger().info('CV of %s %s' % (y_col, coup_type))
+            key_results = [result for key, result in zip(task_keys, results) if key == (y_col, coup_type)]
+            models, df_scores, df_pred = collect_folds(y, type_folds, key_results)
+            self.model_dict[y_col][coup_type] = models
+            self.score_dict[y_col][coup_type] = df_scores
+            oof[rows, self.y_cols.index(y_col)] = df_pred['proba'].values
+        self.oof_ = pd.DataFrame(oof, columns=self.pred_cols)
         
-        return y_pred
+        if set(CONTR_COLS) <= set(self.y_cols) and not np.isnan(y_target).all():
+            # TARGET is the sum of the contributions
+            y_sum = self.oof_[['%s_pred' % col for col in CONTR_COLS]].values.sum(axis=1)
+            is_valid = ~np.isnan(y_target)
+            get_logger().info('valid score(fc+sd+pso+dso): %f' % group_mean_log_mae(
+                y_target[is_valid], y_sum[is_valid], s_type.values[is_valid]))
+        return self
     
-    def load_model(self):
-        # load pkl by joblib
-        self.models_ = joblib.load(MID_MODEL_PATH)
-
-def add_scc_feature(df, cntr_name, mode, s_type=None):
+    def predict(self, df, s_type):
+        """
+        Returns
+        -------
+        y_pred: pd.DataFrame, shape [n_samples, len(y_cols)]
+            '<y_col>_pred' in the order of the rows of df
+        """
+        y_pred = np.full((len(df), len(self.y_cols)), np.nan)
+        for coup_type in s_type.unique():
+            is_the_type = (s_type == coup_type).values
+            X = df[is_the_type][self.feature_dict[coup_type]]
+            for j, y_col in enumerate(self.y_cols):
+                get_logger().info('Starting predict target(%s %s)' % (y_col, coup_type))
+                y_pred[is_the_type, j] = oof_predict(self.model_dict[y_col][coup_type], X)
+        return pd.DataFrame(y_pred, columns=self.pred_cols)
+
+def train_contributions(df, s_type, folds, y_cols=CONTR_COLS + [TARGET]):
+    return CNTR(y_cols).train(df, s_type, folds)
+
+def contribution_models(df, s_type, folds, y_cols=CONTR_COLS + [TARGET], use_cache=USE_STAGE_CACHE):
+    """
+    CNTR trained on df, loaded from the stage cache if it was trained on the same data,
+    so that its out-of-fold predictions (`oof_`) are reused as stacking features without retraining.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame or FeatureStore
+        features and `y_cols` columns
     """
+    data = df.manifest_path if isinstance(df, FeatureStore) else df
+    # the types as an array of strings, whether s_type is categorical or not
+    cache = StageCache([data, np.asarray(s_type, dtype=object), folds, y_cols], enabled=use_cache)
+    cntr = cache.run('contributions', train_contributions, df, s_type, folds, y_cols,
+                     deps=[CNTR, DROP_COLS, drop_uneffect_feature, oof_split, build_dataset, gen_params,
+                           fit_fold, run_fold_tasks, collect_folds, USE_GROUP_MAE_FEVAL,
+                           GroupMAE, group_mean_log_mae, group_mae_feval, group_codes])
+    joblib.dump(cntr, MID_MODEL_PATH, compress=3)
+    return cntr
+
+def add_scc_feature(df, mode, s_type, folds=None, y_cols=CONTR_COLS + [TARGET], cntr=None):
+    """
+    Add predictions of the contributions ('<y_col>_pred') to df in place.
+    In training, they are out-of-fold predictions.
+    
     Parameters
     ----------
-    cntr_name: str
-        'fc', 'sd', 'pso' or 'dso'
     mode: str
         'train' or 'predict'
-    s_type: None or pd.Series
+    s_type: pd.Series
         'type' column (e.g. 1JHC, 2JHH).
-        If mode is 'train', the s_type must be specified.
+    folds: None or np.ndarray
+        fold of each row. If None, get_folds() of df is used.
+    y_cols: list of str
+        some of 'fc', 'sd', 'pso', 'dso' and TARGET
+    cntr: None or CNTR
+        models for 'predict' mode. If None, they are loaded from MID_MODEL_PATH.
+    """
+    if mode == 'train':
+        missing = [col for col in y_cols if col not in df.columns]
+        if missing:
+            # merge only the keys, not the whole dataframe
+            scc = df[MERGE_KEY].merge(load_scc()[MERGE_KEY + missing], on=MERGE_KEY, how='left')
+            for col in missing:
+                df[col] = scc[col].values
+        if folds is None:
+            folds = get_folds(df['molecule_name'], s_type)
+        y_pred = contribution_models(df, s_type, folds, y_cols).oof_
+    elif mode == 'predict':
+        if cntr is None:
+            cntr = joblib.load(MID_MODEL_PATH)
+        y_pred = cntr.predict(df, s_type)
+    
+    for col in y_pred.columns:
+        df[col] = y_pred[col].values
+    return df
+
+"""## feature store
+Preprocessed data is stored column by column and partitioned by coupling type,
+so that only the needed columns and rows are loaded (memory-mapped).
+"""
+
+class FeatureStore:
     """
-    add_feature = '%s_pred' % cntr_name
-    cntr = CNTR(cntr_name)
-    if mode == 'train': 
-        assert s_type is not None, 's_type must be specified.'
+    Layout:
+        <root>/manifest.json
+        <root>/<type>/_row.npy       row positions in the original dataframe
+        <root>/<type>/<column>.npy
+    Non-numeric (object, category) columns are saved as int32 codes and
+    their categories are written to the manifest.
+    """
+    def __init__(self, root=FEATURE_STORE_DIR):
+        self.root = root
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.manifest = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+    
+    @property
+    def columns(self):
+        return self.manifest['columns']
+    
+    @property
+    def types(self):
+        return list(self.manifest['partitions'].keys())
+    
+    def save(self, df, s_type):
+        """
+        Parameters
+        ----------
+        df: pd.DataFrame
+        s_type: pd.Series
+            'type' column (e.g. 1JHC, 2JHH) to partition rows
+        """
+        get_logger().info('save feature store to %s' % self.root)
+        manifest = {'columns': df.columns.tolist(), 'dtypes': {}, 'categories': {}, 'partitions': {}}
+        for col in df.columns:
+            manifest['dtypes'][col] = str(df[col].dtype)
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                manifest['categories'][col] = pd.Categorical(df[col]).categories.tolist()
         
-        get_logger().info('start loading scalar_coupling_contributions')
-        scc = pd.read_csv(INPUT + 'scalar_coupling_contributions.csv')
-        get_logger().info('finished loading scalar_coupling_contributions')
+        for coup_type in s_type.unique():
+            part_dir = os.path.join(self.root, coup_type)
+            os.makedirs(part_dir, exist_ok=True)
+            rows = np.flatnonzero((s_type == coup_type).values)
+            np.save(os.path.join(part_dir, '_row.npy'), rows)
+            for col in df.columns:
+                values = df[col].values[rows]
+                if col in manifest['categories']:
+                    values = pd.Categorical(values, categories=manifest['categories'][col]).codes.astype(np.int32)
+                np.save(os.path.join(part_dir, col + '.npy'), values)
+            manifest['partitions'][coup_type] = len(rows)
         
-        # train contribution(fc/sd/pso/dso)
-        cntr.train(df, scc, s_type)
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        self.manifest = manifest
     
-        display(cntr.y_pred_.head())
-        df[add_feature] = cntr.y_pred_
-    elif mode == 'predict':
-        cntr.load_model()
-        y_pred = cntr.predict(df)
-        df[add_feature] = y_pred
+    def load(self, columns=None, types=None, mmap_mode='r'):
+        """
+        Parameters
+        ----------
+        columns: None or list of str
+            If None, all columns are loaded.
+        types: None or list of str
+            coupling types to load. If None, all types are loaded.
+        mmap_mode: None or str
+            passed to np.load. numeric columns are not copied with 'r'.
+        
+        Returns
+        -------
+        df: pd.DataFrame
+            index is the row position in the saved dataframe
+        """
+        columns = self.columns if columns is None else columns
+        types = self.types if types is None else types
+        
+        parts = []
+        for coup_type in types:
+            part_dir = os.path.join(self.root, coup_type)
+            data = {}
+            for col in columns:
+                values = np.load(os.path.join(part_dir, col + '.npy'), mmap_mode=mmap_mode)
+                if col in self.manifest['categories']:
+                    values = pd.Categorical.from_codes(values, self.manifest['categories'][col])
+                    if self.manifest['dtypes'][col] != 'category':
+                        values = np.asarray(values, dtype=object)
+                data[col] = values
+            index = np.load(os.path.join(part_dir, '_row.npy'))
+            parts.append(pd.DataFrame(data, index=index, columns=columns, copy=False))
+        
+        if len(parts) == 1:
+            return parts[0]
+        return pd.concat(parts, axis=0).sort_index()
     
-    return df
+    def load_type(self):
+        """
+        Returns
+        -------
+        s_type: pd.Series
+            'type' column in the order of the saved dataframe
+        """
+        s_type = np.empty(sum(self.manifest['partitions'].values()), dtype=object)
+        for coup_type in self.types:
+            rows = np.load(os.path.join(self.root, coup_type, '_row.npy'))
+            s_type[rows] = coup_type
+        return pd.Series(s_type, name='type')
 
 """## Train"""
 
-df_train = pd.read_csv(TRAIN_PATH)
-df_strct = pd.read_csv(INPUT + 'structures.csv')
+df_train = load_csv(TRAIN_PATH)
+df_strct = StructureIndex(load_csv(INPUT + 'structures.csv'))
 
 # TODO: remove
 # df_train = df_train[(df_train['type']=='1JHC') | (df_train['type']=='1JHN')]
@@ -594,6 +2046,7 @@ def train_single_model(df, strct):
     df = df.head(10000)
 
     s_type = df['type'].copy()
+    folds = get_folds(df['molecule_name'], s_type)
 
     df = preprocess(df, strct, mode='train', s_type=s_type)
     df = drop_col(df)
@@ -604,7 +2057,7 @@ def train_single_model(df, strct):
     
     display(X.head())
     display(y.head())
-    models, df_scores, df_pred = oof_train(X, y, s_type)
+    models, df_scores, df_pred = oof_train(X, y, s_type, folds)
 
     joblib.dump(models, MODEL_PATH, compress=3)
     
@@ -616,29 +2069,73 @@ class LGBM:
         self.model_dict = {}
         self.score_dict = {}
         self.pred_dict = {}
+        self.feature_dict = {}
     
-    def train(self, df, s_type):
-        self.cols = df.columns.tolist()
+    def train(self, df, s_type, folds, n_workers=TRAIN_N_WORKERS):
+        """
+        Parameters
+        ----------
+        df: pd.DataFrame or FeatureStore
+            If df is FeatureStore, rows of each type are loaded lazily.
+        s_type: pd.Series
+            'type' column (e.g. 1JHC, 2JHH)
+        folds: np.ndarray
+            fold of each row (output of get_folds())
+        n_workers: int
+            If more than 1, all (type, fold) trainings are scheduled by run_fold_tasks().
+            Otherwise the types are trained one by one.
+        """
+        self.cols = df.columns if isinstance(df, FeatureStore) else df.columns.tolist()
+        feature_cols = [col for col in self.cols if col not in CONTR_COLS + [TARGET]]
         
         # TODO: back
         coupling_types = s_type.unique()
         # coupling_types = ['1JHC']
+        tasks = []
+        task_types = []
+        data = {}
         for coup_type in coupling_types:
             get_logger().info('Starting train model(%s %s)' % (self.target_col, coup_type))
             is_the_type = (s_type == coup_type)        
-            df_type = df[is_the_type.values]
+            if isinstance(df, FeatureStore):
+                # only the features and the target are loaded
+                df_type = df.load(columns=feature_cols + [self.target_col], types=[coup_type])
+            else:
+                df_type = df[is_the_type.values]
 
             y = df_type[self.target_col]
-            # df_type.drop([self.target_col], axis=1, inplace=True)
-            df_type.drop(CONTR_COLS + [TARGET], axis=1, inplace=True)
-            X = df_type
+            X = df_type[feature_cols]
             X = drop_uneffect_feature(X)
 
             get_logger().info('features(%s): %s' % (coup_type, str(X.columns.tolist())))
             display(X.head())
             display(y.head())
-            models, df_scores, df_pred = oof_train(X, y, _types=s_type[is_the_type].reset_index(drop=True))
-
+            self.feature_dict[coup_type] = X.columns.tolist()
+            if n_workers == 1:
+                models, df_scores, df_pred = oof_train(X, y, _types=s_type[is_the_type].reset_index(drop=True),
+                                                       _folds=folds[is_the_type.values])
+                self.model_dict[coup_type] = models
+                self.score_dict[coup_type] = df_scores
+                self.pred_dict[coup_type] = df_pred                     
+                continue
+            
+            X = X.reset_index(drop=True)
+            y = y.reset_index(drop=True)
+            types = s_type[is_the_type].reset_index(drop=True)
+            type_folds = oof_split(folds[is_the_type.values])
+            dataset = build_dataset(X, y)
+            data[coup_type] = (y, type_folds)
+            for n_fold, (train_idx, valid_idx) in enumerate(type_folds):
+                tasks.append(dict(_X=X, _y=y, _types=types, dataset=dataset,
+                                  train_idx=train_idx, valid_idx=valid_idx, n_fold=n_fold))
+                task_types.append(coup_type)
+        
+        if len(tasks) == 0:
+            return
+        results = run_fold_tasks(tasks, n_workers)
+        for coup_type, (y, type_folds) in data.items():
+            type_results = [result for t, result in zip(task_types, results) if t == coup_type]
+            models, df_scores, df_pred = collect_folds(y, type_folds, type_results)
             self.model_dict[coup_type] = models
             self.score_dict[coup_type] = df_scores
             self.pred_dict[coup_type] = df_pred                     
@@ -657,8 +2154,13 @@ class LGBM:
             is_the_type = (s_type == coup_type)
             df_type = df[is_the_type]
 
-            X = df_type
-            X = drop_uneffect_feature(X)        
+            # use the features of training, because constant columns
+            # in a (small) test data are not the same as in training data.
+            if coup_type in getattr(self, 'feature_dict', {}):
+                X = df_type[self.feature_dict[coup_type]]
+            else:
+                X = df_type
+                X = drop_uneffect_feature(X)        
 
             display(X.head())  
             y_pred = oof_predict(models, X)        
@@ -667,24 +2169,140 @@ class LGBM:
         
         return df_submit
 
+class ModelArtifact:
+    """
+    Boosters of a target saved per coupling type for prediction:
+    
+        root/encoder.pkl
+        root/<target>/manifest.json  feature columns, the number of boosters and CV score of each type
+        root/<target>/<type>/model_<k>.txt  booster k as LightGBM model text
+        root/<target>/<type>/ensemble.txt  merge_boosters() of the boosters
+    
+    The boosters of a type are loaded on the first use of the type.
+    It has predict() same as LGBM, but no OOF predictions.
+    """
+    def __init__(self, target_col, root=ARTIFACT_DIR):
+        self.target_col = target_col
+        self.root = root
+        self.dir = os.path.join(root, target_col)
+        self.manifest_ = None
+        self.boosters_ = {}
+        self.ensembles_ = {}
+    
+    @classmethod
+    def save(cls, model, root=ARTIFACT_DIR, encoder_path=ENCODER_PATH):
+        """
+        Parameters
+        ----------
+        model: LGBM
+            trained model
+        """
+        artifact = cls(model.target_col, root)
+        manifest = {'types': {}}
+        for coup_type, models in model.model_dict.items():
+            os.makedirs(os.path.join(artifact.dir, coup_type), exist_ok=True)
+            for k, booster in enumerate(models):
+                booster.save_model(artifact.booster_path(coup_type, k))
+            merge_boosters(models).save_model(artifact.ensemble_path(coup_type))
+            manifest['types'][coup_type] = {
+                'features': model.feature_dict[coup_type],
+                'n_models': len(models),
+                'score': float(model.score_dict[coup_type]['valid_score'].mean())}
+        with open(os.path.join(artifact.dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        if os.path.exists(encoder_path):
+            shutil.copyfile(encoder_path, artifact.encoder_path)
+        get_logger().info('saved artifact of %s to %s' % (model.target_col, artifact.dir))
+        return artifact
+    
+    @property
+    def manifest(self):
+        if self.manifest_ is None:
+            with open(os.path.join(self.dir, 'manifest.json')) as f:
+                self.manifest_ = json.load(f)
+        return self.manifest_
+    
+    @property
+    def encoder_path(self):
+        return os.path.join(self.root, 'encoder.pkl')
+    
+    @property
+    def types(self):
+        return list(self.manifest['types'].keys())
+    
+    def booster_path(self, coup_type, k):
+        return os.path.join(self.dir, coup_type, 'model_%d.txt' % k)
+    
+    def ensemble_path(self, coup_type):
+        return os.path.join(self.dir, coup_type, 'ensemble.txt')
+    
+    def features(self, coup_type):
+        return self.manifest['types'][coup_type]['features']
+    
+    def ensemble(self, coup_type):
+        """one lgb.Booster averaging the boosters of coup_type"""
+        if coup_type not in self.ensembles_:
+            path = self.ensemble_path(coup_type)
+            if os.path.exists(path):
+                self.ensembles_[coup_type] = lgb.Booster(model_file=path)
+            else:
+                self.ensembles_[coup_type] = merge_boosters(self.boosters(coup_type))
+        return self.ensembles_[coup_type]
+    
+    def boosters(self, coup_type):
+        if coup_type not in self.boosters_:
+            n_models = self.manifest['types'][coup_type]['n_models']
+            self.boosters_[coup_type] = [lgb.Booster(model_file=self.booster_path(coup_type, k)) 
+                                         for k in range(n_models)]
+        return self.boosters_[coup_type]
+    
+    def release(self, coup_type=None):
+        """Unload boosters of coup_type (all types if None)"""
+        if coup_type is None:
+            self.boosters_ = {}
+            self.ensembles_ = {}
+        else:
+            self.boosters_.pop(coup_type, None)
+            self.ensembles_.pop(coup_type, None)
+    
+    def predict(self, df, s_type, df_submit):
+        coupling_types = s_type.unique()
+        for coup_type in coupling_types:
+            get_logger().info('Starting predict target(%s %s)' % (self.target_col, coup_type))
+            is_the_type = (s_type == coup_type)
+            X = df[is_the_type][self.features(coup_type)]
+            y_pred = oof_predict(self.ensemble(coup_type), X)        
+
+            df_submit.loc[is_the_type, self.target_col] = y_pred        
+        
+        return df_submit
+
 def train_models_each_type(df, strct, use_preprocess_data):
     # TODO:back
     # df = df.head(100000)
     
     get_logger().info('Data size: %s' % str(df.shape))
+    # rows of the store are in the order of df
+    folds = get_folds(df['molecule_name'], df['type'])
     
+    store = FeatureStore()
     if use_preprocess_data:
-        df = joblib.load(PREPROCESS + 'df_preprocessed.pkl')
+        s_type = store.load_type()
     else:
-        df_scc = pd.read_csv(INPUT + 'scalar_coupling_contributions.csv')
+        df_scc = load_scc()
         df = df.merge(df_scc[MERGE_KEY + CONTR_COLS], on=MERGE_KEY, how='left')    
 
         s_type = df['type'].copy()
 
         df = preprocess(df, strct, mode='train', s_type=s_type)
+        if TRAIN_CONTRIBUTIONS:
+            df = add_scc_feature(df, 'train', s_type, folds)
         df = drop_col(df)
         
-        joblib.dump(df, PREPROCESS + 'df_preprocessed.pkl', compress=3)
+        store.save(df, s_type)
+        del df
+        gc.collect()
+    df = store
     
     '''
     model_dict = {}
@@ -715,18 +2333,18 @@ def train_models_each_type(df, strct, use_preprocess_data):
     for target in [TARGET]:# CONTR_COLS:
     # for target in CONTR_COLS:
         model = LGBM(target)
-        model.train(df, s_type)
+        model.train(df, s_type, folds)
         models[target] = model
         
-        model_file = 'model_%s.pkl' % target        
-        joblib.dump(model, model_file, compress=3)
+        ModelArtifact.save(model)
     
     get_logger().info('validate sum of fc sd pso dso')
     # coupling_types = ['1JHC']
     coupling_types = s_type.unique()
-    for coup_type in coupling_types:
+    metric = GroupMAE()
+    for n_type, coup_type in enumerate(coupling_types):
         is_the_type = (s_type == coup_type)
-        y_true = df.loc[is_the_type, TARGET].values
+        y_true = df.load(columns=[TARGET], types=[coup_type])[TARGET].values
         
         y_pred = np.zeros(len(y_true))
         for target in [TARGET]: # CONTR_COLS:
@@ -738,10 +2356,11 @@ def train_models_each_type(df, strct, use_preprocess_data):
         print(y_true[0:10])
         print(y_pred[0:10])
         
-        y_true = pd.Series(y_true)
-        y_pred = pd.Series(y_pred)
-        valid_score = group_mean_log_mae(y_true, y_pred, s_type)
+        groups = np.full(len(y_true), n_type)
+        valid_score = group_mean_log_mae(y_true, y_pred, groups)
+        metric.update(y_true, y_pred, groups)
         get_logger().info('valid score(fc+sd+pso+dso %s): %f' % (coup_type, valid_score))
+    get_logger().info('valid score(fc+sd+pso+dso): %f' % metric.score())
     return models
 
 # models, df_scores, df_pred = train_single_model(df_train, df_strct)
@@ -764,7 +2383,7 @@ print(score)
 def feat_importance(_models, _X, _imp_type='gain'):
     df_imp = pd.DataFrame(index=_X.columns)
     for i, model in enumerate(_models):
-        df_imp[i] = model.booster_.feature_importance(importance_type=_imp_type)
+        df_imp[i] = model.feature_importance(importance_type=_imp_type)
 
     df_imp = df_imp.apply(lambda x: x/sum(x))
     df_imp['imp_mean'] = df_imp[list(range(len(models)))].mean(axis=1)
@@ -777,8 +2396,7 @@ def feat_importance(_models, _X, _imp_type='gain'):
 
 """## Predict"""
 
-df_test = pd.read_csv(TEST_PATH)
-df_strct = pd.read_csv(INPUT + 'structures.csv')
+df_strct = StructureIndex(load_csv(INPUT + 'structures.csv'))
 
 def predict_single(df, strct):
     models = joblib.load(MODEL_PATH)
@@ -802,7 +2420,9 @@ def predict_each_type(df, strct):
     s_type = df['type'].copy()
     df_submit = df[['id']].copy()
     
-    df = preprocess(df, strct, mode='predict')
+    df = preprocess(df, strct, mode='predict', encoder_path=ModelArtifact(TARGET).encoder_path)
+    if TRAIN_CONTRIBUTIONS:
+        df = add_scc_feature(df, 'predict', s_type)
     df = drop_col(df)    
     
     '''
@@ -829,20 +2449,472 @@ def predict_each_type(df, strct):
     # for target in CONTR_COLS: # ['fc', 'sd', 'pso', 'dso']: 
     for target in [TARGET]: 
         get_logger().info('Start prediction: %s' % target)
-        model_file = 'model_%s.pkl' % target
-        model = joblib.load(model_file)
+        model = ModelArtifact(target)
                 
-        df_submit_each_target = model.predict(df, s_type, df_submit)                              
+        df_submit_each_target = model.predict(df, s_type, df_submit[['id']].copy())
         df_submit[TARGET] += df_submit_each_target[target]
     
     display(df_submit.head())
     print((df_submit[TARGET].isnull()).sum())
     return df_submit
 
-df_submit = predict_each_type(df_test, df_strct)
+def iter_molecule_chunks(path, chunk_size):
+    """
+    Read a csv file, whose rows of a molecule are contiguous (e.g. test.csv),
+    by chunks of about chunk_size rows without dividing a molecule.
+    """
+    rest = None
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=csv_dtypes(path)):
+        if INT_MOLECULE_ID:
+            chunk = encode_molecule_name(chunk)
+        if rest is not None:
+            chunk = pd.concat([rest, chunk], axis=0, ignore_index=True)
+        
+        # the last molecule may continue in the next chunk
+        is_last = (chunk['molecule_name'].values == chunk['molecule_name'].values[-1])
+        rest = chunk[is_last]
+        chunk = chunk[~is_last].reset_index(drop=True)
+        if len(chunk) > 0:
+            yield chunk
+    if rest is not None and len(rest) > 0:
+        yield rest.reset_index(drop=True)
+
+def predict_each_type_streaming(path, strct, out_path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Same as predict_each_type() but preprocess and predict by molecule-aligned chunks,
+    appending the predictions to `out_path`. The peak memory is proportional to chunk_size.
+    
+    Parameters
+    ----------
+    path: str
+        path of test.csv
+    strct: StructureIndex
+    out_path: str
+        path of submission csv
+    """
+    models = {}
+    # for target in CONTR_COLS: # ['fc', 'sd', 'pso', 'dso']: 
+    for target in [TARGET]: 
+        models[target] = ModelArtifact(target)
+    tables = {'1j': load_1j_table(), '2j': load_2j_table(), '3j': load_3j_table()}
+    cntr = joblib.load(MID_MODEL_PATH) if TRAIN_CONTRIBUTIONS else None
+    
+    n_rows = 0
+    for n_chunk, df in enumerate(iter_molecule_chunks(path, chunk_size)):
+        s_type = df['type'].copy()
+        df_submit = df[['id']].copy()
+        
+        df = preprocess(df, strct, mode='predict', use_cache=False, tables=tables,
+                        encoder_path=models[TARGET].encoder_path)
+        if TRAIN_CONTRIBUTIONS:
+            df = add_scc_feature(df, 'predict', s_type, cntr=cntr)
+        df = drop_col(df)
+        
+        df_submit[TARGET] = 0
+        for target, model in models.items():
+            df_submit_each_target = model.predict(df, s_type, df_submit[['id']].copy())
+            df_submit[TARGET] += df_submit_each_target[target]
+        
+        df_submit[['id', TARGET]].to_csv(out_path, mode='w' if n_chunk == 0 else 'a',
+                                         header=(n_chunk == 0), index=False)
+        n_rows += len(df_submit)
+        get_logger().info('predicted chunk %d (%d rows in total)' % (n_chunk, n_rows))
+        
+        del df, df_submit
+        gc.collect()
+    return n_rows
+
+if STREAM_PREDICT:
+    n_submit = predict_each_type_streaming(TEST_PATH, df_strct, 'submission.csv')
+else:
+    df_test = load_csv(TEST_PATH)
+    df_submit = predict_each_type(df_test, df_strct)
+    
+    display(df_submit.head())
+    df_submit[['id', TARGET]].to_csv('submission.csv', index=False)
+    n_submit = df_submit.shape[0]
+
+n_submit
+
+"""## Online scoring
+Score couplings of a single molecule without preprocess(): the same features
+are computed from the atoms, coordinates and bonds with NumPy, and the boosters
+and encoder are kept loaded.
+"""
+
+def normalize(x):
+    """
+    Parameters
+    ----------
+    x: np.ndarray
+    
+    Returns
+    -------
+    norm_vec: np.ndarray, shape of [n_samples, n_features]
+    norm: np.ndarray, shape of [n_samples, 1]
+    """
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / norm, norm
+
+def topological_distance(adj):
+    """
+    All-pairs shortest path (the number of bonds) of molecules in one vectorized sweep.
+    
+    Parameters
+    ----------
+    adj: np.ndarray of bool, shape [n_molecules, max_atoms, max_atoms]
+        padded adjacent matrices
+    
+    Returns
+    -------
+    topo: np.ndarray of int8, shape [n_molecules, max_atoms, max_atoms]
+        0 on the diagonal and -1 if the atoms are not connected (or padding).
+    """
+    n_mol, n_slot, _ = adj.shape
+    reach = np.broadcast_to(np.eye(n_slot, dtype=bool), adj.shape).copy()
+    topo = np.where(reach, 0, -1).astype(np.int8)
+    step = adj.astype(np.float32)
+    for n_bond in range(1, n_slot):
+        # breadth-first search from all atoms of all molecules at once
+        reached = (reach.astype(np.float32) @ step > 0) | reach
+        new = reached & ~reach
+        if not new.any():
+            break
+        topo[new] = n_bond
+        reach = reached
+    return topo
+
+def unique_member(is_in):
+    """
+    Parameters
+    ----------
+    is_in: np.ndarray of bool, shape [n_samples, n_atoms]
+    
+    Returns
+    -------
+    idx: np.ndarray, shape [n_samples]
+        the atom if exactly one atom is True in the row, otherwise -1.
+    """
+    return np.where(is_in.sum(axis=1) == 1, is_in.argmax(axis=1), -1)
+
+def molecule_features(atoms, coords, bonds, pairs, types=None):
+    """
+    Features of preprocess() (before encode()) for the couplings of a molecule.
+    
+    The features of a row depend on the other rows by feature_engineering(),
+    so `pairs` should be all the couplings of the molecule as in test.csv.
+    
+    Parameters
+    ----------
+    atoms: array-like object, shape [n_atoms]
+        element of each atom (e.g. 'C', 'H')
+    coords: array-like object, shape [n_atoms, 3]
+        x, y, z of each atom
+    bonds: array-like object, shape [n_bonds, 2]
+        atom indices of bonded atoms
+    pairs: array-like object, shape [n_pairs, 2]
+        atom_index_0 and atom_index_1 of couplings
+    types: None or array-like object, shape [n_pairs]
+        coupling type (e.g. 1JHC). If None, it is given by the number of bonds between the atoms.
+    
+    Returns
+    -------
+    feats: dict
+        {column: np.ndarray of shape [n_pairs]}
+    """
+    atoms = np.asarray(atoms, dtype=object)
+    n_atoms = len(atoms)
+    # the last row is NaN for missing atoms (-1) like StructureIndex
+    xyz = np.full((n_atoms + 1, 3), np.nan)
+    xyz[:-1] = np.asarray(coords, dtype=np.float64).reshape(n_atoms, 3)
+    atom = np.append(atoms, np.nan)
+    weight = np.array([atom_weight.get(a, np.nan) for a in atoms])
+    
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    adj = np.zeros((n_atoms, n_atoms), dtype=bool)
+    adj[bonds[:, 0], bonds[:, 1]] = True
+    adj[bonds[:, 1], bonds[:, 0]] = True
+    # the number of bonds between atoms like BondGraph.topological_distance
+    topo = topological_distance(adj[None])[0]
+    
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    idx0, idx1 = pairs[:, 0], pairs[:, 1]
+    n_pairs = len(pairs)
+    if types is None:
+        n_path = topo[idx0, idx1]
+        assert ((n_path >= 1) & (n_path <= 3)).all(), 'atoms of a pair must be within 3 bonds.'
+        types = ['%dJ%s%s' % t for t in zip(n_path, atoms[idx0], atoms[idx1])]
+    types = np.asarray(types, dtype=object)
+    
+    feats = {'type': types}
+    # map_atom_info
+    for k, idx in enumerate([idx0, idx1]):
+        feats['atom_%d' % k] = atom[idx]
+        for axis, name in enumerate(['x', 'y', 'z']):
+            feats['%s_%d' % (name, k)] = xyz[idx, axis]
+    # calc_dist
+    vec = xyz[idx0] - xyz[idx1]
+    feats['dist'] = np.linalg.norm(vec, axis=1)
+    for axis, name in enumerate(['x', 'y', 'z']):
+        feats['dist_%s' % name] = vec[:, axis] ** 2
+    # add_geometry_features
+    geo = atom_geometry(xyz[None, :-1], atoms[None])
+    for k, idx in enumerate([idx0, idx1]):
+        for name, val in geo.items():
+            feats['%s_%d' % (name, k)] = val[0, idx]
+    # divide_type
+    feats['type_0'] = np.array([t[0] for t in types], dtype=object)
+    feats['type_1'] = np.array([t[1:] for t in types], dtype=object)
+    n_bond = feats['type_0'].astype(np.int64)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # 1J (df_1j.pkl)
+        is_1j = (n_bond == 1)
+        nbr = adj[idx1].copy()
+        nbr[np.arange(n_pairs), idx0] = False
+        feats['1j_nbonds'] = np.where(is_1j, adj.sum(axis=1)[idx1], np.nan)
+        feats['neighbor_atoms'] = np.array([''.join(sorted(atoms[row])) if one else 'nan' 
+                                            for row, one in zip(nbr, is_1j)], dtype=object)
+        # NaN only if a bonded atom has no weight (nbr @ weight is NaN if any atom of the molecule has none)
+        feats['neighbor_weight'] = np.where(is_1j, np.where(nbr, weight, 0.).sum(axis=1), np.nan)
+        
+        # 2J (df_2jsim.pkl)
+        center = np.where(n_bond == 2, unique_member(adj[idx0] & adj[idx1]), -1)
+        vec_02 = xyz[center] - xyz[idx0]
+        vec_12 = xyz[center] - xyz[idx1]
+        _, area_021 = normalize(np.cross(-vec_02, -vec_12))
+        vec_02, norm_vec_02 = normalize(vec_02)
+        vec_12, norm_vec_12 = normalize(vec_12)
+        center_atom = atom[center]
+        feats['2j_atom_center'] = np.where(center >= 0, center_atom, 'nan').astype(object)
+        feats['2j_area_021'] = area_021[:, 0]
+        feats['2j_norm_vec_02'] = norm_vec_02[:, 0]
+        feats['2j_norm_vec_12'] = norm_vec_12[:, 0]
+        feats['2j_cos'] = (vec_02 * vec_12).sum(axis=1)
+        feats['2j_atom_center_weight'] = np.append(weight, np.nan)[center]
+        feats['2j_sum_norm_vec'] = feats['2j_norm_vec_02'] + feats['2j_norm_vec_12']
+        
+        # 3J (df_3jsim.pkl)
+        center0 = unique_member(adj[idx0] & (topo[idx1] == 2))
+        center1 = unique_member(adj[idx1] & (topo[idx0] == 2))
+        is_found = (n_bond == 3) & (center0 >= 0) & (center1 >= 0)
+        center0 = np.where(is_found, center0, -1)
+        center1 = np.where(is_found, center1, -1)
+        vec_02 = xyz[center0] - xyz[idx0]
+        vec_13 = xyz[center1] - xyz[idx1]
+        vec_23 = xyz[center1] - xyz[center0]
+        nvec_023, area_023 = normalize(np.cross(-vec_02, vec_23))
+        nvec_231, area_231 = normalize(np.cross(-vec_23, -vec_13))
+        vec_02, norm_vec_02 = normalize(vec_02)
+        vec_13, norm_vec_13 = normalize(vec_13)
+        vec_23, norm_vec_23 = normalize(vec_23)
+        feats['3j_norm_vec_02'] = norm_vec_02[:, 0]
+        feats['3j_norm_vec_13'] = norm_vec_13[:, 0]
+        feats['3j_norm_vec_23'] = norm_vec_23[:, 0]
+        feats['3j_cos_023'] = (vec_02 * -vec_23).sum(axis=1)
+        feats['3j_cos_231'] = (vec_23 * vec_13).sum(axis=1)
+        feats['3j_area_023'] = area_023[:, 0]
+        feats['3j_area_231'] = area_231[:, 0]
+        feats['3j_dihedral'] = (nvec_023 * nvec_231).sum(axis=1)
+        feats['3j_atom_center_weight'] = np.append(weight, np.nan)[center0] + np.append(weight, np.nan)[center1]
+        feats['3j_atom_center'] = np.array([str_sort(a0 + a1) if found else 'nan' 
+                                            for a0, a1, found in zip(atom[center0], atom[center1], is_found)], dtype=object)
+        feats['3j_sum_norm_vec'] = feats['3j_norm_vec_02'] + feats['3j_norm_vec_13'] + feats['3j_norm_vec_23']
+        
+        # feature_engineering
+        feats['id'] = np.zeros(n_pairs)
+        feats['atom_index_0'], feats['atom_index_1'] = idx0, idx1
+        key_codes = {}
+        for name, keys, col, stat, ops in FE_AGGS:
+            keys = tuple(key for key in keys if key != 'molecule_name')
+            if keys not in key_codes:
+                codes = np.zeros(n_pairs, dtype=np.int64)
+                for key in keys:
+                    _, k_codes = np.unique(feats[key], return_inverse=True)
+                    codes = codes * n_pairs + k_codes.ravel()
+                key_codes[keys] = np.unique(codes, return_inverse=True)[1].ravel()
+            seg = key_codes[keys]
+            x = feats[col].astype(np.float64)
+            count = np.bincount(seg)
+            if stat == 'count':
+                val = count
+            elif stat in ('mean', 'std'):
+                mean = np.bincount(seg, weights=x) / count
+                val = mean
+                if stat == 'std':
+                    dev = x - mean[seg]
+                    val = np.sqrt(np.bincount(seg, weights=dev * dev) / (count - 1))
+            elif stat == 'min':
+                val = np.full(len(count), np.inf)
+                np.minimum.at(val, seg, x)
+            elif stat == 'max':
+                val = np.full(len(count), -np.inf)
+                np.maximum.at(val, seg, x)
+            feats[name] = val[seg].astype(np.float64)
+            for op in ops:
+                if op == 'diff':
+                    feats[f'{name}_diff'] = feats[name] - x
+                elif op == 'div':
+                    feats[f'{name}_div'] = feats[name] / x
+        del feats['id'], feats['atom_index_0'], feats['atom_index_1']
+    return feats
+
+class MoleculeScorer:
+    """
+    Online scoring of a molecule with the boosters and encoder of ModelArtifact kept in memory.
+    """
+    def __init__(self, targets=(TARGET,), root=ARTIFACT_DIR, cntr_path=MID_MODEL_PATH):
+        self.artifacts = [ModelArtifact(target, root) for target in targets]
+        self.encoder = joblib.load(self.artifacts[0].encoder_path)
+        # load all boosters now
+        for artifact in self.artifacts:
+            for coup_type in artifact.types:
+                artifact.ensemble(coup_type)
+        self.cntr_ensembles = self.load_contributions(cntr_path)
+    
+    def load_contributions(self, cntr_path):
+        """
+        Ensembles of CNTR for the stacking features of add_scc_feature() ('<y_col>_pred')
+        of the types whose boosters use them (TRAIN_CONTRIBUTIONS).
+        
+        Returns
+        -------
+        ensembles: dict
+            {coupling type: [(pred_col, lgb.Booster, feature columns)]}
+        """
+        pred_cols = {}
+        for artifact in self.artifacts:
+            for coup_type in artifact.types:
+                cols = [col for col in artifact.features(coup_type) if col.endswith('_pred')]
+                pred_cols.setdefault(coup_type, set()).update(cols)
+        pred_cols = {coup_type: cols for coup_type, cols in pred_cols.items() if len(cols) > 0}
+        if len(pred_cols) == 0:
+            return {}
+        if not os.path.exists(cntr_path):
+            raise FileNotFoundError('the boosters use %s, but the contribution models %s are not found.' 
+                                    % (sorted(set.union(*pred_cols.values())), cntr_path))
+        
+        cntr = joblib.load(cntr_path)
+        ensembles = {}
+        for coup_type, cols in pred_cols.items():
+            missing = sorted(cols - set(cntr.pred_cols)) if coup_type in cntr.feature_dict else sorted(cols)
+            if len(missing) > 0:
+                raise ValueError('the contribution models %s have no %s of %s.' % (cntr_path, missing, coup_type))
+            ensembles[coup_type] = [('%s_pred' % y_col, merge_boosters(cntr.model_dict[y_col][coup_type]), 
+                                     cntr.feature_dict[coup_type]) for y_col in cntr.y_cols]
+        return ensembles
+    
+    def encode(self, feats):
+        """encode categorical features of molecule_features() in place"""
+        for cat_name in self.encoder.vocabs.keys():
+            feats[cat_name] = self.encoder.encode(cat_name, feats[cat_name])
+        return feats
+    
+    def score(self, atoms, coords, bonds, pairs, types=None):
+        """
+        Parameters
+        ----------
+        Same as molecule_features()
+        
+        Returns
+        -------
+        y_pred: np.ndarray, shape [n_pairs]
+            sum of the predictions of the targets
+        """
+        feats = molecule_features(atoms, coords, bonds, pairs, types)
+        type_names = feats['type']
+        feats = self.encode(feats)
+        
+        y_pred = np.zeros(len(type_names))
+        for coup_type in np.unique(type_names):
+            rows = (type_names == coup_type)
+            # stacking features of the type by the contribution models
+            for pred_col, ensemble, features in self.cntr_ensembles.get(coup_type, []):
+                X = np.column_stack([feats[col][rows] for col in features]).astype(np.float32)
+                feats.setdefault(pred_col, np.full(len(type_names), np.nan))[rows] = ensemble.predict(X, num_threads=1)
+            for artifact in self.artifacts:
+                X = np.column_stack([feats[col][rows] for col in artifact.features(coup_type)]).astype(np.float32)
+                y_pred[rows] += artifact.ensemble(coup_type).predict(X, num_threads=1)
+        return y_pred
 
-display(df_submit.head())
-df_submit[['id', TARGET]].to_csv('submission.csv', index=False)
+scorer_ = None
 
-df_submit.shape
+def score_molecule(atoms, coords, bonds, pairs, types=None):
+    """
+    Predict scalar_coupling_constant of couplings of a molecule.
+    The boosters are loaded on the first call and kept.
+    
+    Parameters
+    ----------
+    Same as molecule_features()
+    
+    Returns
+    -------
+    y_pred: np.ndarray, shape [n_pairs]
+    """
+    global scorer_
+    if scorer_ is None:
+        scorer_ = MoleculeScorer()
+    return scorer_.score(atoms, coords, bonds, pairs, types)
 
+def molecule_inputs(df, strct, df_bonds):
+    """
+    Yield arguments of score_molecule() for each molecule in df.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        e.g. test.csv
+    strct: StructureIndex
+    df_bonds: pd.DataFrame
+        df_bonds must have 'molecule_name', 'atom_index_0', 'atom_index_1'
+    """
+    bond_rows = df_bonds.groupby('molecule_name').indices
+    bond_idx = df_bonds[['atom_index_0', 'atom_index_1']].values
+    pair_idx = df[['atom_index_0', 'atom_index_1']].values
+    types = df['type'].values
+    for mole_name, rows in df.groupby('molecule_name', sort=False).indices.items():
+        m = strct.mol_names.get_loc(mole_name)
+        start, end = strct.atom_offset[m], strct.atom_offset[m + 1]
+        bonds = bond_idx[bond_rows.get(mole_name, [])]
+        yield strct.atom[start:end], strct.xyz[start:end], bonds, pair_idx[rows], types[rows]
+
+def benchmark_score_molecule(scorer, inputs, n_warmup=10):
+    """
+    Latency of MoleculeScorer.score() per molecule.
+    
+    Parameters
+    ----------
+    inputs: list of tuple
+        output of molecule_inputs()
+    
+    Returns
+    -------
+    ret: dict
+        the number of molecules, p50, p99 and mean of the latency in milliseconds
+    """
+    for args in inputs[:n_warmup]:
+        scorer.score(*args)
+    
+    latency = np.empty(len(inputs))
+    for i, args in enumerate(inputs):
+        start = time.perf_counter()
+        scorer.score(*args)
+        latency[i] = (time.perf_counter() - start) * 1000
+    return {'n_molecules': len(inputs), 
+            'p50_ms': float(np.percentile(latency, 50)), 
+            'p99_ms': float(np.percentile(latency, 99)), 
+            'mean_ms': float(latency.mean())}
+
+if RUN_SCORE_BENCHMARK:
+    df_test = load_csv(TEST_PATH)
+    df_bonds = load_csv(PREPROCESS + 'test_bonds.csv')
+    scorer = MoleculeScorer()
+    inputs = list(itertools.islice(molecule_inputs(df_test, df_strct, df_bonds), 1000))
+    print(benchmark_score_molecule(scorer, inputs))
+
+"""## Stage summary"""
+
+df_stage = stage_summary()
+get_logger().info('stage summary:\n%s' % df_stage.to_string())
+df_stage
@@ -16,6 +16,7 @@ drive.mount('/gdrive')
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import seaborn as sns
 
 from sklearn.base import clone
@@ -26,6 +27,9 @@ import math
 
 from tqdm import tqdm
 import joblib
+import os
+import json
+import hashlib
 
 """## config"""
 
@@ -35,9 +39,25 @@ TEST_PATH = INPUT + 'test.csv'
 PREPROCESS = './analysis/mole/data/preprocess/'
 
 RUN_PLOT = False
+# use int32 id (e.g. 1) instead of molecule_name (e.g. 'dsgdb9nsd_000001')
+INT_MOLECULE_ID = True
+MOLECULE_PREFIX = 'dsgdb9nsd_'
+# raw csv files are converted to .npy columns on the first read and memory-mapped afterwards
+USE_CSV_CACHE = True
+CSV_CACHE_DIR = PREPROCESS + 'csv_cache/'
+# dtypes of the columns of the raw csv files (the targets keep float64)
+CSV_DTYPES = {
+    'id': np.int32, 'molecule_name': 'category', 'type': 'category', 'atom': 'category',
+    'atom_index': np.int8, 'atom_index_0': np.int8, 'atom_index_1': np.int8,
+    'x': np.float32, 'y': np.float32, 'z': np.float32,
+    'scalar_coupling_constant': np.float64,
+    'fc': np.float64, 'sd': np.float64, 'pso': np.float64, 'dso': np.float64,
+}
 TARGET = 'scalar_coupling_constant'
 N_FOLDS = 4
 ATOM_W = {'H': 1.008, 'C': 12.01, 'N': 14.01, 'O': 16.00}
+# elements of QM9 (sorted)
+ELEMENTS = ['C', 'F', 'H', 'N', 'O']
 
 """## logging"""
 
@@ -67,6 +87,109 @@ def get_logger():
 
 """## util"""
 
+def encode_molecule_name(df):
+    """
+    Convert 'molecule_name' (e.g. 'dsgdb9nsd_000001') to int32 id (e.g. 1) in place.
+    It does nothing if 'molecule_name' is already converted.
+    """
+    if not pd.api.types.is_integer_dtype(df['molecule_name']):
+        df['molecule_name'] = df['molecule_name'].str[len(MOLECULE_PREFIX):].astype(np.int32)
+    return df
+
+def decode_molecule_name(mole_id):
+    """
+    Inverse of encode_molecule_name.
+    
+    Parameters
+    ----------
+    mole_id: array-like object, shape [n_samples]
+    
+    Returns
+    -------
+    mole_name: pd.Series, shape [n_samples]
+    """
+    return MOLECULE_PREFIX + pd.Series(mole_id).astype(str).str.zfill(6)
+
+def csv_dtypes(path, usecols=None):
+    """CSV_DTYPES of the columns of a csv file"""
+    columns = pd.read_csv(path, nrows=0).columns
+    return {col: CSV_DTYPES[col] for col in columns
+            if col in CSV_DTYPES and (usecols is None or col in usecols)}
+
+def read_csv(path, usecols=None, **kwargs):
+    """
+    pd.read_csv with CSV_DTYPES converting 'molecule_name' to int id if INT_MOLECULE_ID is True.
+    String columns not in CSV_DTYPES are read as category.
+    """
+    df = pd.read_csv(path, usecols=usecols, dtype=csv_dtypes(path, usecols), **kwargs)
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col].dtype):
+            df[col] = df[col].astype('category')
+    if INT_MOLECULE_ID and 'molecule_name' in df.columns:
+        df = encode_molecule_name(df)
+    return df
+
+def csv_cache_dir(path):
+    """directory of the binary cache of a csv file. It changes when the file or the dtypes change."""
+    st = os.stat(path)
+    key = hashlib.sha1(repr((os.path.abspath(path), st.st_mtime_ns, st.st_size,
+                             sorted(CSV_DTYPES.items()), INT_MOLECULE_ID)).encode()).hexdigest()
+    return os.path.join(CSV_CACHE_DIR, '%s_%s' % (os.path.basename(path), key[:16]))
+
+def load_csv(path, usecols=None, cache=USE_CSV_CACHE, **kwargs):
+    """
+    read_csv() with a binary cache.
+    
+    On the first read, each column is saved as <CSV_CACHE_DIR>/<file>_<key>/<column>.npy
+    (category as int codes and the categories in meta.json).
+    Later loads memory-map the files (copy-on-write), so they are fast and
+    the pages are shared between processes.
+    
+    Parameters
+    ----------
+    path: str
+    usecols: None or list of str
+        columns to load. Columns not in the cache yet are read from the csv and added.
+    cache: bool
+        If False or kwargs are given, the csv is read without the cache.
+    kwargs:
+        other arguments of pd.read_csv
+    """
+    if not cache or kwargs:
+        return read_csv(path, usecols=usecols, **kwargs)
+    
+    cache_dir = csv_cache_dir(path)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    else:
+        meta = {'columns': pd.read_csv(path, nrows=0).columns.tolist(), 'categories': {}}
+    # in the order of the csv
+    columns = [col for col in meta['columns'] if usecols is None or col in usecols]
+    
+    missing = [col for col in columns if not os.path.exists(os.path.join(cache_dir, col + '.npy'))]
+    if missing:
+        get_logger().info('convert %s to %s' % (path, cache_dir))
+        df = read_csv(path, usecols=missing)
+        os.makedirs(cache_dir, exist_ok=True)
+        for col in missing:
+            values = df[col].values
+            if isinstance(values, pd.Categorical):
+                meta['categories'][col] = values.categories.tolist()
+                values = values.codes
+            np.save(os.path.join(cache_dir, col + '.npy'), np.asarray(values))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    
+    data = {}
+    for col in columns:
+        values = np.load(os.path.join(cache_dir, col + '.npy'), mmap_mode='c')
+        if col in meta['categories']:
+            values = pd.Categorical.from_codes(values, meta['categories'][col])
+        data[col] = values
+    return pd.DataFrame(data, copy=False)
+
 def onehot(_df):
     cat_names = [name for name, col in _df.iteritems() if col.dtype == 'O']
     df_cat = pd.get_dummies(_df[cat_names])
@@ -112,21 +235,88 @@ def reduce_mem_usage(df, verbose=True):
     
     return df
 
-def divide_type(df):    
-    df['type_0'] = df['type'].apply(lambda x: x[0]).astype(np.uint8)
-    df['type_1'] = df['type'].apply(lambda x: x[1:])
+def relabel(codes, labels):
+    """
+    pd.Categorical of `labels[codes]` built from the few labels instead of every row.
+    
+    Parameters
+    ----------
+    codes: np.ndarray, shape [n_samples]
+        -1 for NaN
+    labels: array-like object, shape [n_labels]
+        label of each code. labels can be duplicated.
+    """
+    categories, label_codes = np.unique(np.asarray(labels, dtype=object), return_inverse=True)
+    return pd.Categorical.from_codes(np.append(label_codes.ravel(), -1)[codes], categories)
+
+def divide_type(df):
+    # split the few distinct types instead of every row
+    codes, uniques = pd.factorize(df['type'])
+    df['type_0'] = relabel(codes, [t[0] for t in uniques])
+    df['type_1'] = relabel(codes, [t[1:] for t in uniques])
     return df
 
+class StructureIndex:
+    """
+    structures.csv as flat arrays for gathering atoms by integer indexing.
+    
+    The atom `i` of the molecule `m` is at `atom_offset[m] + i` of `xyz` and `atom`.
+    The last row of `xyz` and `atom` is NaN for missing atoms (e.g. index -1).
+    """
+    def __init__(self, strct):
+        """
+        Parameters
+        ----------
+        strct: pd.DataFrame
+            dataframe of structures.csv
+        """
+        strct = strct.sort_values(['molecule_name', 'atom_index'])
+        mol_codes, mol_names = pd.factorize(strct['molecule_name'], sort=True)
+        self.mol_names = pd.Index(mol_names)
+        self.n_atoms = np.bincount(mol_codes)
+        self.atom_offset = np.zeros(len(mol_names) + 1, dtype=np.int64)
+        self.atom_offset[1:] = np.cumsum(self.n_atoms)
+        assert (strct['atom_index'].values == np.arange(len(strct)) - self.atom_offset[mol_codes]).all(), \
+            'atom_index must be 0, 1, 2, ... in each molecule.'
+        
+        self.xyz = np.empty((len(strct) + 1, 3), dtype=np.float64)
+        self.xyz[:-1] = strct[['x', 'y', 'z']].values
+        self.xyz[-1] = np.nan
+        self.atom = np.append(strct['atom'].values.astype(object), np.nan)
+    
+    def pos(self, mole_name, atom_idx):
+        """
+        Parameters
+        ----------
+        mole_name: array-like object, shape [n_samples]
+        atom_idx: array-like object, shape [n_samples]
+        
+        Returns
+        -------
+        pos: np.ndarray, shape [n_samples]
+            row of `xyz` and `atom`. -1 (NaN row) if the atom does not exist.
+        """
+        mol_codes = self.mol_names.get_indexer(np.asarray(mole_name))
+        atom_idx = np.asarray(atom_idx)
+        is_valid = (mol_codes >= 0) & (atom_idx >= 0) & (atom_idx < self.n_atoms[mol_codes])
+        return np.where(is_valid, self.atom_offset[mol_codes] + atom_idx, -1)
+
 def map_atom_info(df, strct, atom_idx):
-    df = pd.merge(df, strct, how = 'left',
-                  left_on  = ['molecule_name', f'atom_index_{atom_idx}'],
-                  right_on = ['molecule_name',  'atom_index'])
-    
-    df = df.drop('atom_index', axis=1)
-    df = df.rename(columns={'atom': f'atom_{atom_idx}',
-                            'x': f'x_{atom_idx}',
-                            'y': f'y_{atom_idx}',
-                            'z': f'z_{atom_idx}'})
+    """
+    Add `atom_{atom_idx}`, `x_{atom_idx}`, `y_{atom_idx}`, `z_{atom_idx}` to df in place.
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_{atom_idx}'
+    strct: StructureIndex
+    atom_idx: int
+    """
+    pos = strct.pos(df['molecule_name'].values, df[f'atom_index_{atom_idx}'].values)
+    df[f'atom_{atom_idx}'] = strct.atom[pos]
+    df[f'x_{atom_idx}'] = strct.xyz[pos, 0]
+    df[f'y_{atom_idx}'] = strct.xyz[pos, 1]
+    df[f'z_{atom_idx}'] = strct.xyz[pos, 2]
     return df
 
 def calc_dist(df):
@@ -142,7 +332,7 @@ def calc_dist(df):
 
 """## EDA + Preprocess"""
 
-df_train = pd.read_csv(TRAIN_PATH)
+df_train = load_csv(TRAIN_PATH)
 df_train = divide_type(df_train)
 
 df_train['type'].unique()
@@ -166,17 +356,19 @@ if RUN_PLOT:
 - idea: clasify above 50 or under 50.
 """
 
-df_strct = pd.read_csv(INPUT + 'structures.csv')
+df_strct = load_csv(INPUT + 'structures.csv')
 df_strct.head(10)
 
+strct_index = StructureIndex(df_strct)
+
 # the number of molecules
 len(df_strct['molecule_name'].unique())
 
 # max of the number of atoms in a molecule
 df_strct['atom_index'].max()
 
-# df_train = map_atom_info(df_train, df_strct, 0)
-# df_train = map_atom_info(df_train, df_strct, 1)
+# df_train = map_atom_info(df_train, strct_index, 0)
+# df_train = map_atom_info(df_train, strct_index, 1)
 # df_train = calc_dist(df_train)
 
 if RUN_PLOT:
@@ -197,7 +389,7 @@ if RUN_PLOT:
     plt.subplot(1, 2, 1)
     sns.barplot(data=count_type, x='type', y='id')
 
-    df_test = pd.read_csv(TEST_PATH)
+    df_test = load_csv(TEST_PATH)
     count_type = df_test.groupby(by='type')['id'].count().reset_index()
     plt.subplot(1, 2, 2)
     sns.barplot(data=count_type, x='type', y='id')
@@ -248,7 +440,7 @@ plt.subplot(1, 3, 3)
 sns.distplot(df_train[df_train['type']=='3JHN'][TARGET])
 text = plt.title('3JHN')
 
-# df_scc = pd.read_csv(INPUT + 'scalar_coupling_contributions.csv')
+# df_scc = load_csv(INPUT + 'scalar_coupling_contributions.csv')
 # df_scc.head()
 
 def plot_scc(df, type_name):
@@ -285,8 +477,8 @@ if RUN_PLOT:
 """## calculate angel"""
 
 # merge train and test set
-df_train = pd.read_csv(TRAIN_PATH)
-df_test = pd.read_csv(TEST_PATH)
+df_train = load_csv(TRAIN_PATH)
+df_test = load_csv(TEST_PATH)
 
 df_all = pd.concat([df_train, df_test], axis=0, ignore_index=True)
 df_all = df_all[df_train.columns]
@@ -295,8 +487,8 @@ display(df_all.head())
 display(df_all.tail())
 
 def read_bonds():
-    train_bond = pd.read_csv(PREPROCESS + 'train_bonds.csv')
-    test_bond = pd.read_csv(PREPROCESS + 'test_bonds.csv')
+    train_bond = load_csv(PREPROCESS + 'train_bonds.csv')
+    test_bond = load_csv(PREPROCESS + 'test_bonds.csv')
     
     df = pd.concat([train_bond, test_bond], axis=0, ignore_index=True)
     df.drop(['Unnamed: 0', 'L2dist'], axis=1, inplace=True)
@@ -309,13 +501,13 @@ df_bonds = read_bonds()
 display(df_bonds.head())
 display(df_bonds.tail())
 
-df_1j = df_all[df_all['type_0'] == 1]
+df_1j = df_all[df_all['type_0'] == '1']
 display(df_1j.head())
 
-df_2j = df_all[df_all['type_0'] == 2]
+df_2j = df_all[df_all['type_0'] == '2']
 display(df_2j.head())
 
-df_3j = df_all[df_all['type_0'] == 3]
+df_3j = df_all[df_all['type_0'] == '3']
 display(df_3j.head())
 
 """## get adjacent matrix"""
@@ -374,12 +566,243 @@ def get_adjacent_mat_old(df):
     mat += mat.transpose(1, 0)
     return mat
 
-# groups = df_bonds.groupby('molecule_name')
-# groups.__iter__ returns (name, df_group)
-# adj_mat = {g[0]: get_adjacent_mat(g[1])  for g in tqdm(groups)}
+"""## bond graph
+All molecules are packed into one CSR graph instead of a dict of dense adjacent matrices.
+"""
 
-adj_mat = joblib.load(PREPROCESS + 'adj_mat.pkl')
-adj_mat2 = {name: np.matmul(mat, mat) for name, mat in adj_mat.items()}
+def topological_distance(adj):
+    """
+    All-pairs shortest path (the number of bonds) of molecules in one vectorized sweep.
+    
+    Parameters
+    ----------
+    adj: np.ndarray of bool, shape [n_molecules, max_atoms, max_atoms]
+        padded adjacent matrices
+    
+    Returns
+    -------
+    topo: np.ndarray of int8, shape [n_molecules, max_atoms, max_atoms]
+        0 on the diagonal and -1 if the atoms are not connected (or padding).
+    """
+    n_mol, n_slot, _ = adj.shape
+    reach = np.broadcast_to(np.eye(n_slot, dtype=bool), adj.shape).copy()
+    topo = np.where(reach, 0, -1).astype(np.int8)
+    step = adj.astype(np.float32)
+    for n_bond in range(1, n_slot):
+        # breadth-first search from all atoms of all molecules at once
+        reached = (reach.astype(np.float32) @ step > 0) | reach
+        new = reached & ~reach
+        if not new.any():
+            break
+        topo[new] = n_bond
+        reach = reached
+    return topo
+
+class BondGraph:
+    """
+    Bond graph of all molecules packed into global CSR arrays.
+
+    The atom `i` of the molecule `m` is the node `atom_offset[m] + i`.
+    Neighbors of the node `v` are `indices[indptr[v]:indptr[v+1]]`
+    and their bond orders are `nbond[indptr[v]:indptr[v+1]]`.
+    """
+    def __init__(self, mol_names, atom_offset, indptr, indices, nbond):
+        """
+        Parameters
+        ----------
+        mol_names: pd.Index
+            sorted molecule names. position in it is the molecule code.
+        atom_offset: np.ndarray, shape [n_molecules + 1]
+        indptr: np.ndarray, shape [n_nodes + 1]
+        indices: np.ndarray, shape [n_edges]
+        nbond: np.ndarray, shape [n_edges]
+        """
+        self.mol_names = mol_names
+        self.atom_offset = atom_offset
+        self.indptr = indptr
+        self.indices = indices
+        self.nbond = nbond
+
+        n_nodes = len(indptr) - 1
+        self.node_mol = np.repeat(np.arange(len(mol_names), dtype=np.int32), np.diff(atom_offset))
+
+        # padded neighbor table, shape [n_nodes + 1, max_degree].
+        # -1 is padding and the last row is all -1,
+        # so that nbr[-1] (neighbors of padding) is padding again.
+        degree = np.diff(indptr)
+        max_degree = max(degree.max(), 1) if n_nodes > 0 else 1
+        src = np.repeat(np.arange(n_nodes), degree)
+        pos = np.arange(len(indices)) - indptr[src]
+        self.nbr = np.full((n_nodes + 1, max_degree), -1, dtype=np.int32)
+        self.nbr[src, pos] = indices
+
+    @classmethod
+    def from_bonds(cls, df_bonds, n_atoms=None):
+        """
+        Build the graph in one vectorized pass.
+
+        Parameters
+        ----------
+        df_bonds: pd.DataFrame
+            output of read_bonds().
+            df_bonds must have 'molecule_name', 'atom_index_0', 'atom_index_1', 'nbond'
+        n_atoms: None or pd.Series
+            the number of atoms in each molecule, indexed by molecule_name.
+            If None, max of atom index in df_bonds + 1 is used.
+        """
+        if n_atoms is None:
+            mol_codes, mol_names = pd.factorize(df_bonds['molecule_name'], sort=True)
+            mol_names = pd.Index(mol_names)
+            idx_max = np.maximum(df_bonds['atom_index_0'].values, df_bonds['atom_index_1'].values)
+            n_atoms = np.zeros(len(mol_names), dtype=np.int64)
+            np.maximum.at(n_atoms, mol_codes, idx_max + 1)
+        else:
+            n_atoms = n_atoms.sort_index()
+            mol_names = n_atoms.index
+            mol_codes = mol_names.get_indexer(df_bonds['molecule_name'])
+            assert (mol_codes >= 0).all(), 'df_bonds has molecules not in n_atoms.'
+            n_atoms = n_atoms.values.astype(np.int64)
+
+        atom_offset = np.zeros(len(mol_names) + 1, dtype=np.int64)
+        atom_offset[1:] = np.cumsum(n_atoms)
+        n_nodes = atom_offset[-1]
+
+        # a bond is an undirected edge, so store both directions
+        node0 = atom_offset[mol_codes] + df_bonds['atom_index_0'].values
+        node1 = atom_offset[mol_codes] + df_bonds['atom_index_1'].values
+        src = np.concatenate([node0, node1])
+        dst = np.concatenate([node1, node0])
+        nbond = np.tile(df_bonds['nbond'].values.astype(np.float32), 2)
+
+        order = np.lexsort((dst, src))
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src, minlength=n_nodes))
+
+        return cls(mol_names, atom_offset, indptr, dst[order].astype(np.int32), nbond[order])
+
+    def node(self, mole_name, atom_idx):
+        """
+        Parameters
+        ----------
+        mole_name: array-like object, shape [n_samples]
+        atom_idx: array-like object, shape [n_samples]
+
+        Returns
+        -------
+        node: np.ndarray, shape [n_samples]
+            global node index
+        """
+        mol_codes = self.mol_names.get_indexer(np.asarray(mole_name))
+        return self.atom_offset[mol_codes] + np.asarray(atom_idx)
+
+    def atom_index(self, node):
+        """Inverse of node(). -1 (padding) stays -1."""
+        node = np.asarray(node)
+        ret = node - self.atom_offset[self.node_mol[node]]
+        return np.where(node < 0, -1, ret)
+
+    def degree(self, node):
+        """the number of bonded atoms"""
+        node = np.asarray(node)
+        return self.indptr[node + 1] - self.indptr[node]
+
+    def neighbors(self, node):
+        """
+        1-hop query.
+
+        Returns
+        -------
+        nbr: np.ndarray, shape [n_samples, max_degree]
+            neighbor nodes padded with -1
+        """
+        return self.nbr[np.asarray(node)]
+
+    def neighbors2(self, node):
+        """
+        2-hop query, i.e. nodes reached by a walk with two bonds.
+        Like square of the adjacent matrix, it includes the node itself.
+
+        Returns
+        -------
+        nbr2: np.ndarray, shape [n_samples, max_degree**2]
+            padded with -1
+        """
+        nbr2 = self.nbr[self.nbr[np.asarray(node)]]
+        return nbr2.reshape(nbr2.shape[0], -1)
+
+    def to_dense(self, mole_name):
+        """dense adjacent matrix of a molecule (same as get_adjacent_mat) for debugging"""
+        m = self.mol_names.get_loc(mole_name)
+        start, end = self.atom_offset[m], self.atom_offset[m + 1]
+        mat = np.zeros((end - start, end - start), dtype=np.float32)
+        for v in range(start, end):
+            p, q = self.indptr[v], self.indptr[v + 1]
+            mat[v - start, self.indices[p:q] - start] = self.nbond[p:q]
+        return mat
+
+    def topological_distance(self, batch_size=10000):
+        """
+        The number of bonds on the shortest path between atoms of each molecule.
+        It is computed at the first call and kept in the graph.
+        
+        Parameters
+        ----------
+        batch_size: int
+            the number of molecules swept at once (bounds the memory)
+        
+        Returns
+        -------
+        topo: np.ndarray of int8, shape [n_molecules, max_atoms, max_atoms]
+            `topo[m, i, j]` is between the atoms `i` and `j` of the molecule `m`.
+            0 on the diagonal and -1 if the atoms are not connected (or padding).
+        """
+        if getattr(self, 'topo_', None) is None:
+            n_atoms = np.diff(self.atom_offset)
+            n_slot = n_atoms.max() if len(n_atoms) else 0
+            src = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+            src_mol = self.node_mol[src]
+            src_atom = src - self.atom_offset[src_mol]
+            dst_atom = self.indices - self.atom_offset[src_mol]
+            
+            self.topo_ = np.empty((len(n_atoms), n_slot, n_slot), dtype=np.int8)
+            edge_start = np.searchsorted(src_mol, np.arange(0, len(n_atoms) + batch_size, batch_size))
+            for b, start in enumerate(range(0, len(n_atoms), batch_size)):
+                stop = min(start + batch_size, len(n_atoms))
+                e = slice(edge_start[b], edge_start[b + 1])
+                adj = np.zeros((stop - start, n_slot, n_slot), dtype=bool)
+                adj[src_mol[e] - start, src_atom[e], dst_atom[e]] = True
+                topo = topological_distance(adj)
+                is_pad = np.arange(n_slot) >= n_atoms[start:stop, None]
+                topo[is_pad[:, :, None] | is_pad[:, None, :]] = -1
+                self.topo_[start:stop] = topo
+        return self.topo_
+
+    def bonds_between(self, node0, node1):
+        """
+        The number of bonds on the shortest path between nodes of the same molecule.
+
+        Returns
+        -------
+        n_bonds: np.ndarray of int8, shape [n_samples]
+            -1 if the nodes are not connected.
+        """
+        node0, node1 = np.asarray(node0), np.asarray(node1)
+        mol = self.node_mol[node0]
+        return self.topological_distance()[mol, node0 - self.atom_offset[mol], node1 - self.atom_offset[mol]]
+
+n_atoms = pd.Series(strct_index.n_atoms, index=strct_index.mol_names)
+bond_graph = BondGraph.from_bonds(df_bonds, n_atoms)
+# the number of bonds between atoms of each molecule (kept in bond_graph.pkl)
+topo = bond_graph.topological_distance()
+joblib.dump(bond_graph, PREPROCESS + 'bond_graph.pkl')
+
+# coupling type nJ must be n bonds apart
+node0 = bond_graph.node(df_all['molecule_name'].values, df_all['atom_index_0'].values)
+node1 = bond_graph.node(df_all['molecule_name'].values, df_all['atom_index_1'].values)
+df_all['n_bonds_between'] = bond_graph.bonds_between(node0, node1)
+display(df_all.loc[df_all['type_0'].astype(np.int64) != df_all['n_bonds_between'], ['molecule_name', 'atom_index_0', 'atom_index_1', 'type', 'n_bonds_between']])
+
+# bond_graph = joblib.load(PREPROCESS + 'bond_graph.pkl')
 
 # TODO: bug fix
 display(df_2j[df_2j.index==104493])
@@ -390,23 +813,22 @@ display(df_2j[df_2j.index==104493])
 1JHC is correlated with the hybridization of the C-H bonding orbital. sp3 sp2 sp
 """
 
-def trans_bonds(s, adjacent_matrix):
+def trans_bonds(df, graph):
     """
     Get the number of bonds of C or N from atom index.
     
     Parameters
     ----------
-    s: pd.Series
-        s must have 'molecule_name', 'atom_index_1'
-    adjacent_matrix: dict
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_1'
+    graph: BondGraph
     """
-    mole_name = s['molecule_name']
-    idx = s['atom_index_1']
-    n_bonds = (adjacent_matrix[mole_name][:, idx] > 0).sum()
+    node = graph.node(df['molecule_name'].values, df['atom_index_1'].values)
+    n_bonds = graph.degree(node)
     
     return n_bonds
 
-def some_1j(df_1j, strct, adjacent_matrix):
+def some_1j(df_1j, strct, graph):
     # get atom string(e.g., 'C') from atom_index
     df_1j = map_atom_info(df_1j, strct, 0)
     df_1j = map_atom_info(df_1j, strct, 1)
@@ -414,7 +836,7 @@ def some_1j(df_1j, strct, adjacent_matrix):
     
     assert (df_1j['atom_1']!='H').sum() == df_1j.shape[0], 'atom_index_1 is not an index column of C or N.'
 
-    df_1j['1j_nbonds'] = df_1j[['molecule_name', 'atom_index_1']].apply(trans_bonds, axis=1, adjacent_matrix=adjacent_matrix)
+    df_1j['1j_nbonds'] = trans_bonds(df_1j, graph)
     
     ret = df_1j[['molecule_name', 'atom_index_0', 'atom_index_1', '1j_nbonds']]
     display(ret.head())
@@ -424,54 +846,107 @@ assert (df_1j['atom_1']!='H').sum() == df_1j.shape[0], 'atom_index_1 is not an i
 
 df_1j.head()
 
-def trans_bonds(s, adjacent_matrix):
+def trans_bonds(df, graph):
     """
     Get the number of bonds of C or N from atom index.
     
     Parameters
     ----------
-    s: pd.Series
-        s must have 'molecule_name', 'atom_index_1'
-    adjacent_matrix: dict
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_1'
+    graph: BondGraph
     """
-    mole_name = s['molecule_name']
-    idx = s['atom_index_1']
-    n_bonds = (adjacent_matrix[mole_name][:, idx] > 0).sum()
+    node = graph.node(df['molecule_name'].values, df['atom_index_1'].values)
+    n_bonds = graph.degree(node)
     
     return n_bonds
 
-df_1j['1j_nbonds'] = df_1j[['molecule_name', 'atom_index_1']].apply(trans_bonds, axis=1, adjacent_matrix=adj_mat)
-
-"""%%time
-def add_neighbor_atoms(s, groups, adjacent_matrix):
-    # print(s)
-    cn_idx = s['atom_index_1']
-    h_idx = s['atom_index_0']
-    mole_name = s['molecule_name']
-    # print(h_idx)
-    # print(cn_idx)
+def neighbor_composition(graph, strct, elements=ELEMENTS, weights=ATOM_W):
+    """
+    Composition of the bonded atoms of every atom,
+    given by sparse products of the bond matrix of all molecules.
+    
+    Parameters
+    ----------
+    graph: BondGraph
+        built with the atoms of `strct`
+    strct: StructureIndex
+    elements: list of str
+        sorted elements, so that neighbor_atoms is sorted like ''.join(sorted(atoms))
+    weights: dict
+        atomic weight of each element. NaN for the other elements.
+    
+    Returns
+    -------
+    comp: pd.DataFrame, shape [n_nodes + 1, n_elements + 3]
+        indexed by node. the last row (node -1) is NaN.
+        'n_{element}': the number of bonded atoms of the element
+        'n_bonded': the number of bonded atoms
+        'bond_order': sum of bond orders
+        'neighbor_weight': sum of atomic weights of bonded atoms
+    """
+    assert np.array_equal(graph.atom_offset, strct.atom_offset), 'graph and strct must have the same atoms.'
+    n_nodes = len(graph.indptr) - 1
     
-    neighbor_tf = adjacent_matrix[mole_name][cn_idx] > 0
-    neighbor_tf[h_idx] = False
+    # bond matrix [n_nodes, n_nodes] x one-hot element [n_nodes, n_elements]
+    bond = sp.csr_matrix((np.ones(len(graph.indices)), graph.indices, graph.indptr), shape=(n_nodes, n_nodes))
+    order = sp.csr_matrix((graph.nbond.astype(np.float64), graph.indices, graph.indptr), shape=(n_nodes, n_nodes))
+    el_code = pd.Index(elements).get_indexer(strct.atom[:-1])
+    is_known = (el_code >= 0)
+    onehot = sp.csr_matrix((np.ones(is_known.sum()), (np.where(is_known)[0], el_code[is_known])),
+                           shape=(n_nodes, len(elements)))
+    counts = (bond @ onehot).toarray()
     
-    # print(neighbor_tf)
+    comp = pd.DataFrame(counts, columns=[f'n_{e}' for e in elements])
+    comp['n_bonded'] = graph.degree(np.arange(n_nodes))
+    comp['bond_order'] = order @ np.ones(n_nodes)
+    # bonded atoms of the other elements make NaN like sum(weights[c] for c in atoms)
+    comp['neighbor_weight'] = (bond @ np.array([weights.get(a, np.nan) for a in strct.atom[:-1]]))
+    comp = comp.reindex(np.arange(n_nodes + 1))
+    comp.index = np.append(np.arange(n_nodes), -1)
+    return comp
+
+def get_1j_features(df, graph, strct, comp, weights=ATOM_W):
+    """
+    Gather '1j_nbonds', 'neighbor_atoms' and 'neighbor_weight' of atom_index_1
+    (without atom_index_0) from neighbor_composition().
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_0', 'atom_index_1'
+    graph: BondGraph
+    strct: StructureIndex
+    comp: pd.DataFrame
+        output of neighbor_composition()
+    weights: dict
+    """
+    node0 = graph.node(df['molecule_name'].values, df['atom_index_0'].values)
+    node1 = graph.node(df['molecule_name'].values, df['atom_index_1'].values)
+    n_cols = [c for c in comp.columns if c.startswith('n_') and c != 'n_bonded']
+    elements = np.array([c[2:] for c in n_cols], dtype=object)
+    # node is the row of strct since graph and strct have the same atoms
+    atom0 = strct.atom[node0]
     
-    mole_group = mole_groups.get_group(mole_name)
-    neighbor_atoms = mole_group.loc[neighbor_tf, 'atom']
-    neighbor_atoms.values.sort()
-    neighbor_atoms_str = ''.join(neighbor_atoms)
+    # bonded atoms of atom_index_1 except atom_index_0
+    counts = comp[n_cols].values[node1].astype(np.int64) - (atom0[:, None] == elements)
     
-    # print(neighbor_atoms_str)
-    return neighbor_atoms_str
+    ret = df[['molecule_name', 'atom_index_0', 'atom_index_1']].copy()
+    ret['1j_nbonds'] = comp['n_bonded'].values[node1]
+    # a string for each distinct composition, e.g. [2, 0, 1, 0, 0] -> 'CCH'
+    uniq, inverse = np.unique(counts, axis=0, return_inverse=True)
+    names = np.array([''.join(e * n for e, n in zip(elements, row)) for row in uniq], dtype=object)
+    ret['neighbor_atoms'] = names[inverse.ravel()]
+    ret['neighbor_weight'] = comp['neighbor_weight'].values[node1] - pd.Series(atom0).map(weights).values
+    return ret
 
-mole_groups = df_strct.groupby(by='molecule_name')
-df_1j['neighbor_atoms'] = df_1j[['molecule_name', 'atom_index_0', 'atom_index_1']].apply(add_neighbor_atoms, groups=mole_groups, adjacent_matrix=adj_mat, axis=1)
-"""
+neighbor_comp = neighbor_composition(bond_graph, strct_index)
+display(neighbor_comp.head())
 
-def add_neighbor_weight(atom_str):
-    return sum([ATOM_W[c] for c in atom_str])
-    
-df_1j['neighbor_weight'] = df_1j['neighbor_atoms'].transform(add_neighbor_weight)
+df_1j_feats = get_1j_features(df_1j, bond_graph, strct_index, neighbor_comp)
+df_1j['1j_nbonds'] = df_1j_feats['1j_nbonds'].values
+df_1j['neighbor_atoms'] = df_1j_feats['neighbor_atoms'].values
+df_1j['neighbor_weight'] = df_1j_feats['neighbor_weight'].values
 
 df_1j.head(100)
 
@@ -495,59 +970,105 @@ df_1j.head()
 
 """## get intercept atoms and get some features"""
 
-def get_intercept_atom_2j(s, adjacent_matrix):
-    mole_name, idx0, idx1 = s
-    
-    connected_atom0 = adjacent_matrix[mole_name][:, idx0]
-    connected_atom1 = adjacent_matrix[mole_name][:, idx1]
-    intercept_atom = np.where(connected_atom0 * connected_atom1 > 0)[0]
-    if len(intercept_atom) != 1:
-        return -1
-        # TODO: bug fix
-        # raise ValueError('The number of intercept atoms is %d at %s' % (len(intercept_atom), mole_name))
-    intercept_atom_idx = intercept_atom[0]
-    # print(intercept_atom_idx)
-    return intercept_atom_idx
-
-def get_intercept_atom_3j(s, adjacent_matrix, adjacent_matrix2):
-    ret_idx_0 = -1
-    ret_idx_1 = -1
-    
-    mole_name, idx0, idx1 = s
-    
-    # atom, that be arrived by 1-path from idx0 and 2-path from idx1
-    connected_atom0 = adjacent_matrix[mole_name][:, idx0]
-    connected_atom1 = adjacent_matrix2[mole_name][:, idx1]
-    # np.where returns (array[], )
-    intercept_atom = np.where(connected_atom0 * connected_atom1 > 0)[0]    
-    
-    if len(intercept_atom) != 1:        
-        return -1, -1
-        # TODO: bug fix
-        # raise ValueError('The number of intercept atoms is %d at %s' % (len(intercept_atom), mole_name))    
-    else:
-        ret_idx_0 = intercept_atom[0]
-    
-    # atom, that be arrived by 2-path from idx0 and 1-path from idx1
-    connected_atom0 = adjacent_matrix2[mole_name][:, idx0]
-    connected_atom1 = adjacent_matrix[mole_name][:, idx1]
-    # np.where returns (array[], )
-    intercept_atom = np.where(connected_atom0 * connected_atom1 > 0)[0]
-    if len(intercept_atom) != 1:        
-        return -1, -1
-        # TODO: bug fix
-        # raise ValueError('The number of intercept atoms is %d at %s' % (len(intercept_atom), mole_name))    
-    else:
-        ret_idx_1 = intercept_atom[0]
+def path_bonds(graph, cand, node):
+    """
+    Parameters
+    ----------
+    graph: BondGraph
+    cand: np.ndarray, shape [n_samples, n_cand]
+        candidate nodes padded with -1
+    node: np.ndarray, shape [n_samples]
     
-    return ret_idx_0, ret_idx_1
+    Returns
+    -------
+    n_bonds: np.ndarray of int8, shape [n_samples, n_cand]
+        the number of bonds between each candidate and the node of the row. -1 for padding.
+    """
+    n_bonds = graph.bonds_between(np.where(cand >= 0, cand, node[:, None]), np.broadcast_to(node[:, None], cand.shape))
+    return np.where(cand >= 0, n_bonds, -1)
+
+def unique_candidate(cand, is_in):
+    """
+    Returns
+    -------
+    node: np.ndarray, shape [n_samples]
+        the candidate if exactly one candidate is True in the row, otherwise -1.
+    """
+    picked = cand[np.arange(len(cand)), is_in.argmax(axis=1)]
+    return np.where(is_in.sum(axis=1) == 1, picked, -1)
+
+def get_intercept_atom_2j(df, graph, chunk_size=1000000):
+    """
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_0', 'atom_index_1'
+    graph: BondGraph
+    chunk_size: int
+        the number of rows processed at once (bounds the memory)
+    
+    Returns
+    -------
+    center_index: np.ndarray, shape [n_samples]
+        atom index of the atom bonded to both atoms. -1 if it is not unique.
+    """
+    node0 = graph.node(df['molecule_name'].values, df['atom_index_0'].values)
+    node1 = graph.node(df['molecule_name'].values, df['atom_index_1'].values)
+    
+    center_index = np.full(len(df), -1, dtype=np.int32)
+    for start in range(0, len(df), chunk_size):
+        sl = slice(start, start + chunk_size)
+        # neighbors of idx0 that are 1 bond from idx1
+        cand = graph.neighbors(node0[sl])
+        is_center = (cand >= 0) & (path_bonds(graph, cand, node1[sl]) == 1)
+        # -1 if no atom or more than one atom (e.g. in a 4-membered ring) is bonded to both
+        center_index[sl] = graph.atom_index(unique_candidate(cand, is_center))
+    return center_index
+
+def get_intercept_atom_3j(df, graph, chunk_size=1000000):
+    """
+    Parameters
+    ----------
+    df: pd.DataFrame
+        df must have 'molecule_name', 'atom_index_0', 'atom_index_1'
+    graph: BondGraph
+    chunk_size: int
+        the number of rows processed at once (bounds the memory)
+    
+    Returns
+    -------
+    center_index_0: np.ndarray, shape [n_samples]
+        atom index of the atom bonded to atom_index_0 on the path.
+    center_index_1: np.ndarray, shape [n_samples]
+        atom index of the atom bonded to atom_index_1 on the path.
+        both are -1 if either of them is not unique.
+    """
+    node0 = graph.node(df['molecule_name'].values, df['atom_index_0'].values)
+    node1 = graph.node(df['molecule_name'].values, df['atom_index_1'].values)
+    
+    center_index_0 = np.full(len(df), -1, dtype=np.int32)
+    center_index_1 = np.full(len(df), -1, dtype=np.int32)
+    for start in range(0, len(df), chunk_size):
+        sl = slice(start, start + chunk_size)
+        # neighbor of idx0 that is 2 bonds from idx1
+        cand0 = graph.neighbors(node0[sl])
+        intercept0 = unique_candidate(cand0, (cand0 >= 0) & (path_bonds(graph, cand0, node1[sl]) == 2))
+        # neighbor of idx1 that is 2 bonds from idx0
+        cand1 = graph.neighbors(node1[sl])
+        intercept1 = unique_candidate(cand1, (cand1 >= 0) & (path_bonds(graph, cand1, node0[sl]) == 2))
+        
+        # -1 if either end of the path is not unique (e.g. two paths in a 4-membered ring)
+        is_found = (intercept0 >= 0) & (intercept1 >= 0)
+        center_index_0[sl] = np.where(is_found, graph.atom_index(intercept0), -1)
+        center_index_1[sl] = np.where(is_found, graph.atom_index(intercept1), -1)
+    return center_index_0, center_index_1
 
 def get_xyz(df, strct, idx_col, xyz_suffix, get_atom_name=False):
     """
     Parameters
     ----------
     df: pd.DataFrame
-    stcrt: pd.DataFrame
+    strct: StructureIndex
     idx_col: str
         column name according to atom_index in df. 
         e.g. atom_index_0
@@ -563,26 +1084,11 @@ def get_xyz(df, strct, idx_col, xyz_suffix, get_atom_name=False):
         shape of [n_samples, 3]. [n_samples, 4] if get_atom_name is True.
         e.g. the columns are 'x0', 'y0', 'z0', 'atom0'
     """
-    rename_dict = {
-        'x': 'x'+xyz_suffix, 
-        'y': 'y'+xyz_suffix, 
-        'z': 'z'+xyz_suffix        
-    }
+    pos = strct.pos(df['molecule_name'].values, df[idx_col].values)
     
+    ret = pd.DataFrame(strct.xyz[pos], columns=['x'+xyz_suffix, 'y'+xyz_suffix, 'z'+xyz_suffix])
     if get_atom_name:
-        atom_col = ['atom']
-        rename_dict['atom'] = 'atom'+xyz_suffix
-    else:
-        atom_col = []
-        
-    ret = df[['molecule_name', idx_col]].merge(
-        strct[['molecule_name', 'atom_index', 'x', 'y', 'z'] + atom_col],
-        left_on=['molecule_name', idx_col],
-        right_on=['molecule_name', 'atom_index'],
-        how='left'
-    )\
-    .drop(['molecule_name', idx_col, 'atom_index'], axis=1)\
-    .rename(columns=rename_dict)
+        ret['atom'+xyz_suffix] = strct.atom[pos]
     
     return ret
 
@@ -607,9 +1113,9 @@ def get_cos_2j(df, strct):
     df: pd.DataFrame
         df must be has `atom_index_0`, `atom_index_1`, `center_index` columns.
     """
-    tmp1 = get_xyz(df, df_strct, 'atom_index_0', '0')
-    tmp2 = get_xyz(df, df_strct, 'atom_index_1', '1')
-    tmp3 = get_xyz(df, df_strct, 'center_index', '2', get_atom_name=True)    
+    tmp1 = get_xyz(df, strct, 'atom_index_0', '0')
+    tmp2 = get_xyz(df, strct, 'atom_index_1', '1')
+    tmp3 = get_xyz(df, strct, 'center_index', '2', get_atom_name=True)    
     
     # get vector
     vec_02 = tmp3[['x2', 'y2', 'z2']].values - tmp1[['x0', 'y0', 'z0']].values
@@ -642,10 +1148,10 @@ def get_cos_3j(df, strct):
     df: pd.DataFrame
         df must be has `atom_index_0`, `atom_index_1`, `center_index_0`, `center_index_1` columns.
     """
-    tmp0 = get_xyz(df, df_strct, 'atom_index_0', '0')
-    tmp1 = get_xyz(df, df_strct, 'atom_index_1', '1')
-    tmp2 = get_xyz(df, df_strct, 'center_index_0', '2', get_atom_name=True)
-    tmp3 = get_xyz(df, df_strct, 'center_index_1', '3', get_atom_name=True)
+    tmp0 = get_xyz(df, strct, 'atom_index_0', '0')
+    tmp1 = get_xyz(df, strct, 'atom_index_1', '1')
+    tmp2 = get_xyz(df, strct, 'center_index_0', '2', get_atom_name=True)
+    tmp3 = get_xyz(df, strct, 'center_index_1', '3', get_atom_name=True)
     
     # get vector
     vec_02 = tmp2[['x2', 'y2', 'z2']].values - tmp0[['x0', 'y0', 'z0']].values
@@ -690,28 +1196,18 @@ def get_cos_3j(df, strct):
     
     return ret
 
-df_2j['center_index'] = df_2j[['molecule_name', 'atom_index_0', 'atom_index_1']].apply(get_intercept_atom_2j, adjacent_matrix=adj_mat, axis=1)
+df_2j['center_index'] = get_intercept_atom_2j(df_2j, bond_graph)
 display(df_2j.head())
-df_2jsim = get_cos_2j(df_2j, df_strct)
+df_2jsim = get_cos_2j(df_2j, strct_index)
 df_2jsim.head()
 
 joblib.dump(df_2jsim, 'df_2jsim.pkl')
 
-# tmp = df_3j[['molecule_name', 'atom_index_0', 'atom_index_1']].head(1000)
-tmp2 = df_3j[['molecule_name', 'atom_index_0', 'atom_index_1']].apply(get_intercept_atom_3j, 
-# tmp2 = tmp.apply(get_intercept_atom_3j, 
-                                                                     adjacent_matrix=adj_mat, 
-                                                                     adjacent_matrix2=adj_mat2, 
-                                                                     axis=1,
-                                                                     result_type='expand'
-                                                                     )
-tmp2.rename(columns={0: 'center_index_0', 1: 'center_index_1'}, inplace=True)
-df_3j = pd.concat([df_3j, tmp2], axis=1)
-# tmp = pd.concat([tmp, tmp2], axis=1)
+df_3j['center_index_0'], df_3j['center_index_1'] = get_intercept_atom_3j(df_3j, bond_graph)
 display(df_3j.tail())
 # display(tmp.tail())
-df_3jsim = get_cos_3j(df_3j, df_strct)
-# df_3jsim = get_cos_3j(tmp, df_strct)
+df_3jsim = get_cos_3j(df_3j, strct_index)
+# df_3jsim = get_cos_3j(tmp, strct_index)
 df_3jsim.tail()
 
 df_3jsim.head()
@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+"""test_molecular
+
+Tests of the functions of molecular.py and molecular_eda.py on the synthetic data of benchmark.py.
+
+    python -m pytest -q test_molecular.py
+"""
+
+import os
+import subprocess
+import sys
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+
+# functions of the online scoring (molecular.py) in addition to benchmark.MOLECULAR_NAMES
+SCORING_NAMES = [
+    'load_1j_table', 'add_1j', 'preprocess_molecules', 'encode',
+    'normalize', 'topological_distance', 'unique_member', 'molecule_features', 'molecule_inputs',
+]
+
+@pytest.fixture(scope='module')
+def functions(tmp_path_factory):
+    """namespaces of molecular.py and molecular_eda.py (benchmark.load_functions)"""
+    return benchmark.load_functions(str(tmp_path_factory.mktemp('functions')) + '/')
+
+def run_in_new_process(code):
+    """stdout of `code` run by a new interpreter in the notebook directory"""
+    return subprocess.check_output([sys.executable, '-c', code], cwd=benchmark.NOTEBOOK_DIR).decode().strip()
+
+@pytest.fixture(scope='module')
+def pipeline(tmp_path_factory):
+    """
+    Features of the batch pipeline (molecular_eda.py tables merged by preprocess of molecular.py)
+    and the inputs of molecule_features() of each molecule.
+    """
+    preprocess_dir = str(tmp_path_factory.mktemp('preprocess')) + '/'
+    mol, eda = benchmark.load_functions(preprocess_dir)
+    mol['ENCODER_PATH'] = preprocess_dir + 'le.pkl'
+    benchmark.load_definitions(benchmark.MOLECULAR_PATH, SCORING_NAMES, mol)
+
+    df, df_strct, df_bonds = benchmark.make_dataset(300, seed=0)
+    for d in [df, df_strct, df_bonds]:
+        mol['encode_molecule_name'](d)
+    strct = mol['StructureIndex'](df_strct)
+    graph = eda['BondGraph'].from_bonds(df_bonds, pd.Series(strct.n_atoms, index=strct.mol_names))
+
+    n_bond = df['type'].str[0]
+    df_1j = df[n_bond == '1'].reset_index(drop=True)
+    comp = eda['neighbor_composition'](graph, strct)
+    joblib.dump(eda['get_1j_features'](df_1j, graph, strct, comp), preprocess_dir + 'df_1j.pkl')
+    df_2j = df[n_bond == '2'].reset_index(drop=True)
+    df_2j['center_index'] = eda['get_intercept_atom_2j'](df_2j, graph)
+    joblib.dump(eda['get_cos_2j'](df_2j, strct), preprocess_dir + 'df_2jsim.pkl')
+    df_3j = df[n_bond == '3'].reset_index(drop=True)
+    df_3j['center_index_0'], df_3j['center_index_1'] = eda['get_intercept_atom_3j'](df_3j, graph)
+    joblib.dump(eda['get_cos_3j'](df_3j, strct), preprocess_dir + 'df_3jsim.pkl')
+
+    df_fe = mol['add_1j'](df)
+    df_fe = mol['add_2j_center_atom'](df_fe)
+    df_fe = mol['add_3j_center_atom'](df_fe)
+    df_fe = mol['preprocess_molecules'](df_fe, strct)
+    inputs = list(mol['molecule_inputs'](df, strct, df_bonds))
+    return mol, df_fe, inputs
+
+def assert_same_column(online, batch, name):
+    if pd.api.types.is_numeric_dtype(batch.dtype) and not isinstance(batch.dtype, pd.CategoricalDtype):
+        np.testing.assert_allclose(online.astype(np.float64), batch.values.astype(np.float64),
+                                   rtol=1e-9, atol=1e-12, equal_nan=True, err_msg=name)
+    else:
+        online = pd.Series(online, dtype=object).where(pd.notna(online), 'nan').astype(str)
+        batch = pd.Series(batch.values, dtype=object).where(batch.notna().values, 'nan').astype(str)
+        assert (online.values == batch.values).all(), name
+
+def test_molecule_features_with_fluorine(pipeline):
+    """molecule_features() gives the features of the batch pipeline on molecules with F"""
+    mol, df_fe, inputs = pipeline
+    rows_of = df_fe.groupby('molecule_name', sort=False).indices
+    n_checked = 0
+    for mole_name, (atoms, coords, bonds, pairs, types) in zip(rows_of.keys(), inputs):
+        if 'F' not in atoms or not any(t.startswith('1J') for t in types):
+            continue
+        feats = mol['molecule_features'](atoms, coords, bonds, pairs, types)
+        ref = df_fe.iloc[rows_of[mole_name]]
+        for name, values in feats.items():
+            assert_same_column(values, ref[name], name)
+        n_checked += 1
+    assert n_checked > 0, 'no molecule with F and 1J couplings'
+
+def test_neighbor_weight_of_fluorine_neighbor(pipeline):
+    """neighbor_weight is NaN only if a bonded atom has no atomic weight"""
+    mol, _, _ = pipeline
+    # H0-C1(-F2)(-H3), H4-C5 bonded to C1
+    atoms = ['H', 'C', 'F', 'H', 'C', 'H']
+    coords = np.random.RandomState(0).normal(size=(len(atoms), 3))
+    bonds = [[0, 1], [1, 2], [1, 3], [1, 4], [4, 5]]
+    pairs = [[0, 1], [5, 4]]
+    feats = mol['molecule_features'](atoms, coords, bonds, pairs, ['1JHC', '1JHC'])
+    assert np.isnan(feats['neighbor_weight'][0])
+    assert feats['neighbor_weight'][1] == pytest.approx(mol['atom_weight']['C'])
+
+def test_encode_online_as_batch(pipeline):
+    """the categorical features of molecule_features() get the codes of encode() including neighbor_atoms"""
+    mol, df_fe, inputs = pipeline
+    df_enc, enc = mol['encode'](df_fe.copy(), 'train')
+    assert 'neighbor_atoms' in enc.vocabs
+    rows_of = df_fe.groupby('molecule_name', sort=False).indices
+    for mole_name, args in zip(rows_of.keys(), inputs):
+        feats = mol['molecule_features'](*args)
+        ref = df_enc.iloc[rows_of[mole_name]]
+        for cat_name in enc.vocabs.keys():
+            np.testing.assert_array_equal(enc.encode(cat_name, feats[cat_name]), ref[cat_name].values,
+                                          err_msg=cat_name)
+            assert pd.api.types.is_integer_dtype(ref[cat_name].dtype), cat_name
+
+def test_fingerprint_of_pandas_objects(functions):
+    """inputs differing in the middle (hidden by the repr of pandas) have different fingerprints"""
+    mol, _ = functions
+    fingerprint = mol['fingerprint']
+    values = ['1JHC'] * 500 + ['2JHH'] + ['1JHC'] * 500
+    other = values[:500] + ['3JHH'] + values[501:]
+    for make in [lambda v: pd.Categorical(v, categories=['1JHC', '2JHH', '3JHH']),
+                 lambda v: pd.Series(v, dtype='category'), pd.Index, list, tuple, np.array]:
+        assert fingerprint(make(values)) != fingerprint(make(other))
+        assert fingerprint(make(values)) == fingerprint(make(list(values)))
+    assert fingerprint({'a': [1, 2], 'b': 3}) == fingerprint({'b': 3, 'a': [1, 2]})
+    assert fingerprint({'a': [1, 2]}) != fingerprint({'a': [1, 3]})
+
+def test_fingerprint_across_processes():
+    """fingerprints of functions, containers and pandas objects do not depend on the process"""
+    code = (
+        "import benchmark, pandas as pd\n"
+        "mol, _ = benchmark.load_functions('')\n"
+        "fp = mol['fingerprint']\n"
+        "print(fp((4, mol['make_group_folds'])), fp({'x', 'y', 'z'}), fp(pd.Index(['a', 'b'])),"
+        " fp([mol['FE_AGGS'], mol['StructureIndex']]))\n")
+    assert run_in_new_process(code) == run_in_new_process(code)
+
+@pytest.fixture(scope='module')
+def dataset():
+    """synthetic train.csv, structures.csv and bonds of benchmark.make_dataset()"""
+    return benchmark.make_dataset(300, seed=0)
+
+def test_make_group_folds(functions, dataset):
+    """a molecule is in one fold and every type is spread evenly over the folds"""
+    mol, _ = functions
+    df, _, _ = dataset
+    # rows of a molecule are not contiguous
+    df = df.sample(frac=1, random_state=0)
+    folds = mol['make_group_folds'](df['molecule_name'].values, df['type'].values)
+    assert (pd.Series(folds).groupby(df['molecule_name'].values).nunique() == 1).all()
+    assert set(folds) == set(range(mol['N_FOLDS']))
+    share = pd.crosstab(df['type'].values, folds, normalize='index')
+    np.testing.assert_allclose(share.values, 1 / mol['N_FOLDS'], atol=0.03)
+
+def test_fold_key_across_processes(tmp_path):
+    """get_folds() reuses the saved folds in a new process"""
+    code = (
+        "import benchmark\n"
+        "mol, _ = benchmark.load_functions('')\n"
+        "df, _, _ = benchmark.make_dataset(50, seed=0)\n"
+        "folds = mol['get_folds'](df['molecule_name'], df['type'].astype('category'), path=%r)\n"
+        "print(mol['fold_key'](df['molecule_name'], df['type']), folds.sum())\n" % str(tmp_path / 'folds.npz'))
+    first = run_in_new_process(code)
+    mtime = os.stat(tmp_path / 'folds.npz').st_mtime_ns
+    assert run_in_new_process(code) == first
+    # loaded, not saved again
+    assert os.stat(tmp_path / 'folds.npz').st_mtime_ns == mtime
+    key = first.split()[0]
+    assert str(np.load(tmp_path / 'folds.npz')['key']) == key
+
+def test_stage_cache(functions, tmp_path):
+    """changing a stage recomputes it and the stages after it, and loads the stages before it"""
+    mol, _ = functions
+    benchmark.load_definitions(benchmark.MOLECULAR_PATH, ['STAGE_CACHE_DIR', 'USE_STAGE_CACHE', 'StageCache'], mol)
+    calls = []
+    def add_one(x):
+        calls.append('add_one')
+        return x + 1
+    def add_two(x):
+        calls.append('add_two')
+        return x + 2
+    def double(x):
+        calls.append('double')
+        return x * 2
+    def triple(x):
+        calls.append('triple')
+        return x * 3
+
+    def run(second=double, deps_0=(1,), deps_1=(1,)):
+        del calls[:]
+        cache = mol['StageCache']([np.arange(5)], root=str(tmp_path))
+        x = cache.run('first', add_one, np.arange(5), deps=deps_0)
+        x = cache.run('second', second, x, deps=deps_1)
+        x = cache.run('third', add_two, x)
+        return x, list(calls)
+
+    x, called = run()
+    assert called == ['add_one', 'double', 'add_two']
+    np.testing.assert_array_equal(x, (np.arange(5) + 1) * 2 + 2)
+    assert run()[1] == []
+    # a function of the second stage
+    x, called = run(second=triple)
+    assert called == ['triple', 'add_two']
+    np.testing.assert_array_equal(x, (np.arange(5) + 1) * 3 + 2)
+    # deps of the second stage and of the first stage
+    assert run(deps_1=(2,))[1] == ['double', 'add_two']
+    assert run(deps_0=(2,))[1] == ['add_one', 'double', 'add_two']
+    assert run()[1] == []
+
+# baseline of get_intercept_atom_2j/3j (row by row on dense adjacent matrices of molecular_eda.py)
+def get_adjacent_mat_baseline(df):
+    edges = df[['atom_index_0', 'atom_index_1']].values.transpose(1, 0)
+    n_bonds = df['nbond'].values
+    n_nodes = edges.max() + 1
+    mat = np.zeros((n_nodes, n_nodes), dtype=np.uint8)
+    for n_bond in [1, 2, 3]:
+        is_the_bond = (n_bonds == n_bond)
+        mat[edges[0][is_the_bond], edges[1][is_the_bond]] = n_bond
+    mat += mat.transpose(1, 0)
+    return mat
+
+def get_intercept_atom_2j_baseline(s, adjacent_matrix):
+    mole_name, idx0, idx1 = s
+    intercept_atom = np.where(adjacent_matrix[mole_name][:, idx0] * adjacent_matrix[mole_name][:, idx1] > 0)[0]
+    return intercept_atom[0] if len(intercept_atom) == 1 else -1
+
+def get_intercept_atom_3j_baseline(s, adjacent_matrix, adjacent_matrix2):
+    mole_name, idx0, idx1 = s
+    ret = []
+    for adj0, adj1 in [(adjacent_matrix, adjacent_matrix2), (adjacent_matrix2, adjacent_matrix)]:
+        intercept_atom = np.where(adj0[mole_name][:, idx0] * adj1[mole_name][:, idx1] > 0)[0]
+        if len(intercept_atom) != 1:
+            return -1, -1
+        ret.append(intercept_atom[0])
+    return tuple(ret)
+
+def hand_built_molecules():
+    """
+    molecule_name: (atoms, bonds of (atom_index_0, atom_index_1, nbond))
+        1: chain H3C-CH2-NH-OH with a double bond C=N
+        2: 4-membered ring C4H4 (two paths between opposite atoms)
+        3: 6-membered ring with a methyl branch and N
+        4: 5-membered ring
+    """
+    def with_h(heavy, bonds, n_h):
+        atoms = list(heavy)
+        for i, n in enumerate(n_h):
+            for _ in range(n):
+                atoms.append('H')
+                bonds = bonds + [(i, len(atoms) - 1, 1.0)]
+        return atoms, bonds
+    ring = lambda n, order=1.0: [(i, (i + 1) % n, order) for i in range(n)]
+    return {
+        1: with_h('CCNO', [(0, 1, 1.0), (1, 2, 2.0), (2, 3, 1.0)], [3, 1, 0, 1]),
+        2: with_h('CCCC', ring(4), [2, 2, 2, 2]),
+        3: with_h('CCCCNCC', ring(6) + [(0, 6, 1.0)], [1, 2, 2, 2, 1, 2, 3]),
+        4: with_h('CCCCO', ring(5), [2, 2, 2, 2, 0]),
+    }
+
+def make_graph(eda, molecules):
+    """df_bonds and BondGraph of {molecule_name: (atoms, bonds)}"""
+    df_bonds = pd.DataFrame([(name, a, b, o) for name, (_, bonds) in molecules.items() for a, b, o in bonds],
+                            columns=['molecule_name', 'atom_index_0', 'atom_index_1', 'nbond'])
+    n_atoms = pd.Series({name: len(atoms) for name, (atoms, _) in molecules.items()})
+    return df_bonds, eda['BondGraph'].from_bonds(df_bonds, n_atoms)
+
+def couplings_of(molecules, n_bond):
+    """pairs of H and another atom `n_bond` bonds apart"""
+    rows = []
+    for name, (atoms, bonds) in molecules.items():
+        dist = benchmark.bond_distance(len(atoms), bonds)
+        for i, j in zip(*np.nonzero(dist == n_bond)):
+            if atoms[i] == 'H' and (atoms[j] != 'H' or i < j):
+                rows.append((name, i, j))
+    return pd.DataFrame(rows, columns=['molecule_name', 'atom_index_0', 'atom_index_1'])
+
+def test_intercept_atoms_as_baseline(functions):
+    """get_intercept_atom_2j/3j give the centers of the row-wise baseline, -1 if not unique"""
+    _, eda = functions
+    molecules = hand_built_molecules()
+    df_bonds, graph = make_graph(eda, molecules)
+    adj = {name: get_adjacent_mat_baseline(g) for name, g in df_bonds.groupby('molecule_name')}
+    adj2 = {name: mat @ mat for name, mat in adj.items()}
+
+    df_2j = couplings_of(molecules, 2)
+    expected = [get_intercept_atom_2j_baseline(s, adj) for s in df_2j.values]
+    np.testing.assert_array_equal(eda['get_intercept_atom_2j'](df_2j, graph, chunk_size=7), expected)
+
+    df_3j = couplings_of(molecules, 3)
+    expected = np.array([get_intercept_atom_3j_baseline(s, adj, adj2) for s in df_3j.values])
+    center_0, center_1 = eda['get_intercept_atom_3j'](df_3j, graph, chunk_size=7)
+    np.testing.assert_array_equal(center_0, expected[:, 0])
+    np.testing.assert_array_equal(center_1, expected[:, 1])
+
+    # H4 and C2 of the 4-membered ring are connected by H4-C0-C1-C2 and H4-C0-C3-C2
+    is_across = ((df_3j['molecule_name'] == 2) & (df_3j['atom_index_0'] == 4) & (df_3j['atom_index_1'] == 2)).values
+    assert is_across.sum() == 1
+    assert center_0[is_across] == -1 and center_1[is_across] == -1
+    assert (center_0 >= 0).any() and (center_0 == -1).any()
+
+def test_intercept_atoms_of_aromatic_bonds(functions):
+    """1.5 (aromatic) bonds are bonds, which the baseline adjacent matrix dropped"""
+    _, eda = functions
+    benzene = {1: (['C'] * 6 + ['H'] * 6, [(i, (i + 1) % 6, 1.5) for i in range(6)] + [(i, i + 6, 1.0) for i in range(6)])}
+    kekule = {1: (benzene[1][0], [(a, b, 1.0) for a, b, _ in benzene[1][1]])}
+    _, graph = make_graph(eda, benzene)
+    df_bonds, _ = make_graph(eda, kekule)
+    adj = {1: get_adjacent_mat_baseline(df_bonds)}
+    adj2 = {1: adj[1] @ adj[1]}
+    df_2j, df_3j = couplings_of(benzene, 2), couplings_of(benzene, 3)
+    np.testing.assert_array_equal(eda['get_intercept_atom_2j'](df_2j, graph),
+                                  [get_intercept_atom_2j_baseline(s, adj) for s in df_2j.values])
+    center_0, center_1 = eda['get_intercept_atom_3j'](df_3j, graph)
+    expected = np.array([get_intercept_atom_3j_baseline(s, adj, adj2) for s in df_3j.values])
+    np.testing.assert_array_equal(np.c_[center_0, center_1], expected)
+    assert (center_0 >= 0).all()
+
+def test_feature_engineering_as_groupby(functions, dataset):
+    """feature_engineering() gives df.groupby(keys)[column].transform(stat) on unsorted rows with NaN"""
+    mol, _ = functions
+    df, _, _ = dataset
+    rng = np.random.RandomState(0)
+    df = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    for col in ['dist', 'x_1', 'y_1', 'z_1']:
+        df[col] = rng.normal(1., 1., len(df))
+    df['atom_1'] = rng.choice(['C', 'H', 'N', 'O'], len(df))
+    df['type_0'] = df['type'].str[0]
+    df.loc[rng.rand(len(df)) < 0.1, 'dist'] = np.nan
+    df.loc[df['molecule_name'] == df['molecule_name'].iloc[0], 'dist'] = np.nan
+    df.loc[rng.rand(len(df)) < 0.1, 'atom_1'] = np.nan
+
+    expected = df.copy()
+    for name, keys, col, stat, ops in mol['FE_AGGS']:
+        expected[name] = expected.groupby(keys)[col].transform(stat)
+        for op in ops:
+            if op == 'diff':
+                expected[f'{name}_diff'] = expected[name] - expected[col]
+            elif op == 'div':
+                expected[f'{name}_div'] = expected[name] / expected[col]
+
+    result = mol['feature_engineering'](df.copy())
+    assert list(result.columns) == list(expected.columns)
+    for name in expected.columns:
+        assert_same_column(result[name].values, expected[name], name)
+
+def test_reduce_mem_usage_round_trip(functions):
+    """reduced floats are within REDUCE_MEM_RTOL of the original values, with inf and NaN kept"""
+    mol, _ = functions
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'coord': rng.normal(0., 3., 1000),
+        'large': rng.normal(0., 1e8, 1000),
+        'tiny': rng.normal(0., 1e-9, 1000),
+        'half': rng.randint(-100, 100, 1000) / 4,
+        'half_inf': np.r_[np.inf, -np.inf, np.nan, rng.randint(-100, 100, 997) / 4],
+        'coord_inf': np.r_[np.inf, -np.inf, np.nan, rng.normal(0., 3., 997)],
+    })
+    original = df.copy()
+    mol['reduce_mem_usage'](df, verbose=False)
+    assert df['half'].dtype == np.float16 and df['half_inf'].dtype == np.float16
+    assert df['coord'].dtype == np.float32 and df['coord_inf'].dtype == np.float32
+    for col in df.columns:
+        np.testing.assert_allclose(df[col].values.astype(np.float64), original[col].values,
+                                   rtol=mol['REDUCE_MEM_RTOL'], atol=0, equal_nan=True, err_msg=col)
+    # float16 loses precision of general values beyond the tolerance
+    assert not mol['_round_trip_ok'](original['coord'].values, np.float16, mol['REDUCE_MEM_RTOL'], 0.)
+
+def test_reduce_mem_usage_integers(functions):
+    """integers are cast to the smallest integer type holding [min, max]"""
+    mol, _ = functions
+    cases = {
+        'int8': ([-128, 127], np.int8),
+        'int16': ([0, 128], np.int16),
+        'int16_neg': ([-129, 0], np.int16),
+        'int32': ([-40000, 1], np.int32),
+        'int64': ([0, 2**40], np.int64),
+    }
+    df = pd.DataFrame({col: np.array(values * 3, dtype=np.int64) for col, (values, _) in cases.items()})
+    mol['reduce_mem_usage'](df, verbose=False)
+    for col, (values, dtype) in cases.items():
+        assert df[col].dtype == dtype, col
+        assert df[col].tolist() == values * 3, col
+
+def group_mean_log_mae_baseline(y_true, y_pred, types, floor=1e-9):
+    """group_mean_log_mae of pandas groupby/map"""
+    maes = (y_true-y_pred).abs().groupby(types).mean()
+    return np.log(maes.map(lambda x: max(x, floor))).mean()
+
+def test_group_mean_log_mae_as_baseline(functions, dataset):
+    """group_mean_log_mae() gives the score of the pandas groupby/map version"""
+    mol, _ = functions
+    df, _, _ = dataset
+    rng = np.random.RandomState(0)
+    y_true = pd.Series(rng.normal(0., 10., len(df)))
+    y_pred = y_true + rng.normal(0., 1., len(df))
+    # a type predicted exactly is floored
+    is_exact = (df['type'] == df['type'].iloc[0]).values
+    y_pred[is_exact] = y_true[is_exact]
+    for types in [df['type'], pd.Series(pd.factorize(df['type'])[0])]:
+        expected = group_mean_log_mae_baseline(y_true, y_pred, types)
+        np.testing.assert_allclose(mol['group_mean_log_mae'](y_true, y_pred, types), expected, rtol=1e-12)
+        np.testing.assert_allclose(mol['group_mean_log_mae'](y_true.values, y_pred.values, types.values), 
+                                   expected, rtol=1e-12)
+
+def test_group_mae_batches(functions, dataset):
+    """GroupMAE updated batch by batch gives the score of a single update()"""
+    mol, _ = functions
+    df, _, _ = dataset
+    rng = np.random.RandomState(0)
+    y_true = rng.normal(0., 10., len(df))
+    y_pred = y_true + rng.normal(0., 1., len(df))
+    groups = mol['group_codes'](df['type'].values)
+    expected = mol['GroupMAE']().update(y_true, y_pred, groups)
+    
+    order = rng.permutation(len(df))
+    # the first batch has only the smallest codes, so later batches grow the accumulator
+    order = order[np.argsort(groups[order] > groups.min(), kind='stable')]
+    batched = mol['GroupMAE']()
+    for idx in np.array_split(order, [0, 10, 100, 101, len(df) // 2]):
+        batched.update(y_true[idx], y_pred[idx], groups[idx])
+    np.testing.assert_array_equal(batched.count, expected.count)
+    np.testing.assert_allclose(batched.abs_sum, expected.abs_sum, rtol=1e-12)
+    np.testing.assert_allclose(batched.score(), expected.score(), rtol=1e-12)
+
+# feature store and chunked reading of molecular.py
+STORE_NAMES = ['FEATURE_STORE_DIR', 'FeatureStore', 'CSV_DTYPES', 'csv_dtypes', 'iter_molecule_chunks']
+
+def test_feature_store_round_trip(functions, dataset, tmp_path):
+    """FeatureStore.load() gives back the saved columns, dtypes and categories of any columns and types"""
+    mol, _ = functions
+    benchmark.load_definitions(benchmark.MOLECULAR_PATH, STORE_NAMES, mol)
+    df, _, _ = dataset
+    rng = np.random.RandomState(0)
+    df = df.copy()
+    df['atom_1'] = pd.Categorical(rng.choice(['N', 'C', 'H'], len(df)), categories=['N', 'C', 'H'])
+    df.loc[rng.rand(len(df)) < 0.1, 'atom_1'] = np.nan
+    df['n_bond'] = df['type'].str[0].astype(np.int8)
+    df['dist'] = rng.normal(1., 1., len(df)).astype(np.float32)
+    # rows of a type are not contiguous
+    df = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    s_type = df['type'].copy()
+
+    store = mol['FeatureStore'](str(tmp_path))
+    store.save(df, s_type)
+    # categories are saved as int32 codes
+    part_dir = tmp_path / s_type.iloc[0]
+    codes = np.load(part_dir / 'atom_1.npy')
+    assert codes.dtype == np.int32
+    rows = np.load(part_dir / '_row.npy')
+    np.testing.assert_array_equal(codes, df['atom_1'].cat.codes.values[rows])
+
+    # a new instance reads the manifest
+    store = mol['FeatureStore'](str(tmp_path))
+    pd.testing.assert_frame_equal(store.load(), df)
+    pd.testing.assert_series_equal(store.load_type(), s_type)
+    columns = ['dist', 'atom_1', 'molecule_name']
+    types = sorted(s_type.unique())[:2]
+    expected = df.loc[s_type.isin(types).values, columns]
+    pd.testing.assert_frame_equal(store.load(columns=columns, types=types), expected)
+    pd.testing.assert_frame_equal(store.load(columns=['atom_1'], types=types[:1]), 
+                                  df.loc[(s_type == types[0]).values, ['atom_1']])
+
+def test_iter_molecule_chunks(functions, dataset, tmp_path):
+    """chunks never divide a molecule and their concatenation is the csv file"""
+    mol, _ = functions
+    benchmark.load_definitions(benchmark.MOLECULAR_PATH, STORE_NAMES, mol)
+    df, _, _ = dataset
+    path = str(tmp_path / 'test.csv')
+    df.to_csv(path, index=False)
+    expected = pd.read_csv(path, dtype=mol['csv_dtypes'](path))
+    if mol['INT_MOLECULE_ID']:
+        expected = mol['encode_molecule_name'](expected)
+    # categories of a chunk are the values in the chunk
+    expected = expected.astype({col: str for col in expected.columns if expected[col].dtype == 'category'})
+    for chunk_size in [50, 1000, len(df) + 1]:
+        chunks = list(mol['iter_molecule_chunks'](path, chunk_size))
+        assert len(chunks) > 1 or chunk_size > len(df)
+        mol_names = [set(chunk['molecule_name']) for chunk in chunks]
+        for i, names in enumerate(mol_names):
+            assert not any(names & other for other in mol_names[i + 1:]), chunk_size
+        result = pd.concat([chunk.astype(expected.dtypes.to_dict()) for chunk in chunks], ignore_index=True)
+        pd.testing.assert_frame_equal(result, expected)
+
+# helpers copied in both notebooks (molecular_eda.py writes the tables molecular.py reads)
+SHARED_NAMES = [
+    'INT_MOLECULE_ID', 'MOLECULE_PREFIX', 'USE_CSV_CACHE', 'CSV_CACHE_DIR', 'CSV_DTYPES',
+    'encode_molecule_name', 'decode_molecule_name', 'csv_dtypes', 'read_csv', 'csv_cache_dir', 'load_csv',
+    'relabel', 'divide_type', 'StructureIndex', 'map_atom_info', 'calc_dist', 'topological_distance', 'normalize',
+]
+
+def test_shared_definitions():
+    """the helpers in both notebooks have the same source"""
+    sources = []
+    for path in [benchmark.MOLECULAR_PATH, benchmark.MOLECULAR_EDA_PATH]:
+        # the last definition of a name is the one in use
+        sources.append({name: source for defined, source in benchmark.iter_definitions(path) for name in defined})
+    for name in SHARED_NAMES:
+        assert name in sources[0] and name in sources[1], name
+        assert sources[0][name] == sources[1][name], name
+
+CSV_NAMES = ['USE_CSV_CACHE', 'CSV_CACHE_DIR', 'CSV_DTYPES', 'csv_dtypes', 'read_csv', 'csv_cache_dir', 'load_csv']
+
+def test_load_csv_cache(functions, dataset, tmp_path):
+    """load_csv() gives read_csv() from the cache, which is rebuilt when the csv file changes"""
+    mol, _ = functions
+    ns = benchmark.load_definitions(benchmark.MOLECULAR_PATH, CSV_NAMES, dict(mol))
+    ns['CSV_CACHE_DIR'] = str(tmp_path / 'csv_cache') + '/'
+    df, _, _ = dataset
+    path = str(tmp_path / 'train.csv')
+    df.to_csv(path, index=False)
+    expected = ns['read_csv'](path)
+    # load_csv() memory-maps the columns and copy() gives ndarrays to compare
+
+    pd.testing.assert_frame_equal(ns['load_csv'](path).copy(), expected)
+    cache_dir = ns['csv_cache_dir'](path)
+    assert os.path.exists(os.path.join(cache_dir, 'meta.json'))
+    # the second load does not read the csv
+    read_csv = ns['read_csv']
+    def fail(*args, **kwargs):
+        raise AssertionError('csv is read')
+    ns['read_csv'] = fail
+    pd.testing.assert_frame_equal(ns['load_csv'](path).copy(), expected)
+    pd.testing.assert_frame_equal(ns['load_csv'](path, usecols=['type', 'id']).copy(), expected[['id', 'type']])
+    ns['read_csv'] = read_csv
+
+    # a new file with another mtime
+    df_new = df.head(100).assign(scalar_coupling_constant=lambda d: d['scalar_coupling_constant'] + 1)
+    df_new.to_csv(path, index=False)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert ns['csv_cache_dir'](path) != cache_dir
+    pd.testing.assert_frame_equal(ns['load_csv'](path).copy(), ns['read_csv'](path))
+    assert len(ns['load_csv'](path)) == 100